@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+# Compares the IRC formatting pipeline with the regex based implementation it replaced.
+# Usage: benchmarks/formatting.py [iterations]
+
+import html
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "jargonaut"))
+from formatting import format_irc
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "irc-corpus.txt")
+
+# The implementation print_message used before formatting.py
+def legacy_format(text):
+    text = html.escape(text)
+    text = re.sub(r'\x02(.*?)\x02', r'<b>\1</b>', text)
+    text = re.sub(r'\x16(.*?)\x16', r'<i>\1</i>', text)
+    text = re.sub(r'\x1D(.*?)\x1D', r'<i>\1</i>', text)
+    text = re.sub(r'\x1F(.*?)\x1F', r'<u>\1</u>', text)
+    text = re.sub(r'\x1E(.*?)\x1E', r'<s>\1</s>', text)
+    url_pattern = r'((http[s]?://[^\s]{3,}\.[^\s]{2,}))'
+    def repl(match):
+        url = match.group(1)
+        if url.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.svg', '.bmp', '.webp')):
+            return f'<a href="{url}"><img class="thumb" src="{url}" title="{url}"/></a>'
+        else:
+            return f'<a href="{url}">{url}</a>'
+    text = re.sub(url_pattern, repl, text)
+    return text
+
+def run(name, function, lines, iterations):
+    def format_corpus():
+        for line in lines:
+            function(line)
+    seconds = min(timeit.repeat(format_corpus, number=iterations, repeat=5))
+    per_line = seconds / (iterations * len(lines)) * 1000000
+    print(f"{name:10} {per_line:8.2f} µs/line  {1000000 / per_line:10.0f} lines/s")
+    return per_line
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open(CORPUS, encoding="utf-8") as corpus:
+        # Not splitlines(), which also splits on some IRC formatting codes
+        lines = corpus.read().rstrip("\n").split("\n")
+    print(f"{len(lines)} lines, {iterations} iterations")
+    legacy = run("legacy", legacy_format, lines, iterations)
+    current = run("current", format_irc, lines, iterations)
+    print(f"speedup    {legacy / current:8.2f}x")
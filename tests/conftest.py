@@ -0,0 +1,63 @@
+import collections
+import http.server
+import os
+import sys
+import threading
+import time
+import pytest
+
+# The modules are installed in /usr/lib/jargonaut, test the ones of the tree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "jargonaut"))
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        route = server.routes.get(self.path)
+        with server.lock:
+            server.hits[self.path] += 1
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        if route is not None:
+            time.sleep(route[2])
+        with server.lock:
+            server.active -= 1
+        if route is None:
+            self.send_error(404)
+            return
+        body, headers, delay = route
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# A local HTTP server standing in for the web. Tests add the responses of the paths
+# they fetch; it counts the requests, and how many were handled at once at most.
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.routes = {}
+        self.hits = collections.Counter()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    # Responses without a Content-Length header end when the connection is closed
+    def add_route(self, path, body, headers=None, delay=0):
+        self.routes[path] = (body, headers or {}, delay)
+
+    def get_url(self, path):
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+@pytest.fixture
+def http_server():
+    server = StandInServer()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,67 @@
+import base64
+import types
+from capabilities import CapNegotiation, format_server_time, get_authenticate_chunks, get_sasl_plain_payload, \
+    get_tag, parse_server_time
+
+def test_get_tag():
+    event = types.SimpleNamespace(tags=[{"key": "time", "value": "2024-01-31T12:34:56.789Z"}])
+    assert get_tag(event, "time") == "2024-01-31T12:34:56.789Z"
+    assert get_tag(event, "batch") is None
+    assert get_tag(types.SimpleNamespace(tags=None), "time") is None
+    assert get_tag(types.SimpleNamespace(), "time") is None
+
+def test_server_time():
+    timestamp = parse_server_time("2024-01-31T12:34:56.789Z")
+    assert timestamp == 1706704496
+    assert format_server_time(timestamp) == "2024-01-31T12:34:56.000Z"
+    assert parse_server_time("yesterday") is None
+    assert parse_server_time(None) is None
+
+def test_sasl_plain_payload():
+    payload = get_sasl_plain_payload("user", "secret")
+    assert base64.b64decode(get_authenticate_chunks(payload)[0]) == b"user\0user\0secret"
+
+def test_authenticate_chunks():
+    assert get_authenticate_chunks(b"") == ["+"]
+    assert len(get_authenticate_chunks(b"x" * 100)) == 1
+    # 300 bytes are exactly 400 characters of base64, the response ends with "+"
+    chunks = get_authenticate_chunks(b"x" * 300)
+    assert [len(chunk) for chunk in chunks] == [400, 1]
+    chunks = get_authenticate_chunks(b"x" * 400)
+    assert [len(chunk) for chunk in chunks] == [400, 136]
+
+def test_ls_over_several_lines():
+    caps = CapNegotiation()
+    assert caps.on_ls(["LS", "*", "sasl=PLAIN,EXTERNAL multi-prefix"]) is None
+    wanted = caps.on_ls(["LS", "server-time unknown-cap"])
+    assert wanted == ["sasl", "server-time", "multi-prefix"]
+    assert caps.get_sasl_mechanisms() == ["PLAIN", "EXTERNAL"]
+
+def test_ack_nak_and_del():
+    caps = CapNegotiation()
+    caps.on_ls(["LS", "sasl batch server-time"])
+    assert caps.on_ack("batch server-time") == ["batch", "server-time"]
+    caps.on_nak("sasl")
+    assert caps.is_enabled("batch")
+    assert not caps.is_enabled("sasl")
+    assert caps.requested == set()
+    # Not requested again once enabled
+    assert caps.on_ls(["NEW", "batch away-notify"]) == ["away-notify"]
+    caps.on_del("batch")
+    assert not caps.is_enabled("batch")
+    caps.on_ack("-server-time")
+    assert not caps.is_enabled("server-time")
+
+def test_sasl_without_mechanisms():
+    caps = CapNegotiation()
+    caps.on_ls(["LS", "sasl"])
+    assert caps.get_sasl_mechanisms() is None
+
+def test_reset():
+    caps = CapNegotiation()
+    caps.on_ls(["LS", "batch"])
+    caps.on_ack("batch")
+    caps.negotiating = False
+    caps.reset()
+    assert caps.negotiating
+    assert not caps.is_enabled("batch")
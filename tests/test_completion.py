@@ -0,0 +1,85 @@
+from completion import NickCompleter, TabCompletion
+from membership import Membership
+
+def make_completer(*nicks):
+    users = Membership()
+    for nick in nicks:
+        users.add(nick)
+    return (users, NickCompleter(users))
+
+def test_prefix_is_case_insensitive():
+    users, completer = make_completer("Alice", "alfred", "Bob", "[al]")
+    assert completer.get_candidates("AL") == ["alfred", "Alice"]
+    assert completer.get_candidates("{") == ["[al]"]
+    assert completer.get_candidates("c") == []
+
+def test_recent_speakers_first():
+    users, completer = make_completer("anna", "alice", "alfred")
+    completer.on_message("anna")
+    completer.on_message("alfred")
+    completer.on_message("nobody")
+    assert completer.get_candidates("a") == ["alfred", "anna", "alice"]
+    completer.on_message("ANNA")
+    assert completer.get_candidates("a") == ["anna", "alfred", "alice"]
+
+def test_own_nick_is_excluded():
+    users, completer = make_completer("me", "mel")
+    assert completer.get_candidates("m", "Me") == ["mel"]
+
+def test_follows_the_membership():
+    users, completer = make_completer("alice", "bob")
+    completer.on_message("alice")
+    users.add("albert")
+    users.remove("bob")
+    assert completer.get_candidates("") == ["alice", "albert"]
+    users.rename("alice", "Zoe")
+    assert completer.get_candidates("a") == ["albert"]
+    assert completer.get_candidates("z") == ["Zoe"]
+    assert completer.last_spoke == {"zoe": 1}
+    users.clear()
+    assert completer.get_candidates("") == []
+    assert completer.last_spoke == {}
+
+def test_rename_over_another_member():
+    users, completer = make_completer("alice", "bob")
+    completer.on_message("bob")
+    users.rename("alice", "Bob")
+    assert completer.keys == ["bob"]
+    assert completer.get_candidates("b") == ["Bob"]
+    # The spoken order belonged to the displaced member
+    assert completer.last_spoke == {}
+
+def test_casemapping_change():
+    users, completer = make_completer("[x]", "{y}")
+    users.set_casemapping("ascii")
+    assert completer.get_candidates("[") == ["[x]"]
+    assert completer.get_candidates("{") == ["{y}"]
+
+def test_address_at_the_beginning_of_the_line():
+    users, completer = make_completer("alice")
+    assert TabCompletion().complete(completer, "al", 2, "me") == ("alice: ", 7)
+
+def test_complete_in_the_middle_of_the_line():
+    users, completer = make_completer("alice")
+    tab = TabCompletion()
+    assert tab.complete(completer, "hi al", 5, "me") == ("hi alice ", 9)
+    assert tab.complete(completer, "hi al there", 5, "me") == ("hi alice there", 8)
+
+def test_tab_again_cycles():
+    users, completer = make_completer("alice", "alfred", "bob")
+    tab = TabCompletion()
+    text, position = tab.complete(completer, "al", 2, "me")
+    assert text == "alfred: "
+    text, position = tab.complete(completer, text, position, "me")
+    assert (text, position) == ("alice: ", 7)
+    text, position = tab.complete(completer, text, position, "me")
+    assert text == "alfred: "
+    # Typing something starts a new completion
+    assert tab.complete(completer, "alfred: b", 9, "me") == ("alfred: bob ", 12)
+
+def test_no_candidates():
+    users, completer = make_completer("alice")
+    tab = TabCompletion()
+    assert tab.complete(completer, "zz", 2, "me") is None
+    assert tab.complete(completer, "hi ", 3, "me") is None
+    assert tab.complete(completer, "me", 2, "me") is None
@@ -0,0 +1,47 @@
+from highlight import Highlighter
+
+def test_nickname():
+    highlighter = Highlighter("nick")
+    assert highlighter.matches("nick: hello")
+    assert highlighter.matches("hello @Nick!")
+    assert highlighter.matches("NICK")
+    assert not highlighter.matches("nicky: hello")
+    assert not highlighter.matches("hello mynick")
+
+def test_words():
+    highlighter = Highlighter("nick", [" mint ", "kernel panic"])
+    assert highlighter.matches("Mint is great")
+    assert highlighter.matches("a kernel panic, again")
+    assert not highlighter.matches("peppermint")
+    highlighter.set_words([])
+    assert not highlighter.matches("Mint is great")
+
+def test_no_words():
+    highlighter = Highlighter("")
+    assert not highlighter.matches("anything")
+
+def test_default_words_are_not_shared():
+    first = Highlighter("first")
+    second = Highlighter("second")
+    assert not first.matches("second")
+    assert not second.matches("first")
+
+def test_set_nickname():
+    highlighter = Highlighter("old")
+    highlighter.set_nickname("new")
+    assert highlighter.matches("new: hi")
+    assert not highlighter.matches("old: hi")
+
+def test_special_characters():
+    highlighter = Highlighter("n[i]ck|")
+    assert highlighter.matches("hi n[i]ck|")
+    assert not highlighter.matches("hi n[i]ck|x")
+
+def test_casemapping():
+    highlighter = Highlighter("nick[away]")
+    assert highlighter.matches("NICK{AWAY}: hi")
+    highlighter.set_casemapping("ascii")
+    assert not highlighter.matches("nick{away}: hi")
+    highlighter.set_casemapping("strict-rfc1459")
+    assert highlighter.matches("nick{away}: hi")
+    assert not Highlighter("nick~", casemapping="strict-rfc1459").matches("nick^ hi")
@@ -0,0 +1,126 @@
+import sqlite3
+import time
+import pytest
+
+gi = pytest.importorskip("gi")
+try:
+    gi.require_version("Gtk", "3.0")
+except ValueError:
+    pytest.skip("GTK 3 is needed", allow_module_level=True)
+
+from gi.repository import GLib
+import linkpreview
+from linkpreview import CACHE_TTL, MAX_PER_HOST, MAX_READ_SIZE, LinkPreviewer, PreviewCache, parse_metadata
+
+PAGE = b"""<html><head><title>Ignored</title>
+<meta property="og:title" content="The title">
+<meta property="og:image" content="/image.png">
+<meta name="description" content="A description">
+</head><body><meta property="og:site_name" content="Too late"></body></html>"""
+
+@pytest.fixture
+def previewer(tmp_path, monkeypatch):
+    monkeypatch.setattr(linkpreview, "get_cache_path", lambda: str(tmp_path / "previews.db"))
+    previewer = LinkPreviewer()
+    yield previewer
+    previewer.shutdown()
+
+# Runs the main loop until condition() is true, the previews are delivered from there
+def wait_for(condition, timeout=10):
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        context.iteration(False)
+        time.sleep(0.01)
+
+def test_parse_metadata():
+    metadata = parse_metadata(PAGE.decode(), "http://example.com/page")
+    assert metadata == {"title": "The title", "image": "http://example.com/image.png", "description": "A description"}
+
+def test_parse_metadata_falls_back_to_the_title():
+    assert parse_metadata("<title>\n  A   page </title>", "http://example.com/") == {"title": "A page"}
+    assert parse_metadata("<p>no head</p>", "http://example.com/") == {}
+
+def test_request(http_server, previewer):
+    http_server.add_route("/page", PAGE, {"Content-Type": "text/html; charset=utf-8"})
+    url = http_server.get_url("/page")
+    previews = []
+    previewer.request(url, previews.append)
+    previewer.request(url, previews.append)
+    wait_for(lambda: len(previews) == 2)
+    assert previews[0]["title"] == "The title"
+    # Fetched once for both, then known
+    previewer.request(url, previews.append)
+    assert len(previews) == 3
+    assert http_server.hits["/page"] == 1
+
+def test_pages_without_metadata(http_server, previewer):
+    http_server.add_route("/empty", b"<html><body>nothing</body></html>", {"Content-Type": "text/html"})
+    http_server.add_route("/image", b"GIF89a", {"Content-Type": "image/gif"})
+    previews = []
+    for path in ("/empty", "/image"):
+        previewer.request(http_server.get_url(path), previews.append)
+    wait_for(lambda: len(previewer.previews) == 2)
+    assert previews == []
+
+def test_only_the_beginning_is_read(http_server, previewer):
+    page = b"<html><head>" + b" " * MAX_READ_SIZE + b"<title>Too far</title></head></html>"
+    http_server.add_route("/long", page, {"Content-Type": "text/html"})
+    url = http_server.get_url("/long")
+    previewer.request(url, lambda preview: None)
+    wait_for(lambda: url in previewer.previews)
+    assert previewer.previews[url] == {}
+
+def test_requests_per_host_are_limited(http_server, previewer):
+    urls = []
+    for index in range(6):
+        http_server.add_route(f"/{index}", PAGE, {"Content-Type": "text/html"}, delay=0.2)
+        urls.append(http_server.get_url(f"/{index}"))
+    previews = []
+    for url in urls:
+        previewer.request(url, previews.append)
+    wait_for(lambda: len(previews) == len(urls))
+    assert http_server.peak == MAX_PER_HOST
+    assert previewer.host_fetches == {}
+    assert previewer.host_queues == {}
+
+def test_previews_in_memory_are_bounded(previewer, monkeypatch):
+    monkeypatch.setattr(linkpreview, "MAX_PREVIEWS", 2)
+    for url in ("a", "b"):
+        previewer.on_loaded(url, {"title": url})
+    # "a" is used again, so "b" is the least recently used one
+    previewer.request("a", lambda preview: None)
+    previewer.on_loaded("c", {"title": "c"})
+    assert list(previewer.previews) == ["a", "c"]
+
+def set_age(path, url, age):
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("UPDATE previews SET time = ? WHERE url = ?", (int(time.time()) - age, url))
+    connection.close()
+
+def test_cache_ttl(tmp_path):
+    path = str(tmp_path / "previews.db")
+    cache = PreviewCache(path)
+    cache.put("full", {"title": "A title"})
+    cache.put("empty", {})
+    assert cache.get("full") == {"title": "A title"}
+    assert cache.get("empty") == {}
+    assert cache.get("unknown") is None
+    # Pages without metadata are retried after an hour, the others after CACHE_TTL
+    set_age(path, "full", 2 * 3600)
+    set_age(path, "empty", 2 * 3600)
+    assert cache.get("full") == {"title": "A title"}
+    assert cache.get("empty") is None
+    set_age(path, "full", CACHE_TTL + 1)
+    assert cache.get("full") is None
+
+def test_cache_forgets_expired_previews(tmp_path):
+    path = str(tmp_path / "previews.db")
+    PreviewCache(path).put("old", {"title": "Old"})
+    set_age(path, "old", CACHE_TTL + 1)
+    PreviewCache(path).get("old")
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT COUNT(*) FROM previews").fetchone()[0] == 0
+    connection.close()
@@ -0,0 +1,83 @@
+from membership import Membership, irc_lower, split_prefixes
+
+def record(users):
+    events = []
+    users.connect(lambda event, member, old_nick: events.append((event, member.nick if member else None, old_nick)))
+    return events
+
+def test_irc_lower():
+    assert irc_lower("Nick[]\\~") == "nick{}|^"
+    assert irc_lower("Nick[]\\~", "strict-rfc1459") == "nick{}|~"
+    assert irc_lower("Nick[]", "ascii") == "nick[]"
+
+def test_split_prefixes():
+    assert split_prefixes("@+nick") == ("@+", "nick")
+    assert split_prefixes("nick") == ("", "nick")
+
+def test_add_prefixed():
+    users = Membership()
+    member = users.add_prefixed("@+Nick")
+    assert member.nick == "Nick"
+    assert member.get_prefix() == "@"
+    assert "nick" in users
+
+def test_add_is_case_insensitive():
+    users = Membership()
+    events = record(users)
+    users.add("Nick")
+    users.add("NICK")
+    assert len(users) == 1
+    assert events == [("add", "Nick", None)]
+
+def test_remove():
+    users = Membership()
+    users.add("nick")
+    events = record(users)
+    assert users.remove("NICK").nick == "nick"
+    assert users.remove("nick") is None
+    assert len(users) == 0
+    assert events == [("remove", "nick", None)]
+
+def test_rename():
+    users = Membership()
+    users.add("old", "+")
+    events = record(users)
+    users.rename("old", "new")
+    assert "old" not in users
+    assert users.get("new").modes == "+"
+    assert events == [("rename", "new", "old")]
+
+def test_rename_changing_case():
+    users = Membership()
+    users.add("nick")
+    events = record(users)
+    users.rename("nick", "Nick")
+    assert len(users) == 1
+    assert events == [("rename", "Nick", "nick")]
+
+def test_rename_over_another_member():
+    users = Membership()
+    users.add("old")
+    users.add("taken", "@")
+    events = record(users)
+    users.rename("old", "Taken")
+    assert len(users) == 1
+    assert users.get("taken").modes == ""
+    assert events == [("remove", "taken", None), ("rename", "Taken", "old")]
+
+def test_set_mode():
+    users = Membership()
+    users.add("nick")
+    users.set_mode("nick", "+", True)
+    users.set_mode("nick", "@", True)
+    assert users.get("nick").modes == "@+"
+    users.set_mode("nick", "@", False)
+    assert users.get("nick").get_prefix() == "+"
+
+def test_set_casemapping():
+    users = Membership("ascii")
+    users.add("nick[a]")
+    events = record(users)
+    users.set_casemapping("rfc1459")
+    assert "NICK{A}" in users
+    assert events == [("clear", None, None), ("add", "nick[a]", None)]
@@ -0,0 +1,106 @@
+import time
+import types
+import pytest
+
+pytest.importorskip("gi")
+from gi.repository import GLib
+import notifications
+from notifications import MAX_QUOTED_MENTIONS, NotificationManager, get_quiet_time_left, is_quiet_time, \
+    parse_quiet_hours
+
+# A local timestamp, on a day without a DST change
+def at(hours, minutes, seconds=0):
+    return time.mktime((2026, 1, 15, hours, minutes, seconds, 0, 0, -1))
+
+@pytest.fixture
+def manager():
+    settings = types.SimpleNamespace(notification_delay=60000, quiet_hours="")
+    manager = NotificationManager(settings, lambda: None)
+    manager.shown_summaries = []
+    manager.show = lambda: manager.shown_summaries.append(manager.get_summary())
+    yield manager
+    manager.clear()
+
+def set_time(monkeypatch, timestamp):
+    monkeypatch.setattr(notifications, "time", types.SimpleNamespace(time=lambda: timestamp, localtime=time.localtime))
+
+# What the main loop does when the timeout is due
+def fire(manager):
+    GLib.source_remove(manager.source_id)
+    manager.on_timeout()
+
+def test_parse_quiet_hours():
+    assert parse_quiet_hours("22:00-07:30") == (22 * 60, 7 * 60 + 30)
+    assert parse_quiet_hours(" 9:05 - 17:00 ") == (9 * 60 + 5, 17 * 60)
+    for value in ("", "22:00", "24:00-07:00", "22:60-07:00", "10pm-7am"):
+        assert parse_quiet_hours(value) is None
+
+def test_quiet_hours_over_midnight():
+    quiet_hours = parse_quiet_hours("22:00-07:00")
+    for hours, minutes in ((22, 0), (23, 59), (0, 0), (3, 0), (6, 59)):
+        assert is_quiet_time(quiet_hours, at(hours, minutes))
+    for hours, minutes in ((7, 0), (12, 0), (21, 59)):
+        assert not is_quiet_time(quiet_hours, at(hours, minutes))
+
+def test_quiet_hours_within_a_day():
+    quiet_hours = parse_quiet_hours("09:00-17:00")
+    assert is_quiet_time(quiet_hours, at(9, 0))
+    assert is_quiet_time(quiet_hours, at(16, 59))
+    assert not is_quiet_time(quiet_hours, at(17, 0))
+    assert not is_quiet_time(quiet_hours, at(8, 59))
+    assert not is_quiet_time(None, at(12, 0))
+
+def test_quiet_time_left():
+    quiet_hours = parse_quiet_hours("22:00-07:30")
+    assert get_quiet_time_left(quiet_hours, at(23, 30)) == 8 * 3600
+    assert get_quiet_time_left(quiet_hours, at(7, 29, 30)) == 30
+    assert get_quiet_time_left(quiet_hours, at(1, 0, 15)) == 6.5 * 3600 - 15
+
+def test_single_mention(manager):
+    manager.add_mention("alice", "hi <b>you</b>")
+    assert manager.get_summary() == ("Message from alice", "hi <b>you</b>")
+
+def test_mentions_are_aggregated(manager):
+    manager.add_mention("alice", "one")
+    manager.add_mention("bob", "two")
+    manager.add_mention("alice", "three")
+    title, body = manager.get_summary()
+    assert title == "3 mentions from 2 users"
+    assert body.splitlines() == ["<b>alice</b>: one", "<b>bob</b>: two", "<b>alice</b>: three"]
+    manager.clear()
+    manager.add_mention("bob", "four")
+    manager.add_mention("bob", "<five>")
+    assert manager.get_summary()[0] == "2 mentions from bob"
+
+def test_held_mentions_are_bounded(manager):
+    for index in range(1000):
+        manager.add_mention(f"user{index % 10}", str(index))
+    title, body = manager.get_summary()
+    assert title == "1000 mentions from 10 users"
+    assert len(body.splitlines()) == MAX_QUOTED_MENTIONS
+    assert len(manager.recent_mentions) == MAX_QUOTED_MENTIONS
+
+def test_one_timeout_for_a_burst(manager):
+    manager.add_mention("alice", "one")
+    source_id = manager.source_id
+    manager.add_mention("bob", "two")
+    assert manager.source_id == source_id
+    fire(manager)
+    assert manager.shown_summaries == [("2 mentions from 2 users", "<b>alice</b>: one\n<b>bob</b>: two")]
+    assert manager.source_id is None
+
+def test_flushed_when_the_quiet_hours_end(manager, monkeypatch):
+    manager.settings.quiet_hours = "22:00-07:30"
+    set_time(monkeypatch, at(23, 30))
+    manager.add_mention("alice", "one")
+    fire(manager)
+    assert manager.shown_summaries == []
+    # Rescheduled for the end of the quiet hours (timeout_add_seconds() may be up to a second late)
+    source = GLib.MainContext.default().find_source_by_id(manager.source_id)
+    delay = (source.get_ready_time() - GLib.get_monotonic_time()) / 1000000
+    assert 8 * 3600 - 2 < delay < 8 * 3600 + 2
+    manager.add_mention("bob", "two")
+    set_time(monkeypatch, at(7, 30))
+    fire(manager)
+    assert manager.shown_summaries == [("2 mentions from 2 users", "<b>alice</b>: one\n<b>bob</b>: two")]
+    assert manager.source_id is None
@@ -0,0 +1,73 @@
+import types
+from scrollback import Scrollback
+
+def make_messages(count):
+    return [types.SimpleNamespace(seq=None, text=str(index)) for index in range(count)]
+
+def texts(messages):
+    return [message.text for message in messages]
+
+def test_keeps_the_last_messages_up_to_the_limit():
+    scrollback = Scrollback(3)
+    for message in make_messages(5):
+        scrollback.append(message)
+    assert len(scrollback) == 3
+    assert texts(scrollback) == ["2", "3", "4"]
+    assert scrollback.get_first_seq() == 2
+    assert scrollback.get_last().seq == 4
+
+def test_seqs_are_contiguous():
+    scrollback = Scrollback(10)
+    messages = make_messages(4)
+    for message in messages:
+        scrollback.append(message)
+    assert [message.seq for message in messages] == [0, 1, 2, 3]
+
+def test_get_after():
+    scrollback = Scrollback(10)
+    for message in make_messages(5):
+        scrollback.append(message)
+    assert texts(scrollback.get_after(2)) == ["3", "4"]
+    assert scrollback.get_after(4) == []
+    # Older than what's kept, everything is returned
+    assert texts(scrollback.get_after(-10)) == ["0", "1", "2", "3", "4"]
+
+def test_get_before():
+    scrollback = Scrollback(10)
+    for message in make_messages(5):
+        scrollback.append(message)
+    assert texts(scrollback.get_before(4, 2)) == ["2", "3"]
+    assert texts(scrollback.get_before(2, 10)) == ["0", "1"]
+    assert scrollback.get_before(0, 10) == []
+
+def test_get_before_after_eviction():
+    scrollback = Scrollback(3)
+    for message in make_messages(6):
+        scrollback.append(message)
+    assert texts(scrollback.get_before(5, 10)) == ["3", "4"]
+    assert scrollback.get_before(3, 10) == []
+
+def test_prepend_fills_the_room_left():
+    scrollback = Scrollback(4)
+    for message in make_messages(2):
+        scrollback.append(message)
+    older = [types.SimpleNamespace(seq=None, text=text) for text in ("a", "b", "c")]
+    scrollback.prepend(older, scrollback.get_first_seq())
+    assert [message.seq for message in older] == [-3, -2, -1]
+    # Only the most recent of them fit
+    assert texts(scrollback) == ["b", "c", "0", "1"]
+
+def test_prepend_only_next_to_the_first_message():
+    scrollback = Scrollback(10)
+    for message in make_messages(2):
+        scrollback.append(message)
+    scrollback.prepend(make_messages(2), -5)
+    assert len(scrollback) == 2
+
+def test_set_limit():
+    scrollback = Scrollback(5)
+    for message in make_messages(5):
+        scrollback.append(message)
+    scrollback.set_limit(2)
+    assert texts(scrollback) == ["3", "4"]
+    assert scrollback.get_first_seq() == 3
@@ -0,0 +1,83 @@
+import os
+import pytest
+
+gi = pytest.importorskip("gi")
+try:
+    gi.require_version("Gtk", "3.0")
+    gi.require_version("GdkPixbuf", "2.0")
+except ValueError:
+    pytest.skip("GTK 3 and GdkPixbuf are needed", allow_module_level=True)
+
+from gi.repository import GdkPixbuf
+import thumbnails
+from thumbnails import THUMBNAIL_SIZE, ThumbnailCache, ThumbnailError, ThumbnailProvider
+
+@pytest.fixture
+def provider():
+    provider = ThumbnailProvider()
+    yield provider
+    provider.shutdown()
+
+def get_png(width, height):
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, width, height)
+    pixbuf.fill(0xff0000ff)
+    success, buffer = pixbuf.save_to_bufferv("png", [], [])
+    return bytes(buffer)
+
+def test_fetch(http_server, provider):
+    data = get_png(10, 10)
+    http_server.add_route("/image.png", data, {"Content-Type": "image/png", "Content-Length": str(len(data))})
+    assert provider.fetch(http_server.get_url("/image.png")) == data
+
+def test_fetch_refuses_what_isnt_an_image(http_server, provider):
+    http_server.add_route("/page", b"<html></html>", {"Content-Type": "text/html"})
+    with pytest.raises(ThumbnailError):
+        provider.fetch(http_server.get_url("/page"))
+
+def test_fetch_refuses_a_big_content_length(http_server, provider):
+    size = thumbnails.MAX_IMAGE_SIZE + 1
+    http_server.add_route("/big.png", b"", {"Content-Type": "image/png", "Content-Length": str(size)})
+    with pytest.raises(ThumbnailError, match="too big"):
+        provider.fetch(http_server.get_url("/big.png"))
+
+def test_fetch_stops_reading_at_the_maximum_size(http_server, provider):
+    # Without a Content-Length, the download itself is cut
+    http_server.add_route("/big.png", b"x" * (thumbnails.MAX_IMAGE_SIZE + 1024), {"Content-Type": "image/png"})
+    with pytest.raises(ThumbnailError, match="too big"):
+        provider.fetch(http_server.get_url("/big.png"))
+
+def test_create_thumbnail_downscales(provider):
+    data, content_type = provider.create_thumbnail(get_png(2000, 1000))
+    assert content_type == "image/jpeg"
+    loader = GdkPixbuf.PixbufLoader()
+    loader.write(data)
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    assert (pixbuf.get_width(), pixbuf.get_height()) == (THUMBNAIL_SIZE, THUMBNAIL_SIZE // 2)
+
+def test_create_thumbnail_refuses_garbage(provider):
+    with pytest.raises(ThumbnailError):
+        provider.create_thumbnail(b"not an image")
+
+def test_cache_get_and_put(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 1000)
+    assert cache.get("http://example.com/a.png") is None
+    cache.put("http://example.com/a.png", b"png data", "image/png")
+    assert cache.get("http://example.com/a.png") == (b"png data", "image/png")
+
+def test_cache_trims_the_least_recently_used(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 1000)
+    urls = [f"http://example.com/{index}.jpg" for index in range(3)]
+    for age, url in zip((300, 200, 100), urls):
+        cache.put(url, b"x" * 300, "image/jpeg")
+        path = cache.get_path(url) + ".jpg"
+        os.utime(path, (os.path.getmtime(path) - age,) * 2)
+    # Reading the oldest one makes it the most recently used
+    assert cache.get(urls[0]) is not None
+    cache.put("http://example.com/new.jpg", b"x" * 300, "image/jpeg")
+    # Over 1000 bytes, trimmed down to 900: the least recently used one goes
+    assert cache.get(urls[1]) is None
+    assert cache.get(urls[0]) is not None
+    assert cache.get(urls[2]) is not None
+    assert cache.get("http://example.com/new.jpg") is not None
+    assert cache.total_size <= 900
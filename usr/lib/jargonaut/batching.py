@@ -0,0 +1,25 @@
+import queue
+import time
+
+# Yields what's put in source, in lists: the first item, then whatever comes within interval
+# seconds after it. Putting None stops it, once the items put before it are yielded.
+def drain_batch(source, interval):
+    while True:
+        items = [source.get()]
+        deadline = time.monotonic() + interval
+        while items[-1] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(source.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        closing = items[-1] is None
+        if closing:
+            items.pop()
+        if len(items) > 0:
+            yield items
+        if closing:
+            return
@@ -0,0 +1,236 @@
+import ast
+import os
+import random
+import re
+import resource
+import time
+from gi.repository import GLib
+
+# Lines are fed every FEED_INTERVAL ms, all those which are due at once
+FEED_INTERVAL = 1
+# The main loop counts as stalled when a heartbeat is late by more than STALL_THRESHOLD ms
+HEARTBEAT_INTERVAL = 10
+STALL_THRESHOLD = 50
+# Once everything is fed, how long to wait (in ms) for the last lines to be painted
+DRAIN_TIMEOUT = 10000
+
+SERVER_NAME = "irc.benchmark"
+WORDS = ("the", "build", "is", "broken", "again", "on", "my", "machine", "which", "kernel", "are", "you", "running",
+         "did", "that", "fix", "it", "thanks", "\x02bold\x02", "\x0304red\x03", "https://example.com/page",
+         "works", "for", "me", "now", "reboot", "update", "please", "log", "file")
+
+# Lines of the RawLogger output (i.e. "12:34:56.789 irc.libera.chat < 'line'")
+RECORDED_LINE = re.compile(r"^(\d\d):(\d\d):(\d\d)\.(\d{3}) \S+ < (.*)$")
+
+def get_user(index):
+    nick = f"user{index}"
+    return f"{nick}!{nick}@host{index % 97}.example.com"
+
+def get_names_lines(nick, channel, count):
+    lines = []
+    names = []
+    for index in range(count):
+        prefix = "@" if index % 50 == 0 else "+" if index % 20 == 0 else ""
+        names.append(f"{prefix}user{index}")
+        if len(names) == 40:
+            lines.append(f":{SERVER_NAME} 353 {nick} = {channel} :{' '.join(names)}")
+            names = []
+    if len(names) > 0:
+        lines.append(f":{SERVER_NAME} 353 {nick} = {channel} :{' '.join(names)}")
+    lines.append(f":{SERVER_NAME} 366 {nick} {channel} :End of /NAMES list.")
+    return lines
+
+# Each scenario returns a list of (time in ms, line), sorted by time
+
+def get_names_scenario(nick, channel):
+    lines = [f":{nick}!{nick}@localhost JOIN {channel}"] + get_names_lines(nick, channel, 5000)
+    return [(0, line) for line in lines]
+
+def get_netsplit_scenario(nick, channel):
+    timeline = [(0, f":{nick}!{nick}@localhost JOIN {channel}")]
+    timeline += [(0, line) for line in get_names_lines(nick, channel, 3000)]
+    # Half the channel splits off within 50 ms, then comes back within 100 ms
+    split = range(1500, 3000)
+    for position, index in enumerate(split):
+        timeline.append((1000 + position * 50 // len(split), f":{get_user(index)} QUIT :*.net *.split"))
+    for position, index in enumerate(split):
+        timeline.append((4000 + position * 100 // len(split), f":{get_user(index)} JOIN {channel}"))
+    return timeline
+
+def get_flood_scenario(nick, channel):
+    generator = random.Random(0)
+    timeline = [(0, f":{nick}!{nick}@localhost JOIN {channel}")]
+    timeline += [(0, line) for line in get_names_lines(nick, channel, 200)]
+    # One message per millisecond, for 10 seconds
+    for index in range(10000):
+        text = " ".join(generator.choice(WORDS) for _ in range(generator.randint(3, 15)))
+        if index % 100 == 0:
+            text = f"{nick}: {text}"
+        timeline.append((500 + index, f":{get_user(generator.randrange(200))} PRIVMSG {channel} :{text}"))
+    return timeline
+
+SCENARIOS = {
+    "names": get_names_scenario,
+    "netsplit": get_netsplit_scenario,
+    "flood": get_flood_scenario,
+}
+
+# Reads a transcript: either the output of the debug mode, replayed with its timing,
+# or raw IRC lines, replayed at one line per millisecond
+def get_recorded_scenario(path):
+    timeline = []
+    start = None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for index, line in enumerate(f):
+            line = line.rstrip("\r\n")
+            if line == "":
+                continue
+            match = RECORDED_LINE.match(line)
+            if match is None:
+                timeline.append((index, line))
+                continue
+            hours, minutes, seconds, milliseconds = (int(value) for value in match.groups()[:4])
+            timestamp = ((hours * 60 + minutes) * 60 + seconds) * 1000 + milliseconds
+            if start is None:
+                start = timestamp
+            try:
+                raw_line = ast.literal_eval(match.group(5))
+            except (ValueError, SyntaxError):
+                continue
+            timeline.append((max(0, timestamp - start), raw_line))
+    timeline.sort(key=lambda item: item[0])
+    return timeline
+
+def is_valid_scenario(name):
+    return name in SCENARIOS or os.path.isfile(name)
+
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak rather than current, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Nearest-rank percentile of a sorted list
+def get_percentile(values, percentile):
+    if len(values) == 0:
+        return 0
+    index = max(0, min(len(values) - 1, int(round(percentile / 100 * len(values))) - 1))
+    return values[index]
+
+def format_size(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+# Feeds a scenario to the IRC handlers, as if it came from the server of the current
+# channel, and measures how long the lines take to be painted. A line is painted when
+# the animation frame following the first render flush after it has run in the webview.
+class Benchmark():
+    def __init__(self, app, name):
+        self.app = app
+        self.name = name
+        self.started = False
+
+    def start(self):
+        self.started = True
+        channel = self.app.current
+        self.server = channel.server
+        self.server.connection.real_nickname = self.server.nickname
+        self.server.connection.real_server_name = SERVER_NAME
+        if self.name in SCENARIOS:
+            self.timeline = SCENARIOS[self.name](self.server.nickname, channel.name)
+        else:
+            self.timeline = get_recorded_scenario(self.name)
+        self.position = 0
+
+        # Ingest times of the lines which aren't painted yet, and of those waiting for a frame
+        self.waiting = []
+        self.frames = {}
+        self.frame_id = 0
+        self.latencies = []
+        self.last_paint_time = None
+        self.n_stalls = 0
+        self.stall_time = 0
+        self.longest_stall = 0
+
+        content_manager = self.app.webview.get_user_content_manager()
+        content_manager.register_script_message_handler("benchmark")
+        content_manager.connect("script-message-received::benchmark", self.on_frame_painted)
+
+        self.start_rss = get_rss()
+        self.start_time = time.monotonic()
+        self.fed_time = None
+        self.last_heartbeat = self.start_time
+        self.heartbeat_source = GLib.timeout_add(HEARTBEAT_INTERVAL, self.on_heartbeat)
+        GLib.timeout_add(FEED_INTERVAL, self.on_feed)
+
+    def on_feed(self):
+        elapsed = (time.monotonic() - self.start_time) * 1000
+        connection = self.server.connection
+        while self.position < len(self.timeline) and self.timeline[self.position][0] <= elapsed:
+            self.waiting.append(time.monotonic())
+            connection._process_line(self.timeline[self.position][1])
+            self.position += 1
+        if self.position < len(self.timeline):
+            return True
+        self.fed_time = time.monotonic()
+        GLib.timeout_add(100, self.on_drain_check)
+        return False
+
+    def on_heartbeat(self):
+        now = time.monotonic()
+        late = (now - self.last_heartbeat) * 1000 - HEARTBEAT_INTERVAL
+        self.last_heartbeat = now
+        if late > STALL_THRESHOLD:
+            self.n_stalls += 1
+            self.stall_time += late
+            self.longest_stall = max(self.longest_stall, late)
+        return True
+
+    # Called once each render flush reached the webview
+    def on_render_flushed(self):
+        if not self.started or len(self.waiting) == 0:
+            return
+        self.frame_id += 1
+        self.frames[self.frame_id] = self.waiting
+        self.waiting = []
+        self.app.run_javascript("requestAnimationFrame(() => "
+                                f"window.webkit.messageHandlers.benchmark.postMessage({self.frame_id}));")
+
+    def on_frame_painted(self, manager, result):
+        value = result.get_js_value() if hasattr(result, "get_js_value") else result
+        now = time.monotonic()
+        for ingest_time in self.frames.pop(value.to_int32(), []):
+            self.latencies.append((now - ingest_time) * 1000)
+        self.last_paint_time = now
+
+    def on_drain_check(self):
+        if len(self.waiting) > 0 and len(self.frames) == 0 and self.app.render_scheduler.source_id is None:
+            # These lines didn't cause any rendering, time them up to the next frame
+            self.on_render_flushed()
+        drained = len(self.waiting) == 0 and len(self.frames) == 0
+        if not drained and (time.monotonic() - self.fed_time) * 1000 < DRAIN_TIMEOUT:
+            return True
+        GLib.source_remove(self.heartbeat_source)
+        self.report()
+        self.app.quit()
+        return False
+
+    def report(self):
+        end_time = self.last_paint_time or time.monotonic()
+        duration = max(end_time - self.start_time, 0.001)
+        n_lines = len(self.timeline)
+        latencies = sorted(self.latencies)
+        n_unpainted = len(self.waiting) + sum(len(frame) for frame in self.frames.values())
+        end_rss = get_rss()
+        scheduler = self.app.render_scheduler
+        print(f"Benchmark: {self.name}")
+        print(f"  Lines: {n_lines} in {duration:.2f} s ({n_lines / duration:.0f} lines/s)")
+        print(f"  Ingest to paint: p50 {get_percentile(latencies, 50):.1f} ms, p99 {get_percentile(latencies, 99):.1f} ms, "
+              f"max {get_percentile(latencies, 100):.1f} ms")
+        if n_unpainted > 0:
+            print(f"  Never painted: {n_unpainted} lines (is the window visible?)")
+        print(f"  Main loop stalls over {STALL_THRESHOLD} ms: {self.n_stalls}, {self.stall_time:.0f} ms in total, "
+              f"longest {self.longest_stall:.0f} ms")
+        print(f"  RSS: {format_size(self.start_rss)} -> {format_size(end_rss)} ({format_size(end_rss - self.start_rss)} growth)")
+        print(f"  Render flushes: {scheduler.n_flushes} for {scheduler.n_requests} requests")
@@ -0,0 +1,117 @@
+import base64
+import calendar
+import time
+
+# IRCv3 capabilities requested when the server offers them
+WANTED_CAPABILITIES = ("sasl", "server-time", "batch", "multi-prefix", "away-notify", "draft/chathistory")
+
+# AUTHENTICATE payloads are split in chunks of this size
+SASL_CHUNK_SIZE = 400
+
+# Maximum number of missed messages fetched per channel after a reconnection
+HISTORY_LIMIT = 100
+# How long to wait for them (in seconds) before giving up
+HISTORY_TIMEOUT = 10
+
+# Returns the value of a message tag (i.e. "time"), or None
+def get_tag(event, key):
+    for tag in getattr(event, "tags", None) or []:
+        if tag["key"] == key:
+            return tag["value"]
+    return None
+
+# Parses a server-time tag (i.e. "2024-01-31T12:34:56.789Z") into a timestamp
+def parse_server_time(value):
+    if value is None:
+        return None
+    try:
+        return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+def format_server_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(timestamp))
+
+def get_sasl_plain_payload(username, password):
+    return f"{username}\0{username}\0{password}".encode("utf-8")
+
+# Returns the arguments of the AUTHENTICATE commands carrying a SASL response
+def get_authenticate_chunks(payload):
+    encoded = base64.b64encode(payload).decode("ascii")
+    chunks = [encoded[index:index + SASL_CHUNK_SIZE] for index in range(0, len(encoded), SASL_CHUNK_SIZE)]
+    if len(encoded) % SASL_CHUNK_SIZE == 0:
+        # An empty response, or one ending on a full chunk, is terminated by "+"
+        chunks.append("+")
+    return chunks
+
+# Messages tagged with a batch reference, collected until the batch ends
+class Batch():
+    __slots__ = ("type", "parameters", "events")
+
+    def __init__(self, batch_type, parameters):
+        self.type = batch_type
+        self.parameters = parameters
+        self.events = []
+
+# The capability negotiation (CAP LS 302) of a connection
+class CapNegotiation():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Capabilities offered by the server, with their value (i.e. the SASL mechanisms)
+        self.available = {}
+        self.requested = set()
+        self.enabled = set()
+        # Offered by the current CAP LS (or CAP NEW), which may span several lines
+        self.offered = set()
+        # Until CAP END is sent, the server holds the registration
+        self.negotiating = True
+
+    def is_enabled(self, name):
+        return name in self.enabled
+
+    # Handles a CAP LS (or CAP NEW) reply. Returns the capabilities to request,
+    # or None if the list continues on another line.
+    def on_ls(self, arguments):
+        for item in arguments[-1].split():
+            name, separator, value = item.partition("=")
+            self.available[name] = value
+            self.offered.add(name)
+        if len(arguments) > 2 and arguments[1] == "*":
+            return None
+        # Only what this reply offers, so that a CAP NEW doesn't request again what was refused
+        offered = self.offered
+        self.offered = set()
+        wanted = [name for name in WANTED_CAPABILITIES
+                  if name in offered and name not in self.enabled and name not in self.requested]
+        self.requested.update(wanted)
+        return wanted
+
+    # Returns the capabilities which got enabled
+    def on_ack(self, names):
+        enabled = []
+        for name in names.split():
+            if name.startswith("-"):
+                self.enabled.discard(name[1:])
+                continue
+            self.requested.discard(name)
+            self.enabled.add(name)
+            enabled.append(name)
+        return enabled
+
+    def on_nak(self, names):
+        for name in names.split():
+            self.requested.discard(name)
+
+    def on_del(self, names):
+        for name in names.split():
+            self.available.pop(name, None)
+            self.enabled.discard(name)
+
+    # Returns the SASL mechanisms the server supports, or None if it didn't say
+    def get_sasl_mechanisms(self):
+        value = self.available.get("sasl", "")
+        if value == "":
+            return None
+        return value.upper().split(",")
@@ -0,0 +1,225 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from gi.repository import GLib
+from batching import drain_batch
+
+# Messages written within this many seconds share a single transaction
+FLUSH_INTERVAL = 0.5
+
+# Number of messages replayed when the application starts
+REPLAY_COUNT = 200
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        channel TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        nick TEXT,
+        text TEXT,
+        action TEXT,
+        old_nick TEXT,
+        is_action INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS messages_channel_time ON messages (channel, time);
+"""
+
+# Full-text index over the messages, kept up to date by a trigger
+FTS_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='id');
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END;
+    CREATE INDEX IF NOT EXISTS messages_channel_nick ON messages (channel, nick COLLATE NOCASE);
+"""
+
+COLUMNS = "id, channel, time, nick, text, action, old_nick, is_action"
+PREFIXED_COLUMNS = ", ".join("m." + column for column in COLUMNS.split(", "))
+
+# Maximum number of search results
+SEARCH_LIMIT = 100
+
+def get_log_directory():
+    return os.path.join(GLib.get_user_data_dir(), "jargonaut", "logs")
+
+# Returns the timestamp of midnight (local time) for a YYYY-MM-DD date, or None
+def parse_date(value):
+    try:
+        return int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+    except (ValueError, OverflowError):
+        return None
+
+# Splits a search query into its terms and its filters:
+# nick:NICK, after:YYYY-MM-DD (that day included) and before:YYYY-MM-DD (that day excluded)
+def parse_search_query(query):
+    terms = []
+    nick = None
+    after = None
+    before = None
+    for word in query.split():
+        key, separator, value = word.partition(":")
+        key = key.lower()
+        if separator == "" or value == "":
+            terms.append(word)
+        elif key == "nick":
+            nick = value
+        elif key == "after" and parse_date(value) is not None:
+            after = parse_date(value)
+        elif key == "before" and parse_date(value) is not None:
+            before = parse_date(value)
+        else:
+            terms.append(word)
+    return (terms, nick, after, before)
+
+# An append-only log of the messages of a server, in an SQLite database (one per server).
+# Writes are queued and committed in batches from a writer thread.
+class ChatLog():
+    def __init__(self, server):
+        name = server.replace(os.sep, "_")
+        self.path = os.path.join(get_log_directory(), f"{name}.db")
+        self.queue = queue.Queue()
+        self.thread = None
+        self.fts = False
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    # Starts the writer thread. Before writing anything, it reads the most
+    # recent messages of each channel and passes them to callback(channel, rows).
+    def open(self, channels, callback):
+        self.thread = threading.Thread(target=self.run, args=(channels, callback))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def write(self, channel, message):
+        self.queue.put((channel, message))
+
+    def run(self, channels, callback):
+        try:
+            os.makedirs(get_log_directory(), exist_ok=True)
+            connection = self.connect()
+            connection.executescript(SCHEMA)
+            for channel in channels:
+                callback(channel, self.fetch_recent(connection, channel, REPLAY_COUNT))
+        except Exception as e:
+            print("Chat log unavailable:", e)
+            return
+        self.fts = self.create_fts(connection)
+
+        for entries in drain_batch(self.queue, FLUSH_INTERVAL):
+            try:
+                self.insert(connection, entries)
+            except sqlite3.Error as e:
+                print("Could not write to the chat log:", e)
+        connection.close()
+
+    def create_fts(self, connection):
+        try:
+            exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+            connection.executescript(FTS_SCHEMA)
+            if exists is None:
+                # Index what was logged before the index existed
+                with connection:
+                    connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            print("Full-text search unavailable:", e)
+            return False
+
+    def insert(self, connection, entries):
+        rows = []
+        for channel, message in entries:
+            rows.append((channel, message.time, message.nick, message.text, message.action,
+                         message.old_nick, int(message.is_action)))
+        with connection:
+            connection.executemany("INSERT INTO messages (channel, time, nick, text, action, old_nick, is_action) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            last_id = connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+        # Rows inserted in a single transaction get consecutive ids
+        first_id = last_id - len(entries) + 1
+        for index, (channel, message) in enumerate(entries):
+            message.log_id = first_id + index
+
+    def fetch_recent(self, connection, channel, count):
+        rows = connection.execute(f"SELECT {COLUMNS} FROM messages WHERE channel = ? "
+                                  "ORDER BY time DESC, id DESC LIMIT ?", (channel, count)).fetchall()
+        rows.reverse()
+        return rows
+
+    # The methods below are blocking, they're meant to be called from a worker thread
+
+    # Returns up to count messages older than the given message (identified by its time and id)
+    def fetch_before(self, channel, before_time, before_id, count):
+        connection = self.connect()
+        try:
+            rows = connection.execute(f"SELECT {COLUMNS} FROM messages WHERE channel = ? "
+                                      "AND (time < ? OR (time = ? AND id < ?)) "
+                                      "ORDER BY time DESC, id DESC LIMIT ?",
+                                      (channel, before_time, before_time, before_id, count)).fetchall()
+        finally:
+            connection.close()
+        rows.reverse()
+        return rows
+
+    # Returns up to count messages starting with the given message (included)
+    def fetch_after(self, channel, after_time, after_id, count):
+        connection = self.connect()
+        try:
+            return connection.execute(f"SELECT {COLUMNS} FROM messages WHERE channel = ? "
+                                      "AND (time > ? OR (time = ? AND id >= ?)) "
+                                      "ORDER BY time, id LIMIT ?",
+                                      (channel, after_time, after_time, after_id, count)).fetchall()
+        finally:
+            connection.close()
+
+    # Returns the most recent messages matching a query (see parse_search_query())
+    def search(self, channel, query):
+        terms, nick, after, before = parse_search_query(query)
+        conditions = ["m.channel = ?"]
+        parameters = [channel]
+        if nick is not None:
+            conditions.append("m.nick = ? COLLATE NOCASE")
+            parameters.append(nick)
+        if after is not None:
+            conditions.append("m.time >= ?")
+            parameters.append(after)
+        if before is not None:
+            conditions.append("m.time < ?")
+            parameters.append(before)
+
+        if len(terms) > 0 and self.fts:
+            # Each term is quoted (so it can't be an FTS operator) and matched as a prefix
+            match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+            sql = (f"SELECT {PREFIXED_COLUMNS} FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                   f"WHERE messages_fts MATCH ? AND {' AND '.join(conditions)} "
+                   "ORDER BY messages_fts.rowid DESC LIMIT ?")
+            parameters = [match] + parameters
+        else:
+            if len(terms) == 0 and len(parameters) == 1:
+                return []
+            for term in terms:
+                conditions.append("m.text LIKE ?")
+                parameters.append(f"%{term}%")
+            sql = (f"SELECT {PREFIXED_COLUMNS} FROM messages m WHERE {' AND '.join(conditions)} "
+                   "ORDER BY m.id DESC LIMIT ?")
+        parameters.append(SEARCH_LIMIT)
+
+        connection = self.connect()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        except sqlite3.OperationalError as e:
+            print("Search failed:", e)
+            return []
+        finally:
+            connection.close()
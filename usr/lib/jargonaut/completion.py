@@ -0,0 +1,94 @@
+import bisect
+
+# Sorts after any character a nick can contain, for the end of prefix ranges
+LAST_CHARACTER = chr(0x10FFFF)
+
+# Completes the nicknames of the members of a channel. The casemapped nicks are kept
+# sorted, and updated from the membership events, so the nicks starting with a prefix
+# are found with a bisect whatever the size of the channel.
+class NickCompleter():
+    def __init__(self, users):
+        self.users = users
+        self.keys = sorted(users.get_key(member.nick) for member in users)
+        # When members last spoke (a counter, the highest is the most recent), by casemapped nick
+        self.last_spoke = {}
+        self.n_messages = 0
+        users.connect(self.on_membership_changed)
+
+    def on_membership_changed(self, event, member, old_nick):
+        if event == "add":
+            bisect.insort(self.keys, self.users.get_key(member.nick))
+        elif event == "remove":
+            key = self.users.get_key(member.nick)
+            self.remove_key(key)
+            self.last_spoke.pop(key, None)
+        elif event == "rename":
+            old_key = self.users.get_key(old_nick)
+            key = self.users.get_key(member.nick)
+            self.remove_key(old_key)
+            bisect.insort(self.keys, key)
+            if old_key in self.last_spoke:
+                self.last_spoke[key] = self.last_spoke.pop(old_key)
+        elif event == "clear":
+            # Either everyone left, or the casemapping changed and the members are added again
+            self.keys = []
+            self.last_spoke.clear()
+
+    def remove_key(self, key):
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            del self.keys[index]
+
+    def on_message(self, nick):
+        key = self.users.get_key(nick)
+        if key in self.users.members:
+            self.n_messages += 1
+            self.last_spoke[key] = self.n_messages
+
+    # Returns the nicks starting with prefix, the most recent speakers first, then alphabetically
+    def get_candidates(self, prefix, exclude=None):
+        prefix = self.users.get_key(prefix)
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_right(self.keys, prefix + LAST_CHARACTER, start)
+        keys = self.keys[start:end]
+        if exclude is not None:
+            exclude = self.users.get_key(exclude)
+            keys = [key for key in keys if key != exclude]
+        keys.sort(key=lambda key: -self.last_spoke.get(key, 0))
+        return [self.users.members[key].nick for key in keys if key in self.users.members]
+
+# The state of Tab completion in an entry: pressing Tab again cycles through the candidates
+class TabCompletion():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.candidates = []
+        self.index = 0
+        # What the entry looked like after the last completion
+        self.start = 0
+        self.text = None
+        self.position = None
+
+    # Returns (text, position) after completing the word before position, or None
+    def complete(self, completer, text, position, own_nick):
+        if self.text == text and self.position == position and len(self.candidates) > 0:
+            # Tab again, replace the last candidate with the next one
+            self.index = (self.index + 1) % len(self.candidates)
+        else:
+            self.start = text.rfind(" ", 0, position) + 1
+            word = text[self.start:position]
+            self.candidates = completer.get_candidates(word, own_nick) if word != "" else []
+            self.index = 0
+            if len(self.candidates) == 0:
+                self.reset()
+                return None
+        after = text[position:]
+        completed = self.candidates[self.index]
+        # Addressing someone at the beginning of the line
+        completed += ": " if self.start == 0 else " "
+        if after.startswith(" "):
+            completed = completed.rstrip(" ")
+        self.text = text[:self.start] + completed + after
+        self.position = self.start + len(completed)
+        return (self.text, self.position)
@@ -0,0 +1,43 @@
+import queue
+import sys
+import threading
+import time
+from batching import drain_batch
+
+# Lines logged within this many seconds are written to the stream at once
+FLUSH_INTERVAL = 0.2
+
+# Writes the raw IRC traffic to stdout from a separate thread, in batches, so that
+# logging a line is just a queue put for the thread which received it.
+class RawLogger():
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def log(self, server, line):
+        self.queue.put((time.time(), server, line))
+
+    def run(self):
+        for items in drain_batch(self.queue, FLUSH_INTERVAL):
+            lines = []
+            for timestamp, server, line in items:
+                date = time.strftime("%H:%M:%S", time.localtime(timestamp))
+                lines.append(f"{date}.{int(timestamp * 1000) % 1000:03d} {server} < {line!r}\n")
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
@@ -0,0 +1,153 @@
+import html
+import re
+import urllib.parse
+
+BOLD = "\x02"
+COLOR = "\x03"
+MONOSPACE = "\x11"
+RESET = "\x0F"
+# Gtk.Entry won't accept \x1D, so \x16 is used for italics when typing (see on_key_press_event)
+ITALIC_ENTRY = "\x16"
+ITALIC = "\x1D"
+STRIKETHROUGH = "\x1E"
+UNDERLINE = "\x1F"
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.svg', '.bmp', '.webp')
+
+# Images are shown through this URI scheme, served by thumbnails.ThumbnailProvider
+THUMBNAIL_SCHEME = "jargonaut-thumb"
+
+# mIRC colors 0-15, 99 means "default"
+COLORS = [
+    "#FFFFFF",  # White
+    "#000000",  # Black
+    "#00007F",  # Blue
+    "#009300",  # Green
+    "#FF0000",  # Red
+    "#7F0000",  # Brown
+    "#9C009C",  # Magenta
+    "#FC7F00",  # Orange
+    "#FFFF00",  # Yellow
+    "#00FC00",  # Light green
+    "#009393",  # Cyan
+    "#00FFFF",  # Light cyan
+    "#0000FC",  # Light blue
+    "#FF00FF",  # Pink
+    "#7F7F7F",  # Grey
+    "#D2D2D2"   # Light grey
+]
+
+# Formatting codes, color codes (with optional foreground,background) and URLs, matched in a single pass
+TOKEN_PATTERN = re.compile(
+    r'[\x02\x0F\x11\x16\x1D\x1E\x1F]'
+    r'|\x03(?:(\d{1,2})(?:,(\d{1,2}))?)?'
+    r'|(https?://[^\s\x00-\x1F]{3,}\.[^\s\x00-\x1F]{2,})'
+)
+
+# Formatting and color codes only, for plain text output
+CODES_PATTERN = re.compile(r'[\x02\x0F\x11\x16\x1D\x1E\x1F]|\x03(?:\d{1,2}(?:,\d{1,2})?)?')
+
+def get_color(code):
+    if code is None:
+        return None
+    index = int(code)
+    if index < len(COLORS):
+        return COLORS[index]
+    return None
+
+# Wraps already escaped text with the tags for the current style.
+# Tags are always opened and closed in the same order so the HTML is properly nested.
+def apply_style(text, bold, italic, underline, strikethrough, monospace, foreground, background):
+    opening = ""
+    closing = ""
+    if bold:
+        opening += "<b>"
+        closing = "</b>" + closing
+    if italic:
+        opening += "<i>"
+        closing = "</i>" + closing
+    if underline:
+        opening += "<u>"
+        closing = "</u>" + closing
+    if strikethrough:
+        opening += "<s>"
+        closing = "</s>" + closing
+    if monospace:
+        opening += "<code>"
+        closing = "</code>" + closing
+    if foreground is not None or background is not None:
+        style = ""
+        if foreground is not None:
+            style += f"color:{foreground};"
+        if background is not None:
+            style += f"background-color:{background};"
+        opening += f'<span style="{style}">'
+        closing = "</span>" + closing
+    return opening + text + closing
+
+def get_thumbnail_uri(url):
+    return f"{THUMBNAIL_SCHEME}:{urllib.parse.quote(url, safe='')}"
+
+def format_link(url, style):
+    escaped_url = html.escape(url)
+    if url.lower().endswith(IMAGE_EXTENSIONS):
+        thumbnail_uri = html.escape(get_thumbnail_uri(url))
+        return f'<a href="{escaped_url}"><img class="thumb" loading="lazy" src="{thumbnail_uri}" title="{escaped_url}"/></a>'
+    return f'<a href="{escaped_url}">{apply_style(escaped_url, *style)}</a>'
+
+# Returns the URLs of a line of IRC text, except images (they're shown as thumbnails)
+def find_links(text):
+    links = []
+    for match in TOKEN_PATTERN.finditer(text):
+        url = match.group(3)
+        if url is not None and not url.lower().endswith(IMAGE_EXTENSIONS):
+            links.append(url)
+    return links
+
+# Converts a line of IRC text into HTML: tags typed by users are escaped,
+# formatting codes become tags and URLs become links (or thumbnails for images).
+def format_irc(text):
+    output = []
+    bold = italic = underline = strikethrough = monospace = False
+    foreground = background = None
+    position = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        start = match.start()
+        if start > position:
+            output.append(apply_style(html.escape(text[position:start]), bold, italic, underline, strikethrough, monospace, foreground, background))
+        position = match.end()
+
+        url = match.group(3)
+        if url is not None:
+            output.append(format_link(url, (bold, italic, underline, strikethrough, monospace, foreground, background)))
+            continue
+
+        code = text[start]
+        if code == BOLD:
+            bold = not bold
+        elif code == ITALIC or code == ITALIC_ENTRY:
+            italic = not italic
+        elif code == UNDERLINE:
+            underline = not underline
+        elif code == STRIKETHROUGH:
+            strikethrough = not strikethrough
+        elif code == MONOSPACE:
+            monospace = not monospace
+        elif code == COLOR:
+            if match.group(1) is None:
+                foreground = background = None
+            else:
+                foreground = get_color(match.group(1))
+                if match.group(2) is not None:
+                    background = get_color(match.group(2))
+        elif code == RESET:
+            bold = italic = underline = strikethrough = monospace = False
+            foreground = background = None
+
+    if position < len(text):
+        output.append(apply_style(html.escape(text[position:]), bold, italic, underline, strikethrough, monospace, foreground, background))
+    return "".join(output)
+
+# Removes the formatting codes from a line of IRC text
+def strip_codes(text):
+    return CODES_PATTERN.sub("", text)
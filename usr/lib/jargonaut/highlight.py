@@ -0,0 +1,61 @@
+import re
+
+# Characters which can be part of a nickname. A highlight must not be
+# surrounded by them, so "nick," "@nick" or "nick!" match but "nicky" doesn't.
+NICK_CHARACTERS = r"A-Za-z0-9\[\]\\`^{|}_\-"
+
+# Characters which are equivalent under the rfc1459 casemapping
+RFC1459_EQUIVALENTS = {
+    "[": "[{", "{": "[{",
+    "]": "]}", "}": "]}",
+    "\\": "\\|", "|": "\\|",
+    "~": "~^", "^": "~^",
+}
+
+def get_word_pattern(word, casemapping):
+    if casemapping == "ascii":
+        return re.escape(word)
+    pattern = ""
+    for character in word:
+        equivalents = RFC1459_EQUIVALENTS.get(character)
+        if equivalents is None or (casemapping == "strict-rfc1459" and character in "~^"):
+            pattern += re.escape(character)
+        else:
+            pattern += "[" + re.escape(equivalents) + "]"
+    return pattern
+
+# Finds mentions of our nickname, or of any of the user's highlight words, in a message.
+# The pattern is compiled once, when the nickname or the words change.
+class Highlighter():
+    def __init__(self, nickname, words=(), casemapping="rfc1459"):
+        self.nickname = nickname
+        self.words = words
+        self.casemapping = casemapping
+        self.compile()
+
+    def compile(self):
+        words = [self.nickname] + [word.strip() for word in self.words]
+        # Longest first, so the longest alternative wins when words overlap
+        words = sorted(set(word for word in words if word != ""), key=len, reverse=True)
+        if len(words) == 0:
+            self.pattern = None
+            return
+        alternatives = "|".join(get_word_pattern(word, self.casemapping) for word in words)
+        self.pattern = re.compile(f"(?<![{NICK_CHARACTERS}])(?:{alternatives})(?![{NICK_CHARACTERS}])", re.IGNORECASE)
+
+    def set_nickname(self, nickname):
+        if nickname != self.nickname:
+            self.nickname = nickname
+            self.compile()
+
+    def set_words(self, words):
+        self.words = words
+        self.compile()
+
+    def set_casemapping(self, casemapping):
+        if casemapping != self.casemapping:
+            self.casemapping = casemapping
+            self.compile()
+
+    def matches(self, text):
+        return self.pattern is not None and self.pattern.search(text) is not None
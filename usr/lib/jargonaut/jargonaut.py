@@ -9,21 +9,35 @@ try:
 except:
     gi.require_version('WebKit2', '4.0')
 gi.require_version('XApp', '1.0')
-from gi.repository import Gtk, Gio, GLib, Gdk, Notify, WebKit2, XApp, Gspell
-import irc.client
+from gi.repository import Gtk, Gio, GLib, Gdk, XApp
+# WebKit2, Gspell and Notify are only imported once the window is shown
+from startup import profiler
+# irc, the transports and ssl are only imported once the window is drawn (see start_networking())
+import functools
 import getpass
 import gettext
-import html
+import json
 import locale
 import os
 import random
-import re
 import setproctitle
-import ssl
+import sys
+import time
 import webbrowser
-from irc.connection import Factory
-from settings import bind_entry_widget, bind_switch_widget
-from ui import build_menu, idle, _async, color_palette, format_timespan, get_span_minutes
+from benchmark import Benchmark, is_valid_scenario
+from capabilities import HISTORY_LIMIT, HISTORY_TIMEOUT, Batch, format_server_time, get_authenticate_chunks, \
+    get_sasl_plain_payload, get_tag, parse_server_time
+from chatlog import ChatLog
+from completion import TabCompletion
+from debuglog import RawLogger
+from formatting import find_links, format_irc, strip_codes
+from notifications import NotificationManager
+from scrollback import WINDOW_SIZE, PAGE_SIZE
+from session import Server, parse_channel_entry
+from supervisor import ConnectionSupervisor
+from settings import Settings, bind_entry_widget, bind_list_entry_widget, bind_switch_widget
+from timestamps import TimestampFormatter
+from ui import build_menu, idle, _async, get_nick_color, get_nick_markup, get_span_minutes, RenderScheduler
 
 # i18n
 APP = "jargonaut"
@@ -33,22 +47,48 @@ gettext.bindtextdomain(APP, LOCALE_DIR)
 gettext.textdomain(APP)
 _ = gettext.gettext
 
+# Above this many changes, the user list is detached from its views while it's updated
+USER_LIST_BULK_THRESHOLD = 50
+
+# CTCP requests older than this (in seconds, according to their server-time) are replayed, not answered
+CTCP_MAX_AGE = 60
+
 setproctitle.setproctitle("jargonaut")
-Notify.init(_("Chat Room"))
+profiler.mark("imports")
 
 class Message():
-    def __init__(self, nick, text, action=None, old_nick=None, separator=False):
-        self.nick = nick
-        self.text = text
-        self.time = GLib.DateTime.new_now_local()
+    # Long sessions hold thousands of these, keep them small
+    __slots__ = ("nick", "text", "html", "time", "action", "old_nick", "seq", "log_id", "is_action",
+                 "mention", "preview")
+
+    # action is the kind of event ("join", "quit"...), is_action is for /me messages
+    def __init__(self, nick, text, action=None, old_nick=None, timestamp=None, is_action=False):
+        self.nick = sys.intern(nick) if nick is not None else None
+        self.old_nick = sys.intern(old_nick) if old_nick is not None else None
+        self.time = int(time.time()) if timestamp is None else timestamp
         self.action = action
-        self.old_nick = old_nick
-        self.separator = separator
+        self.seq = None
+        # Row id in the chat log, once written
+        self.log_id = None
+        # Derived fields, computed once and cached
+        self.is_action = is_action
+        self.html = None
+        self.mention = False
+        # Link preview, added once it's fetched
+        self.preview = ""
+        self.text = text
 
 class App(Gtk.Application):
     def __init__(self):
         super().__init__(application_id="org.x.jargonaut")
         self.window = None
+        self.add_main_option("profile-startup", 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+                             _("Print how long each phase of the startup takes"), None)
+        self.add_main_option("benchmark", 0, GLib.OptionFlags.NONE, GLib.OptionArg.STRING,
+                             _("Replay a scenario (names, netsplit, flood) or a transcript, then print performance figures"),
+                             "SCENARIO")
+        self.benchmark_scenario = None
+        self.benchmark = None
 
     def do_activate(self):
         # If the window already exists, present it to the user
@@ -56,25 +96,31 @@ class App(Gtk.Application):
             self.window.present()
             return
 
-        self.is_connected = False
-        self.user_colors = {}
-        self.color_index = 0
-
-        self.settings = Gio.Settings(schema="org.x.jargonaut")
-        self.channel = self.settings.get_string("channel")
-        self.server = self.settings.get_string("server")
-        self.port = self.settings.get_int("port")
-        self.tls = self.settings.get_boolean("tls-connection")
-        self.nickname = self.get_new_nickname()
-
-        self.channel_users = {}
-        self.channel_users[self.channel] = []
-        self.messages = []
-        self.n_real_messages = 0
-        self.scrollback_queue_start_count = 0
-        self.separator_message = None
-
-        prefer_dark_mode = self.settings.get_boolean("prefer-dark-mode")
+        self.settings = Settings("org.x.jargonaut")
+        self.settings.connect("changed::highlight-words", self.on_highlight_words_changed)
+        self.settings.connect("changed::scrollback-lines", self.on_scrollback_limit_changed)
+
+        # The reactor and the connections are created once the window is drawn
+        self.reactor = None
+        self.network = None
+        self.servers = []
+        self.servers_by_connection = {}
+        self.channels_by_id = {}
+        # The channel which is shown
+        self.current = None
+
+        # Messages, user list changes and scroll checks are applied together,
+        # at most once per render-interval
+        self.webview_loaded = False
+        self.position_query_pending = False
+        self.render_scheduler = RenderScheduler(self.flush_render, self.settings.render_interval)
+        self.timestamps = TimestampFormatter(self.on_day_changed)
+        self.settings.connect("changed::render-interval", self.on_render_interval_changed)
+        # Raw traffic is only logged (and the handler only registered) in debug mode
+        self.raw_logger = None
+        self.search_results = []
+
+        prefer_dark_mode = self.settings.prefer_dark_mode
         try:
             # DarkModeManager is available in XApp 2.6+
             self.dark_mode_manager = XApp.DarkModeManager.new(prefer_dark_mode)
@@ -83,7 +129,6 @@ class App(Gtk.Application):
             # Use the Gtk.Settings API as a fallback for older versions
             Gtk.Settings.get_default().set_property("gtk-application-prefer-dark-theme", prefer_dark_mode)
 
-        self.last_key_press_is_tab = False
         self.last_message_nick = ""
 
         self.builder = Gtk.Builder()
@@ -91,7 +136,7 @@ class App(Gtk.Application):
         self.window = self.builder.get_object("main_window")
         self.window.set_application(self)
         self.window.connect("delete_event", self.close_window)
-        self.window.show()
+        self.first_draw_handler = self.window.connect("draw", self.on_first_draw)
 
         css_provider = Gtk.CssProvider()
         css_provider.load_from_path("/usr/share/jargonaut/style.css")
@@ -100,6 +145,8 @@ class App(Gtk.Application):
             css_provider,
             Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION
         )
+        self.window.show()
+        profiler.mark("window")
 
         # Users button
         self.builder.get_object("users_button").connect("clicked", self.on_users_button_clicked)
@@ -125,48 +172,140 @@ class App(Gtk.Application):
 
         self.main_stack = self.builder.get_object("main_stack")
 
-        # Settings widgets
+        # The settings widgets are bound the first time the preferences are opened
+        self.preferences_ready = False
 
-        bind_switch_widget(self.builder.get_object("pref_dark"), self.settings, "prefer-dark-mode", fn_callback=self.update_dark_mode)
-        bind_switch_widget(self.builder.get_object("pref_24h"), self.settings, "timestamp-24h", fn_callback=self.update_timestamp_format)
-
-        bind_entry_widget(self.builder.get_object("pref_nickname"), self.settings, "nickname", fn_callback=self.show_restart_infobar)
-        bind_entry_widget(self.builder.get_object("pref_password"), self.settings, "password", fn_callback=self.show_restart_infobar),
-        bind_switch_widget(self.builder.get_object("pref_acceleration"), self.settings, "hw-acceleration", fn_callback=self.update_hw_acceleration)
-
-        self.webview = WebKit2.WebView()
-        self.update_hw_acceleration(self.settings.get_boolean("hw-acceleration"))
-        self.webview.connect("decide-policy", self.on_decide_policy)
-        self.webview.show()
-        self.render_html()
-
-        self.builder.get_object("webview_box").pack_start(self.webview, True, True, 0)
+        # The webview, thumbnails and spell checker are created once the window is shown,
+        # link previews and notifications when they're first needed
+        self.webview = None
+        self.thumbnails = None
+        self.link_previewer = None
+        self.notifications = NotificationManager(self.settings, self.on_notification_activated)
+        self.window.connect("focus-in-event", self.on_window_focused)
 
         self.scrollback_return_button = self.builder.get_object("scrollback_return_button")
         self.scrollback_return_button.connect("clicked", self.on_scrollback_return_button_clicked)
 
+        # Search
+        self.search_bar = self.builder.get_object("search_bar")
+        self.search_entry = self.builder.get_object("search_entry")
+        self.search_bar.connect_entry(self.search_entry)
+        self.search_entry.connect("search-changed", self.on_search_changed)
+        self.search_entry.connect("stop-search", self.on_search_stopped)
+        self.search_results_window = self.builder.get_object("search_results_window")
+        self.search_results_list = self.builder.get_object("search_results")
+        self.search_results_list.connect("row-activated", self.on_search_result_activated)
+
+        # Channel list, only shown when there's more than one channel
+        self.sidebar = self.builder.get_object("sidebar")
+        self.channel_list = self.builder.get_object("channel_list")
+        self.channel_list.connect("row-selected", self.on_channel_row_selected)
+        self.channel_rows = {}
+
+        # Each channel has its own user store, the treeview shows the current one
         self.user_treeview = self.builder.get_object("treeview_users")
-        self.user_store = Gtk.ListStore(str, str) # nick, raw_nick
-        self.user_treeview.set_model(self.user_store)
-        self.user_store.set_sort_column_id(1, Gtk.SortType.ASCENDING)
 
         self.user_list_box = self.builder.get_object("user_list_box")
-        self.user_list_box.set_visible(self.settings.get_boolean("user-list-visible"))
+        self.user_list_box.set_visible(self.settings.user_list_visible)
         self.current_paned_position = 0
 
 
         self.chat_paned = self.builder.get_object("chat_paned")
 
-        completion = Gtk.EntryCompletion()
-        completion.set_model(self.user_store)
-        completion.set_text_column(1)
-        completion.set_inline_completion(True)
-        completion.set_popup_completion(True)
+        # Tab completes nicknames, from the members of the current channel
+        self.tab_completion = TabCompletion()
 
         self.entry = self.builder.get_object("entry_main")
-        self.entry.set_completion(completion)
         self.entry.connect("key-press-event", self.on_key_press_event)
 
+        renderer = Gtk.CellRendererText()
+        col = Gtk.TreeViewColumn("Users", renderer, markup=0)
+        self.user_treeview.append_column(col)
+
+        # Servers and channels: the main channel, then the extra ones
+        nickname = self.get_new_nickname()
+        default_server = self.settings.server
+        default_port = self.settings.port
+        entries = [self.settings.channel] + self.settings.extra_channels
+        entries = [entry for entry in entries if parse_channel_entry(entry, default_server, default_port)[2] != ""]
+        if len(entries) == 0:
+            # There's always at least one channel to show
+            entries = [self.settings.get_default("channel")]
+            self.print_info(f"No channel configured, joining {entries[0]}")
+        for entry in entries:
+            host, port, name = parse_channel_entry(entry, default_server, default_port)
+            server = self.find_server(host, port)
+            if server is None:
+                server = self.add_server(host, port, nickname)
+            if server.get_channel(name) is None:
+                self.add_channel(server, name)
+        self.update_sidebar()
+        self.switch_channel(next(iter(self.servers[0].channels.values())))
+
+        # Persistent history, the most recent messages are replayed once it's open
+        for server in self.servers:
+            if server.chatlog is not None:
+                names = [channel.name for channel in server.channels.values()]
+                server.chatlog.open(names, functools.partial(self.on_recent_history_loaded, server))
+
+        profiler.mark("channels")
+
+        if self.benchmark_scenario is not None:
+            # The traffic is injected once the webview is loaded
+            self.benchmark = Benchmark(self, self.benchmark_scenario)
+            self.main_stack.set_visible_child_name("page_chat")
+        elif os.environ.get("JARGONAUT_NO_SERVER_TEST", False):
+            self.main_stack.set_visible_child_name("page_chat")
+
+    def do_handle_local_options(self, options):
+        if options.contains("benchmark"):
+            self.benchmark_scenario = options.lookup_value("benchmark", GLib.VariantType.new("s")).get_string()
+            if not is_valid_scenario(self.benchmark_scenario):
+                print(f"Unknown benchmark scenario: {self.benchmark_scenario}")
+                return 1
+            # Run in this process, even if Jargonaut is already running
+            self.set_flags(self.get_flags() | Gio.ApplicationFlags.NON_UNIQUE)
+        # --profile-startup is handled by the profiler, let the application carry on
+        return -1
+
+    def on_first_draw(self, widget, cairo_context):
+        self.window.disconnect(self.first_draw_handler)
+        profiler.mark_first_paint()
+        GLib.idle_add(self.finish_startup)
+        return False
+
+    # The rest of the startup, which runs once the window is drawn
+    def finish_startup(self):
+        # Connecting takes round trips, start it before anything else
+        self.start_networking()
+
+        from gi.repository import WebKit2
+        from thumbnails import ThumbnailProvider
+
+        # Images posted in the chat are shown as thumbnails, downloaded and scaled in the background
+        self.thumbnails = ThumbnailProvider()
+        self.thumbnails.register(WebKit2.WebContext.get_default())
+
+        # A single webview shows every channel, each in its own container
+        self.webview = WebKit2.WebView()
+        self.apply_hw_acceleration(self.settings.hw_acceleration)
+        self.webview.connect("decide-policy", self.on_decide_policy)
+        self.webview.connect("load-changed", self.on_load_changed)
+        content_manager = self.webview.get_user_content_manager()
+        content_manager.register_script_message_handler("scrollback")
+        content_manager.connect("script-message-received::scrollback", self.on_scrollback_requested)
+        self.webview.show()
+        self.load_page()
+
+        self.builder.get_object("webview_box").pack_start(self.webview, True, True, 0)
+        profiler.mark("webview")
+
+        self.setup_spell_checker()
+        profiler.mark("spell checker")
+        return False
+
+    def setup_spell_checker(self):
+        from gi.repository import Gspell
         checker = Gspell.Checker()
         language = Gspell.Language.lookup("en_US")
         checker.set_language(language)
@@ -175,52 +314,30 @@ class App(Gtk.Application):
         gspell_entry = Gspell.Entry.get_from_gtk_entry(self.entry)
         gspell_entry.set_inline_spell_checking(True)
 
-        renderer = Gtk.CellRendererText()
-        col = Gtk.TreeViewColumn("Users", renderer, markup=0)
-        self.user_treeview.append_column(col)
+    # Called by open_preferences()
+    def setup_preferences(self):
+        if self.preferences_ready:
+            return
+        self.preferences_ready = True
+        bind_switch_widget(self.builder.get_object("pref_dark"), self.settings, "prefer-dark-mode", fn_callback=self.update_dark_mode)
+        bind_switch_widget(self.builder.get_object("pref_24h"), self.settings, "timestamp-24h", fn_callback=self.update_timestamp_format)
 
-        self.assign_color(self.nickname)
-        self.builder.get_object("label_username").set_markup(self.nickname)
-
-        self.client = irc.client.SimpleIRCClient()
-        self.client.connection.add_global_handler("welcome", self.on_welcome)
-        self.client.connection.add_global_handler("join", self.on_join)
-        self.client.connection.add_global_handler("namreply", self.on_namreply)
-        self.client.connection.add_global_handler("notice", self.on_notice)
-        self.client.connection.add_global_handler("nick", self.on_nick)
-        self.client.connection.add_global_handler("quit", self.on_quit)
-        self.client.connection.add_global_handler("part", self.on_part)
-        self.client.connection.add_global_handler("all_raw_messages", self.on_all_raw_messages)
-        self.client.connection.add_global_handler("pubmsg", self.on_pubmsg)
-        self.client.connection.add_global_handler("erroneusnickname", self.on_erroneusnickname)
-        self.client.connection.add_global_handler("disconnect", self.on_disconnect)
-        self.client.connection.add_global_handler("error", self.on_error)
-        self.client.connection.add_global_handler("nicknameinuse", self.on_nicknameinuse)
-
-        if os.environ.get("JARGONAUT_NO_SERVER_TEST", False):
-            self.main_stack.set_visible_child_name("page_chat")
-        else:
-            self.connect_to_server()
+        bind_entry_widget(self.builder.get_object("pref_nickname"), self.settings, "nickname", fn_callback=self.show_restart_infobar)
+        bind_entry_widget(self.builder.get_object("pref_password"), self.settings, "password", fn_callback=self.show_restart_infobar),
+        bind_list_entry_widget(self.builder.get_object("pref_highlight_words"), self.settings, "highlight-words")
+        bind_list_entry_widget(self.builder.get_object("pref_extra_channels"), self.settings, "extra-channels", fn_callback=self.show_restart_infobar)
+        bind_entry_widget(self.builder.get_object("pref_client_certificate"), self.settings, "client-certificate")
+        bind_switch_widget(self.builder.get_object("pref_link_previews"), self.settings, "link-previews")
+        bind_entry_widget(self.builder.get_object("pref_quiet_hours"), self.settings, "quiet-hours")
+        bind_switch_widget(self.builder.get_object("pref_acceleration"), self.settings, "hw-acceleration", fn_callback=self.update_hw_acceleration)
 
 #########################
 # Nickname/user functions
 #########################
 
-    def assign_color(self, nick):
-        if nick not in self.user_colors.keys():
-            color = color_palette[self.color_index]
-            print(f"Assigning color {color} to {nick}")
-            self.user_colors[nick] = color
-            self.color_index = (self.color_index + 1) % len(color_palette)
-
-    def get_nick_markup(self, nick):
-        color = self.user_colors[nick]
-        nick = f"<span foreground='{color}'>{nick}</span>"
-        return nick
-
     def get_new_nickname(self, with_random_suffix=False):
-        if self.settings.get_string("nickname") != "":
-            prefix = self.settings.get_string("nickname")
+        if self.settings.nickname != "":
+            prefix = self.settings.nickname
         else:
             prefix = getpass.getuser()
         if with_random_suffix:
@@ -230,54 +347,287 @@ class App(Gtk.Application):
         else:
             return prefix[:16] # 16 chars max
 
+##########################
+# Server/channel functions
+##########################
+
+    def find_server(self, host, port):
+        for server in self.servers:
+            if server.host == host and server.port == port:
+                return server
+        return None
+
+    def add_server(self, host, port, nickname):
+        server = Server(host, port, self.settings.tls_connection,
+                        nickname, self.settings.highlight_words)
+        # Benchmarks don't write to the chat log
+        if self.settings.keep_history and self.benchmark_scenario is None:
+            server.chatlog = ChatLog(host)
+        server.supervisor = ConnectionSupervisor(functools.partial(self.start_connection, server),
+                                                 functools.partial(self.send_ping, server),
+                                                 functools.partial(self.drop_connection, server))
+        self.servers.append(server)
+        return server
+
+    def add_channel(self, server, name):
+        channel = server.add_channel(name, self.settings.scrollback_lines)
+        channel.users.connect(functools.partial(self.on_membership_changed, channel))
+        self.channels_by_id[channel.id] = channel
+
+        label = Gtk.Label(xalign=0)
+        row = Gtk.ListBoxRow()
+        row.add(label)
+        row.show_all()
+        self.channel_list.add(row)
+        self.channel_rows[row] = channel
+        channel.sidebar_row = row
+        self.update_sidebar_row(channel)
+        self.sidebar.set_visible(len(self.channel_rows) > 1)
+        return channel
+
+    def update_sidebar(self):
+        for channel in self.channel_rows.values():
+            self.update_sidebar_row(channel)
+
+    def update_sidebar_row(self, channel):
+        markup = GLib.markup_escape_text(channel.name)
+        if channel.unread_count > 0:
+            markup = f"<b>{markup}</b> ({channel.unread_count})"
+        if len(self.servers) > 1:
+            markup += f"\n<small>{GLib.markup_escape_text(channel.server.host)}</small>"
+        channel.sidebar_row.get_child().set_markup(markup)
+
+    def on_channel_row_selected(self, listbox, row):
+        if row is not None:
+            self.switch_channel(self.channel_rows[row])
+
+    def switch_channel(self, channel):
+        if channel is self.current:
+            return
+        self.current = channel
+        channel.unread_count = 0
+        self.update_sidebar_row(channel)
+        self.channel_list.select_row(channel.sidebar_row)
+
+        self.user_treeview.set_model(channel.user_store)
+        self.tab_completion.reset()
+        self.builder.get_object("users_label").set_text(str(len(channel.users)))
+        self.builder.get_object("label_username").set_markup(channel.server.nickname)
+        self.update_lag_label()
+
+        self.scrollback_return_button.hide()
+        if self.webview_loaded:
+            self.run_javascript(f"showChannel({channel.id});")
+        self.render_html()
+        if self.search_bar.get_search_mode():
+            self.on_search_changed(self.search_entry)
+
+    # Creates the reactor and the connections, irc and the transports are only imported here
+    def start_networking(self):
+        import irc.client
+        import irc.events
+        from network import MainLoopQueue, NetworkWorker
+        from transport import GioServerConnection
+
+        # All the servers share a single reactor. Connections either run on the main loop
+        # through Gio, or (as a fallback) on a single network thread.
+        self.reactor = irc.client.Reactor()
+        self.glib_transport = self.settings.glib_transport
+        burst = self.settings.flood_burst
+        interval = self.settings.flood_interval / 1000
+        if self.glib_transport:
+            self.reactor.connection_class = GioServerConnection
+            self.network = MainLoopQueue(burst, interval)
+        else:
+            self.network = NetworkWorker(self.reactor, burst, interval)
+        self.settings.connect("changed::flood-burst", self.on_flood_control_changed)
+        self.settings.connect("changed::flood-interval", self.on_flood_control_changed)
+        self.settings.connect("changed::debug", self.on_debug_changed)
+        for server in self.servers:
+            server.connection = self.reactor.server()
+            self.servers_by_connection[server.connection] = server
+
+        self.reactor.add_global_handler("welcome", self.on_welcome)
+        self.reactor.add_global_handler("join", self.on_join)
+        self.reactor.add_global_handler("namreply", self.on_namreply)
+        self.reactor.add_global_handler("notice", self.on_notice)
+        self.reactor.add_global_handler("nick", self.on_nick)
+        self.reactor.add_global_handler("quit", self.on_quit)
+        self.reactor.add_global_handler("part", self.on_part)
+        self.reactor.add_global_handler("mode", self.on_mode)
+        self.reactor.add_global_handler("featurelist", self.on_featurelist)
+        self.reactor.add_global_handler("pubmsg", self.on_pubmsg)
+        self.reactor.add_global_handler("action", self.on_action)
+        self.reactor.add_global_handler("ctcp", self.on_ctcp)
+        self.reactor.add_global_handler("erroneusnickname", self.on_erroneusnickname)
+        self.reactor.add_global_handler("disconnect", self.on_disconnect)
+        self.reactor.add_global_handler("error", self.on_error)
+        self.reactor.add_global_handler("nicknameinuse", self.on_nicknameinuse)
+        self.reactor.add_global_handler("pong", self.on_pong)
+        self.reactor.add_global_handler("cap", self.on_cap)
+        self.reactor.add_global_handler("authenticate", self.on_authenticate)
+        self.reactor.add_global_handler("batch", self.on_batch)
+        self.reactor.add_global_handler("away", self.on_away)
+        self.reactor.add_global_handler("all_raw_messages", self.on_raw_message_received)
+        self.update_raw_logging()
+        # SASL replies (RPL_SASLSUCCESS, ERR_SASLFAIL...), by name if irc.events knows them
+        for code in ("903", "907"):
+            self.reactor.add_global_handler(irc.events.numeric.get(code, code), self.on_sasl_success)
+        for code in ("902", "904", "905", "906"):
+            self.reactor.add_global_handler(irc.events.numeric.get(code, code), self.on_sasl_failure)
+
+        # Benchmarks feed their own traffic, and the test mode doesn't connect at all
+        if self.benchmark is None and not os.environ.get("JARGONAUT_NO_SERVER_TEST", False):
+            self.connect_to_servers()
+            profiler.mark("connection started")
+
 #####################
 # IRC commands
 #####################
 
-    @_async
-    def connect_to_server(self):
+    def connect_to_servers(self):
+        for server in self.servers:
+            server.supervisor.connect()
+        self.network.start()
+
+    def start_connection(self, server):
+        server.reset_session()
+        self.network.send(server.connection, self.open_connection, server, cost=0)
+
+    # Called from the network thread, or from the main loop with the GLib transport
+    def open_connection(self, server):
+        certificate = self.get_client_certificate(server)
+        if self.glib_transport:
+            on_error = functools.partial(self.on_connection_failed, server)
+            try:
+                if certificate is not None:
+                    certificate = Gio.TlsCertificate.new_from_file(certificate)
+            except GLib.Error as e:
+                on_error(e.message)
+                return
+            on_socket_connected = functools.partial(self.on_socket_connected, server)
+            server.connection.connect_async(server.host, server.port, server.nickname, server.tls, on_socket_connected,
+                                            on_error, certificate)
+            return
+        import ssl
+        from irc.connection import Factory
+        from transport import CapFactory
         try:
-            if self.tls:
+            if server.tls:
                 context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
                 context.check_hostname = False
                 context.verify_mode = ssl.CERT_NONE
+                if certificate is not None:
+                    context.load_cert_chain(certificate)
                 factory = Factory(wrapper=context.wrap_socket)
-                self.client.connect(self.settings.get_string("server"),
-                                    self.settings.get_int("port"),
-                                    self.nickname, connect_factory=factory)
             else:
-                self.client.connect(self.settings.get_string("server"),
-                                    self.settings.get_int("port"),
-                                    self.nickname)
-            self.is_connected = True
-            self.client.start()
+                factory = Factory()
+            server.connection.connect(server.host, server.port, server.nickname, connect_factory=CapFactory(factory))
         except Exception as e:
-            self.show_error_status("xsi-dialog-error-symbolic", _("Error"), str(e))
-
-    @_async
-    def join_channels(self, connection):
-        connection.join(self.channel)
-        connection.names([self.channel])
+            self.on_connection_failed(server, str(e))
+            return
+        self.on_socket_connected(server)
 
-    @_async
-    def identify(self, connection):
-        username = self.settings.get_string("nickname")
-        password = self.settings.get_string("password")
+    # The server has REGISTRATION_TIMEOUT seconds to welcome us from now on
+    @idle
+    def on_socket_connected(self, server):
+        server.supervisor.on_socket_connected()
+
+    # The credentials in the settings are for the main server
+    def get_client_certificate(self, server):
+        path = self.settings.client_certificate
+        if server is not self.servers[0] or not server.tls or path == "":
+            return None
+        return path
+
+    def get_sasl_mechanism(self, server):
+        if server is not self.servers[0]:
+            return None
+        if self.get_client_certificate(server) is not None:
+            return "EXTERNAL"
+        if self.settings.nickname != "" and self.settings.password != "":
+            return "PLAIN"
+        return None
+
+    # Sends a raw command, i.e. one irc.client doesn't have a method for
+    def send_raw(self, server, command, cost=1):
+        connection = server.connection
+        self.network.send(connection, connection.send_raw, command, cost=cost)
+
+    def end_cap_negotiation(self, server):
+        if server.caps.negotiating:
+            server.caps.negotiating = False
+            self.send_raw(server, "CAP END", cost=0)
+
+    # Asks for the messages each channel missed while disconnected, newer ones wait until they arrive
+    def request_missed_history(self, server):
+        for channel in server.channels.values():
+            since = None
+            for message in reversed(channel.scrollback):
+                if message.action != "status":
+                    since = message.time
+                    break
+            if since is None:
+                continue
+            channel.pending_history = []
+            channel.history_since = since
+            self.send_raw(server, f"CHATHISTORY LATEST {channel.name} timestamp={format_server_time(since)} {HISTORY_LIMIT}")
+            GLib.timeout_add_seconds(HISTORY_TIMEOUT, self.on_missed_history_timeout, channel)
+
+    def send_ping(self, server, token):
+        connection = server.connection
+        self.network.send(connection, connection.ping, token, cost=0)
+
+    # Closes a connection which stopped responding, the supervisor then reconnects
+    def drop_connection(self, server, reason):
+        self.print_info(f"{server.host}: {reason}")
+        connection = server.connection
+        self.network.send(connection, connection.disconnect, reason, cost=0)
+
+    def join_channels(self, server):
+        connection = server.connection
+        for channel in server.channels.values():
+            self.network.send(connection, connection.join, channel.name)
+            self.network.send(connection, connection.names, [channel.name])
+
+    def identify(self, server):
+        username = self.settings.nickname
+        password = self.settings.password
         if username != "" and password != "":
             self.print_info(f"Identifying as {username}...")
-            connection.privmsg("Nickserv", f"IDENTIFY {username} {password}")
+            connection = server.connection
+            self.network.send(connection, connection.privmsg, "Nickserv", f"IDENTIFY {username} {password}")
 
-    @_async
-    def send_message(self, message):
+    def send_message(self, channel, message):
         message = message.replace('\x16', '\x1D')
-        self.client.connection.privmsg(self.channel, message)
+        server = channel.server
+        if not server.is_connected:
+            if len(server.outbox) == 0:
+                self.print_status(server, _("Not connected, messages will be sent once the connection is back."))
+            server.outbox.append((channel, message))
+            return
+        connection = server.connection
+        self.network.send(connection, connection.privmsg, channel.name, message)
+
+    # Sends the messages typed while the server was unreachable (after the JOINs, which are queued first)
+    def send_outbox(self, server):
+        while len(server.outbox) > 0:
+            channel, message = server.outbox.popleft()
+            self.send_message(channel, message)
 
-    @_async
     def disconnect(self):
-        try:
-            self.client.connection.disconnect(message=_("Jargonaut signing out!"))
-        except Exception as e:
-            print(e)
+        if self.network is None:
+            # Closed before the window was even drawn
+            return
+        for server in self.servers:
+            server.supervisor.stop()
+            if server.is_connected:
+                connection = server.connection
+                self.network.send(connection, connection.disconnect, _("Jargonaut signing out!"), cost=0)
+        self.network.stop()
+
+    def on_flood_control_changed(self, settings, key):
+        self.network.set_flood_control(self.settings.flood_burst, self.settings.flood_interval / 1000)
 
 #####################
 # IRC signal handlers
@@ -285,39 +635,55 @@ class App(Gtk.Application):
 
     @idle
     def on_welcome(self, connection, event):
-        self.join_channels(connection)
+        server = self.servers_by_connection[connection]
+        if not server.was_connected:
+            profiler.mark(f"connected to {server.host}")
+        server.is_connected = True
+        server.supervisor.on_connected()
+        if server.was_connected:
+            self.print_status(server, _("Reconnected to the server."))
+        reconnected = server.was_connected
+        server.was_connected = True
+        # In case the server didn't answer CAP LS
+        server.caps.negotiating = False
+        # The credentials in the settings are for the main server
+        if server is self.servers[0] and not server.sasl_authenticated:
+            self.identify(server)
+        self.join_channels(server)
+        if reconnected and server.caps.is_enabled("draft/chathistory"):
+            self.request_missed_history(server)
+        self.send_outbox(server)
 
     @idle
     def on_join(self, connection, event):
         self.print_info(f"Joined channel: target={event.target} source={event.source}")
+        server = self.servers_by_connection[connection]
         nick = event.source.nick
-        channel = event.target
-        if nick not in self.channel_users[channel]:
-            self.assign_color(nick)
-            self.channel_users[channel].append(nick)
-            self.update_users()
-        if nick == self.nickname:
-            self.builder.get_object("main_stack").set_visible_child_name("page_chat")
-            self.entry.grab_focus()
-            self.identify(connection)
+        channel = server.get_channel(event.target)
+        if channel is None:
+            channel = self.add_channel(server, event.target)
+            self.update_sidebar()
+        if nick == server.nickname:
+            # Joined again after a reconnection, the NAMES reply brings the user list up to date
+            channel.users.clear()
+        if nick not in channel.users:
+            channel.users.add(nick)
+        if nick == server.nickname:
+            if channel is self.current:
+                self.builder.get_object("main_stack").set_visible_child_name("page_chat")
+                self.entry.grab_focus()
         else:
-            message = Message(nick, None, "join")
-            self.messages.append(message)
-            self.render_html()
+            message = Message(nick, None, "join", timestamp=self.get_event_time(event))
+            self.add_message(channel, message)
+            self.render_html(channel)
 
     @idle
     def on_namreply(self, connection, event):
-        channel = event.arguments[1]
-        users = event.arguments[2].split()
-        for user in users:
-            for character in ["~", "&", "@", "%", "+"]:
-                if user.startswith(character):
-                    user = user[1:]
-                    break
-            self.assign_color(user)
-            if not user in self.channel_users[channel]:
-                self.channel_users[channel].append(user)
-        self.update_users()
+        channel = self.servers_by_connection[connection].get_channel(event.arguments[1])
+        if channel is None:
+            return
+        for name in event.arguments[2].split():
+            channel.users.add_prefixed(name)
 
     @idle
     def on_notice(self, connection, event):
@@ -326,101 +692,349 @@ class App(Gtk.Application):
     @idle
     def on_nick(self, connection, event):
         self.print_info(f"Nick: target={event.target} source={event.source}")
+        server = self.servers_by_connection[connection]
         old_nick = event.source.nick
         new_nick = event.target
-        if old_nick in self.channel_users[self.channel]:
-            self.channel_users[self.channel].remove(old_nick)
-        if not new_nick in self.channel_users[self.channel]:
-            self.channel_users[self.channel].append(new_nick)
-        if not new_nick in self.user_colors.keys():
-            self.assign_color(new_nick)
-        if old_nick == self.nickname:
-            self.nickname = new_nick
-            self.builder.get_object("label_username").set_markup(new_nick)
-        self.update_users()
-
-        if new_nick != self.nickname:
-            message = Message(new_nick, None, "nick", event.source.nick)
-            self.messages.append(message)
-            self.render_html()
+        if old_nick == server.nickname:
+            server.set_nickname(new_nick)
+            if server is self.current.server:
+                self.builder.get_object("label_username").set_markup(new_nick)
+
+        # A nick change applies to every channel the user is in
+        for channel in server.channels.values():
+            if channel.users.rename(old_nick, new_nick) is None:
+                continue
+            if new_nick != server.nickname:
+                message = Message(new_nick, None, "nick", event.source.nick, self.get_event_time(event))
+                self.add_message(channel, message)
+                self.render_html(channel)
 
     @idle
     def on_quit(self, connection, event):
         self.print_info(f"Quit: target={event.target} source={event.source}")
+        server = self.servers_by_connection[connection]
         nick = event.source.nick
-        channel = event.target
-        if nick in self.channel_users[self.channel]:
-            self.channel_users[self.channel].remove(nick)
-            self.update_users()
-
-        if nick != self.nickname:
-            message = Message(nick, None, "quit")
-            self.messages.append(message)
-            self.render_html()
+        for channel in server.channels.values():
+            if nick not in channel.users:
+                continue
+            channel.users.remove(nick)
+            if nick != server.nickname:
+                message = Message(nick, None, "quit", timestamp=self.get_event_time(event))
+                self.add_message(channel, message)
+                self.render_html(channel)
 
     @idle
     def on_part(self, connection, event):
         self.print_info(f"Part: target={event.target} source={event.source}")
+        server = self.servers_by_connection[connection]
         nick = event.source.nick
-        channel = event.target
-        if nick in self.channel_users[channel]:
-            self.channel_users[channel].remove(nick)
-            self.update_users()
-
-        if nick != self.nickname:
-            message = Message(nick, None, "quit")
-            self.messages.append(message)
-            self.render_html()
+        channel = server.get_channel(event.target)
+        if channel is None:
+            return
+        channel.users.remove(nick)
+
+        if nick != server.nickname:
+            message = Message(nick, None, "quit", timestamp=self.get_event_time(event))
+            self.add_message(channel, message)
+            self.render_html(channel)
+
+    @idle
+    def on_mode(self, connection, event):
+        import irc.modes
+        channel = self.servers_by_connection[connection].get_channel(event.target)
+        if channel is None:
+            return
+        # Only prefix modes (i.e. +o nick) matter here
+        prefixes = {mode: prefix for prefix, mode in connection.features.prefix.items()}
+        for sign, mode, argument in irc.modes.parse_channel_modes(" ".join(event.arguments)):
+            if mode in prefixes and argument is not None:
+                channel.users.set_mode(argument, prefixes[mode], sign == "+")
 
     @idle
+    def on_featurelist(self, connection, event):
+        casemapping = getattr(connection.features, "casemapping", "rfc1459")
+        self.servers_by_connection[connection].set_casemapping(casemapping)
+
+    # Called from whichever thread reads the connection, any traffic resets the ping timer
+    def on_raw_message_received(self, connection, event):
+        self.servers_by_connection[connection].supervisor.on_activity()
+
+    # Called from whichever thread reads the connection, the logger does the rest
     def on_all_raw_messages(self, connection, event):
-        if self.settings.get_boolean("debug"):
-            content = str(event.arguments)
-            self.print_info("Raw message: " + content)
-            # Actions (i.e. /me commands) are not received as PRIVMSGS or PUBMSGS
-            # only as RAW messages, so we need to handle them here
-            if f"PRIVMSG {self.channel}" in content:
-                if "\\x01ACTION" in content:
-                    nick = content.split("!")[0].split(":")[1]
-                    text = content.split("\\x01ACTION")[1].split("\\x01")[0]
-                    text = f"\x01ACTION{text}\x01"
-                    self.print_message(nick, text)
+        self.raw_logger.log(connection.server, event.arguments[0])
+
+    def on_debug_changed(self, settings, key):
+        self.update_raw_logging()
+
+    def update_raw_logging(self):
+        debug = self.settings.debug
+        if debug and self.raw_logger is None:
+            self.raw_logger = RawLogger()
+            self.raw_logger.start()
+            self.reactor.add_global_handler("all_raw_messages", self.on_all_raw_messages)
+        elif not debug and self.raw_logger is not None:
+            self.reactor.remove_global_handler("all_raw_messages", self.on_all_raw_messages)
+            self.raw_logger.stop()
+            self.raw_logger = None
 
     @idle
     def on_pubmsg(self, connection, event):
+        self.on_channel_message(connection, event, False)
+
+    # CTCP ACTION, i.e. /me
+    @idle
+    def on_action(self, connection, event):
+        import irc.client
+        if irc.client.is_channel(event.target):
+            self.on_channel_message(connection, event, True)
+
+    def on_channel_message(self, connection, event, is_action):
+        server = self.servers_by_connection[connection]
+        batch = server.batches.get(get_tag(event, "batch"))
+        if batch is not None and batch.type == "chathistory":
+            # Added all at once when the batch ends
+            batch.events.append(event)
+            return
+        channel = server.get_channel(event.target)
+        if channel is None:
+            return
+        if channel.pending_history is not None:
+            # Shown after the messages which were missed
+            channel.pending_history.append(event)
+            return
         nick = event.source.split('!')[0]
-        message = event.arguments[0]
-        self.print_message(nick, message)
+        message = event.arguments[0] if len(event.arguments) > 0 else ""
+        self.print_message(channel, nick, message, self.get_event_time(event), is_action)
+
+    # Other CTCP requests (ACTION is handled by on_action)
+    @idle
+    def on_ctcp(self, connection, event):
+        # Requests replayed from the history were answered (or not) when they were sent
+        if get_tag(event, "batch") is not None:
+            return
+        timestamp = self.get_event_time(event)
+        if timestamp is not None and time.time() - timestamp > CTCP_MAX_AGE:
+            return
+        request = event.arguments[0].upper()
+        nick = event.source.nick
+        if request == "VERSION":
+            reply = "VERSION Jargonaut"
+        elif request == "PING" and len(event.arguments) > 1:
+            reply = "PING " + event.arguments[1]
+        elif request == "TIME":
+            reply = "TIME " + time.strftime("%a %b %d %H:%M:%S %Y")
+        else:
+            return
+        self.print_info(f"CTCP {request} from {nick}")
+        self.network.send(connection, connection.ctcp_reply, nick, reply)
+
+    # With server-time, messages are timestamped by the server
+    def get_event_time(self, event):
+        return parse_server_time(get_tag(event, "time"))
+
+    @idle
+    def on_cap(self, connection, event):
+        server = self.servers_by_connection[connection]
+        caps = server.caps
+        subcommand = event.arguments[0].upper()
+        if subcommand in ("LS", "NEW"):
+            wanted = caps.on_ls(event.arguments)
+            if wanted is None:
+                return
+            if len(wanted) > 0:
+                self.send_raw(server, "CAP REQ :" + " ".join(wanted), cost=0)
+            elif subcommand == "LS":
+                self.end_cap_negotiation(server)
+            return
+        if subcommand == "ACK":
+            enabled = caps.on_ack(event.arguments[-1])
+            self.print_info(f"{server.host}: capabilities enabled: {' '.join(enabled)}")
+            if "sasl" in enabled and caps.negotiating and self.start_sasl(server):
+                return
+        elif subcommand == "NAK":
+            caps.on_nak(event.arguments[-1])
+        elif subcommand == "DEL":
+            caps.on_del(event.arguments[-1])
+        if len(caps.requested) == 0 and server.sasl_mechanism is None:
+            self.end_cap_negotiation(server)
+
+    def start_sasl(self, server):
+        mechanism = self.get_sasl_mechanism(server)
+        mechanisms = server.caps.get_sasl_mechanisms()
+        if mechanism is None or (mechanisms is not None and mechanism not in mechanisms):
+            return False
+        server.sasl_mechanism = mechanism
+        self.send_raw(server, f"AUTHENTICATE {mechanism}", cost=0)
+        return True
+
+    @idle
+    def on_authenticate(self, connection, event):
+        server = self.servers_by_connection[connection]
+        if event.target != "+" or server.sasl_mechanism is None:
+            return
+        if server.sasl_mechanism == "PLAIN":
+            payload = get_sasl_plain_payload(self.settings.nickname, self.settings.password)
+        else:
+            # EXTERNAL: the identity comes from the client certificate
+            payload = b""
+        for chunk in get_authenticate_chunks(payload):
+            self.send_raw(server, f"AUTHENTICATE {chunk}", cost=0)
+
+    @idle
+    def on_sasl_success(self, connection, event):
+        server = self.servers_by_connection[connection]
+        self.print_info(f"{server.host}: authenticated with SASL {server.sasl_mechanism}")
+        server.sasl_authenticated = True
+        server.sasl_mechanism = None
+        self.end_cap_negotiation(server)
+
+    @idle
+    def on_sasl_failure(self, connection, event):
+        server = self.servers_by_connection[connection]
+        self.print_info(f"{server.host}: SASL authentication failed: {' '.join(event.arguments)}")
+        # Falls back to identifying with NickServ once registered
+        server.sasl_mechanism = None
+        self.end_cap_negotiation(server)
+
+    @idle
+    def on_batch(self, connection, event):
+        server = self.servers_by_connection[connection]
+        reference = event.target
+        if reference is None or len(reference) < 2:
+            return
+        if reference[0] == "+":
+            batch_type = event.arguments[0] if len(event.arguments) > 0 else ""
+            server.batches[reference[1:]] = Batch(batch_type, event.arguments[1:])
+        elif reference[0] == "-":
+            batch = server.batches.pop(reference[1:], None)
+            if batch is None or batch.type != "chathistory" or len(batch.parameters) == 0:
+                return
+            channel = server.get_channel(batch.parameters[0])
+            if channel is not None and channel.pending_history is not None:
+                self.add_missed_history(channel, batch.events)
+
+    def on_missed_history_timeout(self, channel):
+        if channel.pending_history is not None:
+            self.print_info(f"No history received for {channel.name}")
+            self.add_missed_history(channel, [])
+        return False
+
+    # Adds the missed messages, then those which arrived in the meantime, and renders them at once
+    def add_missed_history(self, channel, events):
+        waiting = channel.pending_history
+        channel.pending_history = None
+        since = channel.history_since
+        # The first messages may be ones we already have (timestamps are only precise to the second)
+        known = set()
+        for message in reversed(channel.scrollback):
+            if message.time < since:
+                break
+            known.add((message.time, message.nick, message.text))
+
+        messages = []
+        for event in events:
+            message = self.message_from_event(event)
+            if message.time >= since and (message.time, message.nick, message.text) not in known:
+                messages.append(message)
+        n_missed = len(messages)
+        for event in waiting:
+            messages.append(self.message_from_event(event))
+
+        for message in messages:
+            self.prepare_message(channel, message)
+            self.add_message(channel, message)
+            channel.n_real_messages += 1
+        if len(messages) == 0:
+            return
+        self.print_info(f"{channel.name}: {n_missed} missed messages")
+        self.last_message_nick = messages[-1].nick
+        if channel is not self.current:
+            channel.unread_count += len(messages)
+            self.update_sidebar_row(channel)
+        for message in messages[n_missed:]:
+            self.notify_mention(message)
+        self.render_html(channel)
+
+    def message_from_event(self, event):
+        text = event.arguments[0] if len(event.arguments) > 0 else ""
+        return Message(event.source.nick, text, timestamp=self.get_event_time(event), is_action=event.type == "action")
+
+    @idle
+    def on_away(self, connection, event):
+        if "!" not in event.source:
+            # RPL_AWAY, a reply to a message sent to someone away
+            return
+        # away-notify: the message is the target, no message means back
+        server = self.servers_by_connection[connection]
+        for channel in server.channels.values():
+            channel.users.set_away(event.source.nick, event.target is not None)
 
     @idle
     def on_erroneusnickname(self, connection, event):
         self.print_info("Invalid nickname: %s" % event.arguments[0])
-        self.show_error_status("xsi-dialog-error-symbolic", _("Invalid nickname"), _("Your nickname was rejected. Restart the application to reset it."))
-        self.settings.set_string("nickname", "")
+        self.report_error(self.servers_by_connection[connection], _("Invalid nickname"), _("Your nickname was rejected. Restart the application to reset it."))
+        self.settings.set("nickname", "")
 
     @idle
     def on_disconnect(self, connection, event):
         self.print_info("Disconnected from server: %s" % event.target)
-        self.show_error_status("xsi-dialog-error-symbolic", _("Disconnected"), _("You have been disconnected from the server. Please try to reconnect."))
+        server = self.servers_by_connection[connection]
+        server.is_connected = False
+        delay = server.supervisor.on_disconnected()
+        if server is self.current.server:
+            self.update_lag_label()
+        for channel in server.channels.values():
+            if channel.pending_history is not None:
+                self.add_missed_history(channel, [])
+        if delay is not None:
+            self.show_reconnect_status(server, _("Disconnected"), _("You have been disconnected from the server."), delay)
+
+    @idle
+    def on_connection_failed(self, server, details):
+        self.print_info(f"Could not connect to {server.host}: {details}")
+        delay = server.supervisor.on_disconnected()
+        if delay is not None:
+            self.show_reconnect_status(server, _("Error"), details, delay)
 
     @idle
     def on_error(self, connection, event):
         self.print_info("Error from server: %s" % event.arguments[0])
-        self.show_error_status("xsi-dialog-error-symbolic", _("Error"), _("An error occurred: ") + event.arguments[0])
+        self.print_status(self.servers_by_connection[connection], _("An error occurred: ") + event.arguments[0])
+
+    @idle
+    def on_pong(self, connection, event):
+        server = self.servers_by_connection[connection]
+        if len(event.arguments) > 0 and server.supervisor.on_pong(event.arguments[-1]) is not None:
+            if server is self.current.server:
+                self.update_lag_label()
 
     @idle
     def on_nicknameinuse(self, connection, event):
-        self.nickname =  self.get_new_nickname(with_random_suffix=True)
-        self.assign_color(self.nickname)
-        connection.nick(self.nickname)
-        self.print_info(f"Nickname in use, switching to '{self.nickname}'")
-        self.builder.get_object("label_username").set_markup(self.nickname)
+        server = self.servers_by_connection[connection]
+        nickname = self.get_new_nickname(with_random_suffix=True)
+        server.set_nickname(nickname)
+        self.network.send(connection, connection.nick, nickname)
+        self.print_info(f"Nickname in use, switching to '{nickname}'")
+        if server is self.current.server:
+            self.builder.get_object("label_username").set_markup(nickname)
 
 ##################
 # UI IRC functions
 ##################
 
     def render_if_current(self):
+        if not self.webview_loaded:
+            # on_load_changed() calls us back once the page is ready
+            return
+        channel = self.current
+        if not channel.rendered:
+            self.render_channel(channel)
+            return
+        if self.position_query_pending:
+            # Check again once the current query is done
+            channel.render_dirty = True
+            return
+        self.position_query_pending = True
         script = """
             ({
                 page_height:      document.body.scrollHeight,
@@ -428,163 +1042,647 @@ class App(Gtk.Application):
                 viewport_height:  window.innerHeight
             });
         """
-        self.webview.evaluate_javascript(script, -1, None, None, None, self.on_position_query_finished)
+        self.webview.evaluate_javascript(script, -1, None, None, None, self.on_position_query_finished, channel)
 
-    def on_position_query_finished(self, webview, result, user_data=None):
+    def on_position_query_finished(self, webview, result, channel):
+        self.position_query_pending = False
+        if self.current.render_dirty:
+            self.render_scheduler.schedule()
         jscvalue = webview.evaluate_javascript_finish(result)
+        if channel is not self.current:
+            # The user switched channels in the meantime, and that triggered another render
+            return
         if jscvalue is not None and jscvalue.is_object():
             page_height = jscvalue.object_get_property("page_height").to_double()
             current_position = jscvalue.object_get_property("current_position").to_double()
             viewport_height = jscvalue.object_get_property("viewport_height").to_double()
 
-            if current_position + viewport_height >= page_height - 10:
+            if current_position + viewport_height >= page_height - 10 and channel.search_hit_seq is None:
                 self.scrollback_return_button.hide()
-                self.scrollback_queue_start_count = 0
-                self._real_render_html()
+                channel.scrollback_queue_start_count = 0
+                self.append_new_messages(channel)
             else:
-                if self.scrollback_queue_start_count == 0 and self.messages[-1].action is None:
-                    self.scrollback_queue_start_count = self.n_real_messages - 1
+                last_message = channel.scrollback.get_last()
+                if channel.scrollback_queue_start_count == 0 and last_message is not None and last_message.action is None:
+                    channel.scrollback_queue_start_count = channel.n_real_messages - 1
 
-                    if self.separator_message is not None:
-                        self.messages.remove(self.separator_message)
+                    if channel.separator_seq is not None and channel.separator_seq <= channel.rendered_last_seq:
+                        self.run_javascript(f"removeSeparator({channel.id});")
 
-                    message = Message(None, None, separator=True)
-                     # We're already handling a message (which was already appended),
-                     # place this before it.
-                    self.messages.insert(-1, message)
-                    self.separator_message = message
+                    # We're already handling a message (which was already appended),
+                    # place the separator before it.
+                    channel.separator_seq = last_message.seq
 
-                queued_count = self.n_real_messages - self.scrollback_queue_start_count
+                queued_count = channel.n_real_messages - channel.scrollback_queue_start_count
                 if queued_count > 0:
                     self.scrollback_return_button.show()
                     button_text = gettext.ngettext(_("%d new message"), _("%d new messages"), queued_count) % (queued_count)
                     self.scrollback_return_button.set_label(button_text)
+                elif channel.search_hit_seq is not None:
+                    self.scrollback_return_button.set_label(_("Back to recent messages"))
+                    self.scrollback_return_button.show()
+        if self.benchmark is not None:
+            self.benchmark.on_render_flushed()
+
+    def on_load_changed(self, webview, load_event):
+        from gi.repository import WebKit2
+        if load_event == WebKit2.LoadEvent.FINISHED:
+            if not self.webview_loaded:
+                profiler.mark("webview loaded")
+            self.webview_loaded = True
+            self.run_javascript(f"showChannel({self.current.id});")
+            self.render_html()
+            if self.benchmark is not None and not self.benchmark.started:
+                self.benchmark.start()
+
+    def on_scrollback_requested(self, manager, result):
+        # The user scrolled to the top of the page, page in older messages,
+        # from memory first, then from the chat log.
+        value = result.get_js_value() if hasattr(result, "get_js_value") else result
+        channel = self.channels_by_id.get(value.to_int32())
+        if channel is None:
+            return
+        chatlog = channel.server.chatlog
+        messages = channel.scrollback.get_before(channel.rendered_first_seq, PAGE_SIZE)
+        if len(messages) > 0:
+            self.prepend_messages(channel, messages, len(messages) < PAGE_SIZE and chatlog is None)
+        elif chatlog is not None:
+            self.load_older_history(channel, self.get_first_rendered_message(channel))
+        else:
+            self.prepend_messages(channel, [], True)
+
+    def get_first_rendered_message(self, channel):
+        messages = channel.scrollback.get_before(channel.rendered_first_seq + 1, 1)
+        if len(messages) > 0 and messages[0].seq == channel.rendered_first_seq:
+            return messages[0]
+        # It's older than what's in memory
+        return channel.history_first_message
+
+    def prepend_messages(self, channel, messages, complete):
+        if len(messages) > 0:
+            channel.rendered_first_seq = messages[0].seq
+        # Older messages are grouped on their own, keep the state used for appending
+        last_nick, last_time, last_day = channel.render_last_nick, channel.render_last_time, channel.render_last_day
+        channel.render_last_nick = ""
+        channel.render_last_time = None
+        channel.render_last_day = None
+        fragments = self.render_messages(channel, messages)
+        channel.render_last_nick, channel.render_last_time, channel.render_last_day = last_nick, last_time, last_day
+        self.run_javascript(f"prependMessages({channel.id}, {json.dumps(fragments)}, {json.dumps(complete)});")
+
+    @_async
+    def load_older_history(self, channel, message):
+        if message is None:
+            before_time, before_id = int(time.time()) + 1, 0
+        elif message.log_id is None:
+            # Not written yet, try again on the next scroll
+            self.on_older_history_loaded(channel, None)
+            return
+        else:
+            before_time, before_id = message.time, message.log_id
+        rows = channel.server.chatlog.fetch_before(channel.name, before_time, before_id, PAGE_SIZE)
+        self.on_older_history_loaded(channel, rows)
+
+    @idle
+    def on_older_history_loaded(self, channel, rows):
+        if rows is None:
+            self.run_javascript(f"getContainer({channel.id}).loadingHistory = false;")
+            return
+        messages = [self.message_from_row(channel, row) for row in rows]
+        channel.scrollback.prepend(messages, min(channel.scrollback.get_first_seq(), channel.rendered_first_seq))
+        if len(messages) > 0:
+            channel.history_first_message = messages[0]
+        self.prepend_messages(channel, messages, len(messages) < PAGE_SIZE)
+
+    @idle
+    def on_recent_history_loaded(self, server, name, rows):
+        channel = server.get_channel(name)
+        if channel is None or len(rows) == 0:
+            return
+        messages = [self.message_from_row(channel, row) for row in rows]
+        channel.scrollback.prepend(messages, min(channel.scrollback.get_first_seq(), channel.rendered_first_seq))
+        channel.history_first_message = messages[0]
+        channel.rendered = False
+        self.render_html(channel)
+
+    def message_from_row(self, channel, row):
+        log_id, name, timestamp, nick, text, action, old_nick, is_action = row
+        message = Message(nick, text, action, old_nick, timestamp, bool(is_action))
+        message.log_id = log_id
+        self.prepare_message(channel, message)
+        return message
+
+    def on_search_changed(self, entry):
+        query = entry.get_text().strip()
+        if query == "" or self.current.server.chatlog is None:
+            self.on_search_finished(self.current, query, [])
+        else:
+            self.search(self.current, query)
+
+    def on_search_stopped(self, entry):
+        self.search_bar.set_search_mode(False)
+        self.entry.grab_focus()
+
+    @_async
+    def search(self, channel, query):
+        self.on_search_finished(channel, query, channel.server.chatlog.search(channel.name, query))
+
+    @idle
+    def on_search_finished(self, channel, query, rows):
+        if channel is not self.current or query != self.search_entry.get_text().strip():
+            # The query (or the channel) changed while it was running
+            return
+        for row in self.search_results_list.get_children():
+            row.destroy()
+        self.search_results = rows
+        use_24h = self.settings.timestamp_24h
+        for log_id, name, timestamp, nick, text, action, old_nick, is_action in rows:
+            text = GLib.markup_escape_text(strip_codes(text or "")[:200])
+            date = self.timestamps.get_date_time(timestamp, use_24h)
+            label = Gtk.Label(xalign=0)
+            label.set_line_wrap(True)
+            label.set_markup(f"<b>{GLib.markup_escape_text(nick or '')}</b>  <small>{date}</small>\n{text}")
+            self.search_results_list.add(label)
+        self.search_results_list.show_all()
+        self.search_results_window.set_visible(len(rows) > 0)
+
+    def on_search_result_activated(self, listbox, row):
+        self.load_search_hit(self.current, self.search_results[row.get_index()])
+
+    @_async
+    def load_search_hit(self, channel, row):
+        log_id, name, timestamp = row[0], row[1], row[2]
+        chatlog = channel.server.chatlog
+        rows = chatlog.fetch_before(name, timestamp, log_id, PAGE_SIZE // 2)
+        rows += chatlog.fetch_after(name, timestamp, log_id, PAGE_SIZE // 2)
+        self.on_search_hit_loaded(channel, log_id, rows)
 
-    def render_html(self):
-        self.render_if_current()
+    @idle
+    def on_search_hit_loaded(self, channel, log_id, rows):
+        messages = [self.message_from_row(channel, row) for row in rows]
+        if len(messages) == 0:
+            return
+        # Give them seqs below any other message, without adding them to the scrollback
+        channel.scrollback.prepend(messages, min(channel.scrollback.get_first_seq(), channel.rendered_first_seq) - 1)
+        for message in messages:
+            if message.log_id == log_id:
+                channel.search_hit_seq = message.seq
+        channel.history_first_message = messages[0]
+        channel.rendered_first_seq = messages[0].seq
+        channel.render_last_nick = ""
+        channel.render_last_time = None
+        channel.render_last_day = None
+        fragments = self.render_messages(channel, messages)
+        self.run_javascript(f"showSearchHit({channel.id}, {json.dumps(fragments)});")
+        if channel is self.current:
+            self.scrollback_return_button.set_label(_("Back to recent messages"))
+            self.scrollback_return_button.show()
+
+    def on_scrollback_limit_changed(self, settings, key):
+        for server in self.servers:
+            for channel in server.channels.values():
+                channel.scrollback.set_limit(self.settings.scrollback_lines)
+
+    def render_html(self, channel=None):
+        if channel is None:
+            channel = self.current
+        channel.render_dirty = True
+        # Other channels are rendered when the user switches to them
+        if channel is self.current:
+            self.render_scheduler.schedule()
+
+    def flush_render(self):
+        for server in self.servers:
+            for channel in server.channels.values():
+                if channel.users_dirty:
+                    channel.users_dirty = False
+                    self._real_update_users(channel)
+        if self.current.render_dirty:
+            self.current.render_dirty = False
+            self.render_if_current()
+        # Otherwise, the messages are appended once the position query is answered
+        if self.benchmark is not None and not self.position_query_pending:
+            self.benchmark.on_render_flushed()
+
+    def on_highlight_words_changed(self, settings, key):
+        for server in self.servers:
+            server.highlighter.set_words(self.settings.highlight_words)
+
+    def on_render_interval_changed(self, settings, key):
+        self.render_scheduler.set_interval(self.settings.render_interval)
+
+    def run_javascript(self, script):
+        # Everything is rendered again once the page is loaded
+        if not self.webview_loaded:
+            return
+        self.webview.evaluate_javascript(script, -1, None, None, None, None)
 
-    def _real_render_html(self):
-        messages_section = "<div>"
-        last_nick = ""
-        last_message_time = None
+    # Returns a (group_class, fragment) tuple. When group_class isn't None the
+    # fragment starts a new message group, otherwise it goes in the last one.
+    def render_message(self, channel, message):
         minutes_since_previous_message = 0
-        for message in self.messages:
-            if last_message_time is not None:
-                minutes_since_previous_message = get_span_minutes(message.time, last_message_time)
-            last_message_time = message.time
-            date = format_timespan(message.time, self.settings.get_boolean("timestamp-24h"))
-            mine = ""
-            response = ""
-            nickname = message.nick
-
-            if message.text is not None:
-                text = message.text
-                words = text.lower().split(" ")
-                if text.startswith("\x01ACTION") and text.endswith("\x01"):
-                    text = text.replace("\x01ACTION", "").replace("\x01", "")
-                    text = f"<i><-- {text}</i>"
-                if message.nick == self.nickname:
-                    mine = "mine"
-                elif self.nickname.lower() in words or (self.nickname+":").lower() in words or ("@"+self.nickname).lower() in words:
-                    response = "response"
-
-            if message.action is not None:
-                if message.action == "join":
-                    action_message = _(f"{nickname} joined the channel")
-                elif message.action == "quit":
-                    action_message = _(f"{nickname} left the channel")
-                elif message.action == "nick":
-                    action_message = _(f"{message.old_nick} is now {nickname}")
-
-                messages_section += f"""
-                    <div class="action">
-                        <div class="action-text">{action_message}</div>
-                    </div>
-                """
-            elif message.separator:
-                messages_section += f"""
-                    <hr class="solid">
-                """
-            elif message.nick == last_nick and minutes_since_previous_message < 5:
-                messages_section += f"""
-                        <div class="line {response}">{text}</div>
-                    """
-            else:
-                letter = nickname[0].upper()
-                color = self.user_colors[nickname]
-                messages_section += f"""
-                    </div>
-                    <div class="messages {mine}">
-                        <span class="avatar"><span style="background-color:{color}">{letter}</span></span>
-                        <div class="nick">{nickname}<span class="date">{date}</span></div>
-                        <div class="line {response}">{text}</div>
-                    """
-            # ignore parts/joins with respect to chat continuity
-            if message.action is None and not message.separator:
-                last_nick = message.nick
-
-        html = f"""
+        if channel.render_last_time is not None:
+            minutes_since_previous_message = get_span_minutes(message.time, channel.render_last_time)
+        channel.render_last_time = message.time
+        date = self.timestamps.get_time(message.time, self.settings.timestamp_24h)
+        mine = ""
+        response = ""
+        nickname = message.nick
+
+        if message.text is not None:
+            text = message.html
+            if message.nick == channel.server.nickname:
+                mine = "mine"
+            elif message.mention:
+                response = "response"
+
+        hit = ""
+        if message.seq == channel.search_hit_seq:
+            hit = "search-hit"
+
+        group_class = None
+        if message.action is not None:
+            if message.action == "join":
+                action_message = _(f"{nickname} joined the channel")
+            elif message.action == "quit":
+                action_message = _(f"{nickname} left the channel")
+            elif message.action == "nick":
+                action_message = _(f"{message.old_nick} is now {nickname}")
+            elif message.action == "status":
+                action_message = message.html
+
+            fragment = f"""
+                <div class="action {hit}">
+                    <div class="action-text">{action_message}</div>
+                </div>
+            """
+        elif message.nick == channel.render_last_nick and minutes_since_previous_message < 5:
+            fragment = f"""
+                <div class="line {response} {hit}" data-seq="{message.seq}">{text}</div>{message.preview}
+            """
+        else:
+            letter = nickname[0].upper()
+            color = get_nick_color(nickname)
+            group_class = f"messages {mine}"
+            fragment = f"""
+                <span class="avatar"><span style="background-color:{color}">{letter}</span></span>
+                <div class="nick">{nickname}<span class="date">{date}</span></div>
+                <div class="line {response} {hit}" data-seq="{message.seq}">{text}</div>{message.preview}
+            """
+        # ignore parts/joins with respect to chat continuity
+        if message.action is None:
+            channel.render_last_nick = message.nick
+
+        return (group_class, fragment)
+
+    def render_messages(self, channel, messages):
+        fragments = []
+        for message in messages:
+            day = self.timestamps.get_day(message.time)
+            if day != channel.render_last_day:
+                # Each day starts with a separator, and a new group
+                channel.render_last_day = day
+                channel.render_last_nick = ""
+                label = GLib.markup_escape_text(self.timestamps.get_day_label(day))
+                fragments.append(("day", f'<div class="day-separator" data-day="{day}"><span>{label}</span></div>'))
+            if message.seq == channel.separator_seq:
+                fragments.append((None, """
+                    <hr class="solid" id="separator">
+                """))
+            fragments.append(self.render_message(channel, message))
+        return fragments
+
+    def append_new_messages(self, channel):
+        # Only render what isn't in the DOM yet, the page is never reloaded here
+        last_seq = channel.scrollback.next_seq - 1
+        if channel.search_hit_seq is not None or last_seq - channel.rendered_first_seq + 1 > WINDOW_SIZE + PAGE_SIZE:
+            # Too many messages in the DOM (or the ones around a search result), only keep the most recent ones
+            self.render_channel(channel)
+            return
+        messages = channel.scrollback.get_after(channel.rendered_last_seq)
+        channel.rendered_last_seq = last_seq
+        fragments = self.render_messages(channel, messages)
+        self.run_javascript(f"appendMessages({channel.id}, {json.dumps(fragments)});")
+
+    # Replaces the content of the channel's container with its most recent messages
+    def render_channel(self, channel):
+        channel.render_last_nick = ""
+        channel.render_last_time = None
+        channel.render_last_day = None
+        channel.search_hit_seq = None
+        messages = channel.scrollback.get_before(channel.scrollback.next_seq, WINDOW_SIZE)
+        if len(messages) > 0:
+            channel.rendered_first_seq = messages[0].seq
+        else:
+            channel.rendered_first_seq = channel.scrollback.next_seq
+        channel.rendered_last_seq = channel.scrollback.next_seq - 1
+        channel.rendered = True
+        fragments = self.render_messages(channel, messages)
+        self.run_javascript(f"replaceMessages({channel.id}, {json.dumps(fragments)});")
+
+    def load_page(self):
+        # Full page load, only done at startup. The page starts empty,
+        # channels are rendered in their own container when they're shown.
+        for channel in self.channels_by_id.values():
+            channel.rendered = False
+
+        html = """
             <html>
             <head>
                 <link rel="stylesheet" type="text/css" href="webview.css">
+                <script>
+                    var currentChannel = null;
+
+                    // Each channel has its own container, with its own scroll position and paging state
+                    function getContainer(id) {
+                        var container = document.getElementById("messages-" + id);
+                        if (container === null) {
+                            container = document.createElement("div");
+                            container.id = "messages-" + id;
+                            container.style.display = "none";
+                            container.channelId = id;
+                            container.savedScrollTop = null;
+                            container.loadingHistory = false;
+                            container.historyComplete = false;
+                            document.getElementById("messages").appendChild(container);
+                        }
+                        return container;
+                    }
+                    function scrollToBottom(container) {
+                        if (container === currentChannel) {
+                            window.scrollTo(0, document.body.scrollHeight);
+                        } else {
+                            container.savedScrollTop = null;
+                        }
+                    }
+                    function showChannel(id) {
+                        if (currentChannel !== null) {
+                            currentChannel.savedScrollTop = document.body.scrollTop;
+                            currentChannel.style.display = "none";
+                        }
+                        currentChannel = getContainer(id);
+                        currentChannel.style.display = "block";
+                        if (currentChannel.savedScrollTop === null) {
+                            window.scrollTo(0, document.body.scrollHeight);
+                        } else {
+                            window.scrollTo(0, currentChannel.savedScrollTop);
+                        }
+                    }
+                    function buildGroups(container, fragments) {
+                        for (var i = 0; i < fragments.length; i++) {
+                            if (fragments[i][0] !== null || container.lastElementChild === null) {
+                                var group = document.createElement("div");
+                                if (fragments[i][0] !== null) {
+                                    group.className = fragments[i][0];
+                                }
+                                container.appendChild(group);
+                            }
+                            container.lastElementChild.insertAdjacentHTML("beforeend", fragments[i][1]);
+                        }
+                    }
+                    function appendMessages(id, fragments) {
+                        var container = getContainer(id);
+                        buildGroups(container, fragments);
+                        scrollToBottom(container);
+                    }
+                    function replaceMessages(id, fragments) {
+                        var container = getContainer(id);
+                        container.innerHTML = "";
+                        buildGroups(container, fragments);
+                        container.historyComplete = false;
+                        scrollToBottom(container);
+                    }
+                    function prependMessages(id, fragments, complete) {
+                        var container = getContainer(id);
+                        var older = document.createElement("div");
+                        buildGroups(older, fragments);
+                        // Keep what the user is looking at in place
+                        var height = document.body.scrollHeight;
+                        while (older.lastElementChild !== null) {
+                            container.insertBefore(older.lastElementChild, container.firstChild);
+                        }
+                        removeRepeatedDays(container);
+                        if (container === currentChannel) {
+                            window.scrollBy(0, document.body.scrollHeight - height);
+                        }
+                        container.historyComplete = complete;
+                        container.loadingHistory = false;
+                    }
+                    // Older messages may end on the day the newer ones started with
+                    function removeRepeatedDays(container) {
+                        var lastDay = null;
+                        container.querySelectorAll(".day-separator").forEach(function(separator) {
+                            if (separator.dataset.day === lastDay) {
+                                separator.remove();
+                            }
+                            lastDay = separator.dataset.day;
+                        });
+                    }
+                    function showSearchHit(id, fragments) {
+                        var container = getContainer(id);
+                        container.innerHTML = "";
+                        buildGroups(container, fragments);
+                        container.historyComplete = false;
+                        container.loadingHistory = false;
+                        var hit = container.querySelector(".search-hit");
+                        if (hit !== null && container === currentChannel) {
+                            hit.scrollIntoView({block: "center"});
+                        }
+                    }
+                    function addPreview(id, seq, preview) {
+                        var container = getContainer(id);
+                        var line = container.querySelector('[data-seq="' + seq + '"]');
+                        if (line === null) {
+                            return;
+                        }
+                        var atBottom = window.innerHeight + document.body.scrollTop >= document.body.scrollHeight - 20;
+                        line.insertAdjacentHTML("afterend", preview);
+                        if (atBottom && container === currentChannel) {
+                            scrollToBottom(container);
+                        }
+                    }
+                    function removeSeparator(id) {
+                        var separator = getContainer(id).querySelector("#separator");
+                        if (separator !== null) {
+                            separator.remove();
+                        }
+                    }
+                    window.addEventListener("scroll", function() {
+                        var container = currentChannel;
+                        if (container !== null && document.body.scrollTop < 200 && !container.loadingHistory && !container.historyComplete) {
+                            container.loadingHistory = true;
+                            window.webkit.messageHandlers.scrollback.postMessage(container.channelId);
+                        }
+                    });
+                </script>
             </head>
             <body>
-                {messages_section}
+                <div id="messages">
                 </div>
-                <script>
-                    window.scrollTo(0, document.body.scrollHeight);
-                </script>
             </body>
             </html>
         """
 
+        self.webview_loaded = False
         self.webview.load_html(html, "file:///usr/share/jargonaut/")
 
     @idle
-    def print_message(self, nick, text):
-        # Escape any tags, i.e. show exactly what people typed, don't let Webkit interpret it.
-        text = html.escape(text)
-        # Format text (IRC codes -> pango/HTML)
-        text = re.sub(r'\x02(.*?)\x02', r'<b>\1</b>', text)
-        text = re.sub(r'\x16(.*?)\x16', r'<i>\1</i>', text)
-        text = re.sub(r'\x1D(.*?)\x1D', r'<i>\1</i>', text)
-        text = re.sub(r'\x1F(.*?)\x1F', r'<u>\1</u>', text)
-        text = re.sub(r'\x1E(.*?)\x1E', r'<s>\1</s>', text)
-        # Convert URLs to clickable links
-        url_pattern = r'((http[s]?://[^\s]{3,}\.[^\s]{2,}))'
-        def repl(match):
-            url = match.group(1)
-            if url.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.svg', '.bmp', '.webp')):
-                return f'<a href="{url}"><img class="thumb" src="{url}" title="{url}"/></a>'
-            else:
-                return f'<a href="{url}">{url}</a>'
-        text = re.sub(url_pattern, repl, text)
-
-        message = Message(nick, text)
-        self.messages.append(message)
-        self.n_real_messages += 1
-        self.render_html()
+    def print_message(self, channel, nick, text, timestamp=None, is_action=False):
+        message = Message(nick, text, timestamp=timestamp, is_action=is_action)
+        self.prepare_message(channel, message)
+        self.add_message(channel, message)
+        channel.n_real_messages += 1
+        self.render_html(channel)
+        self.request_link_preview(channel, message)
         self.last_message_nick = nick
+        channel.completer.on_message(nick)
+        if channel is not self.current:
+            channel.unread_count += 1
+            self.update_sidebar_row(channel)
+        self.notify_mention(message)
+
+    # Previews are fetched in the background and patched into the message once they're known
+    def request_link_preview(self, channel, message):
+        if not self.settings.link_previews:
+            return
+        links = find_links(message.text)
+        if len(links) > 0:
+            if self.link_previewer is None:
+                from linkpreview import LinkPreviewer
+                self.link_previewer = LinkPreviewer()
+            self.link_previewer.request(links[0], functools.partial(self.on_link_preview, channel, message, links[0]))
+
+    def on_link_preview(self, channel, message, url, preview):
+        from linkpreview import format_preview
+        fragment = format_preview(url, preview)
+        if fragment is None:
+            return
+        message.preview = fragment
+        if channel.rendered and message.seq <= channel.rendered_last_seq:
+            self.run_javascript(f"addPreview({channel.id}, {message.seq}, {json.dumps(fragment)});")
 
-        words = text.lower().split(" ")
-        if self.nickname.lower() in words or (self.nickname+":").lower() in words or ("@"+self.nickname).lower() in words:
+    def notify_mention(self, message):
+        if message.mention:
             if not self.is_window_focused():
                 self.tray.set_icon_name("jargonaut-status-msg-symbolic")
-                title = _("Message from %s") % message.nick
-                self.send_notification(title, text)
+                self.notifications.add_mention(message.nick, message.html)
 
-    @idle
-    def update_users(self):
-        self.user_store.clear()
-        users = self.channel_users[self.channel]
-        self.builder.get_object("users_label").set_text(str(len(users)))
-        for user in users:
-            self.user_store.append([self.get_nick_markup(user), user])
+    # Computes the fields used for rendering, once, when the message comes in
+    def prepare_message(self, channel, message):
+        if message.text is None:
+            return
+        # Escape any tags, i.e. show exactly what people typed, don't let Webkit interpret it,
+        # and convert IRC formatting codes and URLs to HTML.
+        text = format_irc(message.text)
+        if message.is_action:
+            text = f"<i><-- {text}</i>"
+        message.html = text
+        if message.action is not None:
+            return
+        server = channel.server
+        message.mention = message.nick != server.nickname and server.highlighter.matches(message.text)
+
+    def add_message(self, channel, message):
+        channel.scrollback.append(message)
+        # Status lines (i.e. "Disconnected...") only matter to the current session
+        if channel.server.chatlog is not None and message.action != "status":
+            channel.server.chatlog.write(channel.name, message)
+
+    def on_membership_changed(self, channel, event, member, old_nick):
+        nick = member.nick if member is not None else None
+        channel.pending_user_changes.append((event, nick, old_nick))
+        self.update_users(channel)
+
+    def update_users(self, channel):
+        channel.users_dirty = True
+        self.render_scheduler.schedule()
+
+    def _real_update_users(self, channel):
+        users = channel.users
+        changes = channel.pending_user_changes
+        channel.pending_user_changes = []
+        store = channel.user_store
+        shown = channel is self.current
+        if shown:
+            self.builder.get_object("users_label").set_text(str(len(users)))
+
+        bulk = len(changes) > USER_LIST_BULK_THRESHOLD
+        if bulk:
+            # Detach the sorted model while a big batch (i.e. a NAMES reply) is applied,
+            # so the views don't re-sort and re-filter after every row.
+            if shown:
+                self.user_treeview.set_model(None)
+            store.set_sort_column_id(Gtk.TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID, Gtk.SortType.ASCENDING)
+
+        for event, nick, old_nick in changes:
+            if event == "add":
+                key = users.get_key(nick)
+                if key not in channel.user_iters:
+                    channel.user_iters[key] = store.append([self.get_member_markup(users, nick), nick])
+            elif event == "remove":
+                iter = channel.user_iters.pop(users.get_key(nick), None)
+                if iter is not None:
+                    store.remove(iter)
+            elif event == "rename":
+                iter = channel.user_iters.pop(users.get_key(old_nick), None)
+                if iter is not None:
+                    store.set(iter, [0, 1], [self.get_member_markup(users, nick), nick])
+                    channel.user_iters[users.get_key(nick)] = iter
+            elif event == "modes":
+                iter = channel.user_iters.get(users.get_key(nick))
+                if iter is not None:
+                    store.set_value(iter, 0, self.get_member_markup(users, nick))
+            elif event == "clear":
+                store.clear()
+                channel.user_iters.clear()
+
+        if bulk:
+            store.set_sort_column_id(1, Gtk.SortType.ASCENDING)
+            if shown:
+                self.user_treeview.set_model(store)
+
+    # The nick with its highest prefix (i.e. "@"), dimmed when the user is away
+    def get_member_markup(self, users, nick):
+        member = users.get(nick)
+        if member is None:
+            return get_nick_markup(nick)
+        return get_nick_markup(nick, member.away, member.get_prefix())
 
     @idle
     def print_info(self, message):
         print("Info: " + message)
 
+    # Shows a connection status line in every channel of a server
+    def print_status(self, server, text):
+        for channel in server.channels.values():
+            message = Message(None, text, "status")
+            self.prepare_message(channel, message)
+            self.add_message(channel, message)
+            self.render_html(channel)
+
+    # Until the server was connected once, the chat isn't shown and errors go to the status page
+    def show_reconnect_status(self, server, message, details, delay):
+        retry = _("Reconnecting in %d seconds...") % round(delay)
+        if server.was_connected:
+            self.print_status(server, f"{details} {retry}")
+        else:
+            self.report_error(server, message, f"{details}\n{retry}")
+
+    def update_lag_label(self):
+        lag = self.current.server.supervisor.lag
+        label = self.builder.get_object("label_username")
+        if lag is None:
+            label.set_tooltip_text(None)
+        else:
+            label.set_tooltip_text(_("Lag: %d ms") % round(lag * 1000))
+
+    # Errors on the main server replace the chat, the other servers only log them
+    def report_error(self, server, message, details):
+        if server is self.servers[0]:
+            self.show_error_status("xsi-dialog-error-symbolic", message, details)
+        else:
+            self.print_info(f"{server.host}: {message}: {details}")
+
     @idle
     def show_error_status(self, icon_name, message, details):
         self.builder.get_object("main_stack").set_visible_child_name("page_status")
@@ -597,6 +1695,7 @@ class App(Gtk.Application):
 ###############
 
     def on_decide_policy(self, view, decision, decision_type):
+        from gi.repository import WebKit2
         if decision_type == WebKit2.PolicyDecisionType.NAVIGATION_ACTION:
             navigation_action = decision.get_navigation_action()
             if navigation_action.get_mouse_button() == 0:
@@ -609,27 +1708,23 @@ class App(Gtk.Application):
 
     def on_scrollback_return_button_clicked(self, widget):
         self.scrollback_return_button.hide()
-        self.scrollback_queue_start_count = 0
-        self._real_render_html()
+        self.current.scrollback_queue_start_count = 0
+        self.append_new_messages(self.current)
 
     def close_window(self, window, event):
         window.hide()
         return True
 
-    def send_notification(self, title, text):
-        # We use self.notification (instead of just a variable) to keep a memory pointer
-        # on the notification. Without doing this, callbacks are never executed by Gtk/Notify.
-        self.notification = Notify.Notification.new(title, text, "jargonaut-status-msg-symbolic")
-        self.notification.set_urgency(2)
-        self.notification.set_timeout(Notify.EXPIRES_NEVER)
-        self.notification.connect("closed", self.on_notification_closed)
-        self.notification.show()
-
-    def on_notification_closed(self, notification):
+    def on_notification_activated(self):
         self.tray.set_icon_name("jargonaut-status-normal-symbolic")
         self.window.show()
         self.window.present()
 
+    def on_window_focused(self, window, event):
+        # The mentions are on screen now
+        self.notifications.clear()
+        return False
+
     def on_tray_quit(self, widget):
         self.quit()
 
@@ -648,7 +1743,7 @@ class App(Gtk.Application):
 
     def on_users_button_clicked(self, widget):
         visible = self.user_list_box.get_visible()
-        self.settings.set_boolean("user-list-visible", not visible)
+        self.settings.set("user-list-visible", not visible)
         self.user_list_box.set_visible(not visible)
 
     def on_tray_activated(self, icon, button, time):
@@ -661,19 +1756,36 @@ class App(Gtk.Application):
                 self.window.present_with_time(time)
 
     def update_hw_acceleration(self, active):
+        if self.webview is not None:
+            self.apply_hw_acceleration(active)
+        self.show_restart_infobar()
+
+    def apply_hw_acceleration(self, active):
+        from gi.repository import WebKit2
         settings = self.webview.get_settings()
         if active:
             policy = WebKit2.HardwareAccelerationPolicy.ALWAYS
         else:
             policy = WebKit2.HardwareAccelerationPolicy.NEVER
         settings.set_hardware_acceleration_policy(policy)
-        self.show_restart_infobar()
 
     @idle
     def update_dark_mode(self, active):
         Gtk.Settings.get_default().set_property("gtk-application-prefer-dark-theme", active)
 
     def update_timestamp_format(self, active):
+        # Every timestamp changes
+        self.render_all_channels()
+
+    # "Today" and "Yesterday" moved
+    def on_day_changed(self):
+        self.render_all_channels()
+
+    def render_all_channels(self):
+        self.scrollback_return_button.hide()
+        for channel in self.channels_by_id.values():
+            channel.scrollback_queue_start_count = 0
+            channel.rendered = False
         self.render_html()
 
     def show_restart_infobar(self, *args, **kargs):
@@ -689,47 +1801,27 @@ class App(Gtk.Application):
         position = widget.get_position()
         text = widget.get_text()
         if keyname == "Tab":
-            if " " in text:
-                return True
-            if text == "":
-                return True
-            completion = widget.get_completion()
-            model = completion.get_model()
-            if len(model) > 0:
-                num_matches = 0
-                for row in model:
-                    if row[1].startswith(text):
-                        num_matches += 1
-                if num_matches > 0:
-                    # Adding prefix
-                    completion.insert_prefix()
-                    if num_matches == 1:
-                        # Adding suffix (cause single match)
-                        widget.set_text(text + ": ")
-                    elif self.last_key_press_is_tab:
-                        # Adding suffix (cause double tab)
-                        widget.set_text(text + ": ")
-                widget.set_position(-1)
-                self.last_key_press_is_tab = True
+            channel = self.current
+            completed = self.tab_completion.complete(channel.completer, text, position, channel.server.nickname)
+            if completed is not None:
+                widget.set_text(completed[0])
+                widget.set_position(completed[1])
             return True  # Stop propagation of the event
-        else:
-            self.last_key_press_is_tab = False
+        elif keyname not in ("Shift_L", "Shift_R"):
+            self.tab_completion.reset()
         if keyname == "Return" or keyname == "KP_Enter":
             message = text.strip()
             if message != "":
-                completion = widget.get_completion()
-                widget.set_completion(None)
                 widget.set_text("")
-                widget.set_completion(completion)
+                channel = self.current
+                nickname = channel.server.nickname
                 if message.startswith("/me "):
-                    local_msg = message.replace("/me ", self.nickname + " ", 1)
-                    remote_msg = message.replace("/me ", " ", 1)
-                    remote_msg = f"\x01ACTION{remote_msg}\x01"
-                    self.print_message(self.nickname, local_msg)
-                    self.send_message(remote_msg)
+                    action = message[len("/me "):]
+                    self.print_message(channel, nickname, action, is_action=True)
+                    self.send_message(channel, f"\x01ACTION {action}\x01")
                 else:
-                    self.print_message(self.nickname, message)
-                    self.send_message(message)
+                    self.print_message(channel, nickname, message)
+                    self.send_message(channel, message)
 
             return True
         elif ctrl and keyname == "b":
@@ -758,10 +1850,21 @@ class App(Gtk.Application):
         Gtk.Application.do_startup(self)
 
     def do_shutdown(self):
-        if self.is_connected:
-            self.disconnect()
+        if self.settings.debug:
+            scheduler = self.render_scheduler
+            print(f"Render requests: {scheduler.n_requests}, flushes: {scheduler.n_flushes}, coalesced: {scheduler.get_coalesced_count()}")
+        for server in self.servers:
+            if server.chatlog is not None:
+                server.chatlog.close()
+        self.disconnect()
+        if self.raw_logger is not None:
+            self.raw_logger.stop()
+        if self.thumbnails is not None:
+            self.thumbnails.shutdown()
+        if self.link_previewer is not None:
+            self.link_previewer.shutdown()
 
         Gtk.Application.do_shutdown(self)
 
 app = App()
-app.run()
\ No newline at end of file
+app.run(sys.argv)
\ No newline at end of file
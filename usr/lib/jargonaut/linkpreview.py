@@ -0,0 +1,270 @@
+import collections
+import concurrent.futures
+import html
+import html.parser
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+from gi.repository import GLib
+from formatting import get_thumbnail_uri
+from ui import idle
+
+# Number of pages fetched at once, in total and per host
+MAX_WORKERS = 4
+MAX_PER_HOST = 2
+FETCH_TIMEOUT = 10
+# Only the beginning of a page is read, the metadata is in its <head>
+MAX_READ_SIZE = 256 * 1024
+# How long previews are cached (in seconds), pages without any metadata are retried sooner
+CACHE_TTL = 7 * 24 * 3600
+EMPTY_CACHE_TTL = 3600
+# Maximum length of the description shown under the title
+MAX_DESCRIPTION_LENGTH = 300
+# Number of previews kept in memory, the least recently used ones are dropped first
+MAX_PREVIEWS = 500
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS previews (
+        url TEXT PRIMARY KEY,
+        time INTEGER NOT NULL,
+        title TEXT,
+        description TEXT,
+        site_name TEXT,
+        image TEXT
+    );
+"""
+
+FIELDS = ("title", "description", "site_name", "image")
+
+def get_cache_path():
+    return os.path.join(GLib.get_user_cache_dir(), "jargonaut", "previews.db")
+
+class EndOfHead(Exception):
+    pass
+
+# Collects the title and OpenGraph metadata of a page, up to the end of its <head>
+class MetadataParser(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.metadata = {}
+        self.title = ""
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self.in_title = True
+        elif tag == "meta":
+            attributes = dict(attrs)
+            key = attributes.get("property") or attributes.get("name") or ""
+            content = attributes.get("content")
+            if content is None:
+                return
+            key = key.lower()
+            if key.startswith("og:") and key[3:] in FIELDS:
+                self.metadata.setdefault(key[3:], content.strip())
+            elif key == "description":
+                self.metadata.setdefault("description", content.strip())
+        elif tag == "body":
+            raise EndOfHead()
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag == "head":
+            raise EndOfHead()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+
+# Returns the preview fields (title, description, site_name, image) found in a page
+def parse_metadata(text, url):
+    parser = MetadataParser()
+    try:
+        parser.feed(text)
+        parser.close()
+    except EndOfHead:
+        pass
+    metadata = parser.metadata
+    if "title" not in metadata and parser.title.strip() != "":
+        metadata["title"] = " ".join(parser.title.split())
+    if "image" in metadata:
+        metadata["image"] = urllib.parse.urljoin(url, metadata["image"])
+    return metadata
+
+def format_preview(url, preview):
+    title = preview.get("title")
+    if not title:
+        return None
+    escaped_url = html.escape(url)
+    parts = ['<div class="preview">']
+    image = preview.get("image")
+    if image and image.lower().startswith(("http://", "https://")):
+        parts.append(f'<img class="preview-image" loading="lazy" src="{html.escape(get_thumbnail_uri(image))}"/>')
+    if preview.get("site_name"):
+        parts.append(f'<div class="preview-site">{html.escape(preview["site_name"])}</div>')
+    parts.append(f'<a class="preview-title" href="{escaped_url}">{html.escape(title)}</a>')
+    description = preview.get("description")
+    if description:
+        if len(description) > MAX_DESCRIPTION_LENGTH:
+            description = description[:MAX_DESCRIPTION_LENGTH].rstrip() + "…"
+        parts.append(f'<div class="preview-description">{html.escape(description)}</div>')
+    parts.append('</div>')
+    return "".join(parts)
+
+# Previews fetched before, in an SQLite database shared by all channels and servers
+class PreviewCache():
+    def __init__(self, path):
+        self.path = path
+        self.created = False
+
+    def connect(self):
+        if not self.created:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        if not self.created:
+            connection.executescript(SCHEMA)
+            # Forget the expired previews
+            with connection:
+                connection.execute("DELETE FROM previews WHERE time < ?", (int(time.time()) - CACHE_TTL,))
+            self.created = True
+        return connection
+
+    # Returns the cached preview (a dict, empty if the page had no metadata), or None
+    def get(self, url):
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT time, title, description, site_name, image FROM previews WHERE url = ?",
+                                     (url,)).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        preview = {key: value for key, value in zip(FIELDS, row[1:]) if value is not None}
+        ttl = CACHE_TTL if len(preview) > 0 else EMPTY_CACHE_TTL
+        if row[0] < time.time() - ttl:
+            return None
+        return preview
+
+    def put(self, url, preview):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO previews (url, time, title, description, site_name, image) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)",
+                                   (url, int(time.time())) + tuple(preview.get(key) for key in FIELDS))
+        finally:
+            connection.close()
+
+# Fetches link previews in the background. Each URL is fetched once, whoever asks for it,
+# by a bounded pool of workers which also limits the number of requests per host.
+# URLs of a host which is already busy wait in a queue, not in a worker.
+class LinkPreviewer():
+    def __init__(self):
+        self.cache = PreviewCache(get_cache_path())
+        self.cache_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        # Number of requests in progress and URLs waiting for them, by host (only for busy hosts)
+        self.host_fetches = {}
+        self.host_queues = {}
+        self.host_lock = threading.Lock()
+        # Previews recently used in this session, keyed by URL, the most recent last
+        self.previews = collections.OrderedDict()
+        # Callbacks waiting for a URL which is being fetched
+        self.pending = {}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Calls callback(preview) with the preview of url (from the main loop), unless there's none
+    def request(self, url, callback):
+        if url in self.previews:
+            self.previews.move_to_end(url)
+            if len(self.previews[url]) > 0:
+                callback(self.previews[url])
+            return
+        if url in self.pending:
+            self.pending[url].append(callback)
+            return
+        self.pending[url] = [callback]
+        self.executor.submit(self.load, url)
+
+    # Runs in the executor, the SQLite cache is shared by the workers (hence the lock)
+    def load(self, url):
+        preview = None
+        try:
+            with self.cache_lock:
+                preview = self.cache.get(url)
+        except (sqlite3.Error, OSError) as e:
+            print("Link preview cache unavailable:", e)
+        if preview is None:
+            host = urllib.parse.urlsplit(url).hostname or ""
+            if not self.acquire_host(host, url):
+                # Loaded again once a request to that host ends
+                return
+            try:
+                preview = self.fetch(url)
+            except Exception as e:
+                print(f"Could not fetch a preview of {url}:", e)
+                preview = {}
+            finally:
+                self.release_host(host)
+            try:
+                with self.cache_lock:
+                    self.cache.put(url, preview)
+            except (sqlite3.Error, OSError) as e:
+                print("Could not cache the link preview:", e)
+        self.on_loaded(url, preview)
+
+    # Returns True if a request to host can start now, otherwise queues url for later
+    def acquire_host(self, host, url):
+        with self.host_lock:
+            n_fetches = self.host_fetches.get(host, 0)
+            if n_fetches >= MAX_PER_HOST:
+                self.host_queues.setdefault(host, collections.deque()).append(url)
+                return False
+            self.host_fetches[host] = n_fetches + 1
+            return True
+
+    def release_host(self, host):
+        url = None
+        with self.host_lock:
+            self.host_fetches[host] -= 1
+            if self.host_fetches[host] == 0:
+                del self.host_fetches[host]
+            waiting = self.host_queues.get(host)
+            if waiting is not None:
+                url = waiting.popleft()
+                if len(waiting) == 0:
+                    del self.host_queues[host]
+        if url is not None:
+            try:
+                self.executor.submit(self.load, url)
+            except RuntimeError:
+                # Shutting down
+                pass
+
+    def fetch(self, url):
+        request = urllib.request.Request(url, headers={"User-Agent": "Jargonaut", "Accept": "text/html"})
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+            if response.headers.get_content_type() not in ("text/html", "application/xhtml+xml"):
+                return {}
+            charset = response.headers.get_content_charset() or "utf-8"
+            data = response.read(MAX_READ_SIZE)
+        try:
+            text = data.decode(charset, errors="replace")
+        except LookupError:
+            text = data.decode("utf-8", errors="replace")
+        return parse_metadata(text, url)
+
+    @idle
+    def on_loaded(self, url, preview):
+        self.previews[url] = preview
+        if len(self.previews) > MAX_PREVIEWS:
+            self.previews.popitem(last=False)
+        for callback in self.pending.pop(url, []):
+            if len(preview) > 0:
+                callback(preview)
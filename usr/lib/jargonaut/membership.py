@@ -0,0 +1,140 @@
+# Channel prefixes, from the highest to the lowest rank
+PREFIXES = "~&@%+"
+
+UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+LOWER = "abcdefghijklmnopqrstuvwxyz"
+
+# IRC nicknames are case insensitive, and depending on the server's CASEMAPPING
+# []\~ are the uppercase versions of {}|^
+CASEMAPPINGS = {
+    "ascii": str.maketrans(UPPER, LOWER),
+    "rfc1459": str.maketrans(UPPER + "[]\\~", LOWER + "{}|^"),
+    "strict-rfc1459": str.maketrans(UPPER + "[]\\", LOWER + "{}|"),
+}
+
+def irc_lower(nick, casemapping="rfc1459"):
+    table = CASEMAPPINGS.get(casemapping, CASEMAPPINGS["rfc1459"])
+    return nick.translate(table)
+
+# Splits "@+nick" into ("@+", "nick")
+def split_prefixes(name):
+    index = 0
+    while index < len(name) and name[index] in PREFIXES:
+        index += 1
+    return (name[:index], name[index:])
+
+class Member():
+    __slots__ = ("nick", "modes", "away")
+
+    def __init__(self, nick, modes=""):
+        self.nick = nick
+        self.modes = modes
+        self.away = False
+
+    # Returns the highest prefix the member has, or ""
+    def get_prefix(self):
+        for prefix in PREFIXES:
+            if prefix in self.modes:
+                return prefix
+        return ""
+
+# The users in a channel, keyed by casemapped nickname.
+# Listeners are called with (event, member, old_nick) where event is one of
+# "add", "remove", "rename", "modes" or "clear".
+class Membership():
+    def __init__(self, casemapping="rfc1459"):
+        self.casemapping = casemapping
+        self.members = {}
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members.values())
+
+    def __contains__(self, nick):
+        return self.get_key(nick) in self.members
+
+    def get_key(self, nick):
+        return irc_lower(nick, self.casemapping)
+
+    def get(self, nick):
+        return self.members.get(self.get_key(nick))
+
+    def connect(self, callback):
+        self.listeners.append(callback)
+
+    def emit(self, event, member=None, old_nick=None):
+        for callback in self.listeners:
+            callback(event, member, old_nick)
+
+    def set_casemapping(self, casemapping):
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self.members = {self.get_key(member.nick): member for member in self.members.values()}
+        # Keys changed, let listeners rebuild their own indexes
+        self.emit("clear")
+        for member in self.members.values():
+            self.emit("add", member)
+
+    def add(self, nick, modes=""):
+        key = self.get_key(nick)
+        member = self.members.get(key)
+        if member is None:
+            member = Member(nick, modes)
+            self.members[key] = member
+            self.emit("add", member)
+        elif modes != "" and member.modes != modes:
+            member.modes = modes
+            self.emit("modes", member)
+        return member
+
+    # Adds a user as listed in a NAMES reply, i.e. "@nick"
+    def add_prefixed(self, name):
+        modes, nick = split_prefixes(name)
+        return self.add(nick, modes)
+
+    def remove(self, nick):
+        member = self.members.pop(self.get_key(nick), None)
+        if member is not None:
+            self.emit("remove", member)
+        return member
+
+    def rename(self, old_nick, new_nick):
+        member = self.members.pop(self.get_key(old_nick), None)
+        if member is None:
+            return None
+        member.nick = new_nick
+        key = self.get_key(new_nick)
+        # Whoever had that nick (i.e. we missed their QUIT) is gone now
+        displaced = self.members.pop(key, None)
+        if displaced is not None:
+            self.emit("remove", displaced)
+        self.members[key] = member
+        self.emit("rename", member, old_nick)
+        return member
+
+    def set_mode(self, nick, prefix, enabled):
+        member = self.get(nick)
+        if member is None:
+            return
+        if enabled and prefix not in member.modes:
+            member.modes = "".join(p for p in PREFIXES if p in member.modes or p == prefix)
+        elif not enabled and prefix in member.modes:
+            member.modes = member.modes.replace(prefix, "")
+        else:
+            return
+        self.emit("modes", member)
+
+    def set_away(self, nick, away):
+        member = self.get(nick)
+        if member is None or member.away == away:
+            return
+        member.away = away
+        self.emit("modes", member)
+
+    def clear(self):
+        self.members.clear()
+        self.emit("clear")
@@ -0,0 +1,179 @@
+from gi.repository import GLib
+import collections
+import irc.client
+import select
+import socket
+import threading
+import time
+import traceback
+
+# How long the network thread sleeps when there's nothing to send (in seconds)
+IDLE_TIMEOUT = 1.0
+
+# Flood control: up to burst lines go out at once, then one line per interval (in seconds)
+class TokenBucket():
+    def __init__(self, burst, interval):
+        self.burst = burst
+        self.interval = interval
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.interval > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) / self.interval)
+        else:
+            self.tokens = self.burst
+        self.last_refill = now
+
+    def take(self, cost):
+        self.refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    # Returns how long (in seconds) until take(cost) succeeds
+    def get_delay(self, cost):
+        return max(0, (cost - self.tokens) * self.interval)
+
+# Commands waiting to be sent, per connection. They go out in order,
+# as fast as each server's token bucket allows. Subclasses decide where
+# they run, and implement wake() to get flush() called.
+class CommandQueue():
+    def __init__(self, burst, interval):
+        self.burst = burst
+        self.interval = interval
+        self.queues = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.closing = False
+
+    # Queues func(*args) to be called from the network thread. Commands sent to the
+    # server cost one token, local ones (i.e. connecting) can use a cost of 0.
+    def send(self, connection, func, *args, cost=1):
+        with self.lock:
+            if connection not in self.queues:
+                self.queues[connection] = collections.deque()
+                self.buckets[connection] = TokenBucket(self.burst, self.interval)
+            self.queues[connection].append((cost, func, args))
+        self.wake()
+
+    def set_flood_control(self, burst, interval):
+        with self.lock:
+            self.burst = burst
+            self.interval = interval
+            for bucket in self.buckets.values():
+                bucket.burst = burst
+                bucket.interval = interval
+
+    def wake(self):
+        pass
+
+    def has_pending_commands(self):
+        with self.lock:
+            return any(len(queue) > 0 for queue in self.queues.values())
+
+    # Runs the commands the token buckets allow and returns how long
+    # to wait (in seconds) before the next ones can go out.
+    def flush(self):
+        delay = IDLE_TIMEOUT
+        with self.lock:
+            connections = list(self.queues.keys())
+        for connection in connections:
+            while True:
+                with self.lock:
+                    queue = self.queues[connection]
+                    if len(queue) == 0:
+                        break
+                    cost, func, args = queue[0]
+                    bucket = self.buckets[connection]
+                    if not self.closing and not bucket.take(cost):
+                        delay = min(delay, bucket.get_delay(cost))
+                        break
+                    queue.popleft()
+                try:
+                    func(*args)
+                except irc.client.ServerNotConnectedError:
+                    print("Not connected, dropping command:", getattr(func, "__name__", func), args)
+                except Exception:
+                    traceback.print_exc()
+        return delay
+
+# A single thread doing all the network I/O: it reads from every connection of the reactor
+# and runs the queued commands. Nothing else touches the connections, so they don't need any locking.
+class NetworkWorker(CommandQueue):
+    def __init__(self, reactor, burst, interval):
+        super().__init__(burst, interval)
+        self.reactor = reactor
+        self.thread = None
+        # Wakes the thread up when a command is queued
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Sends what's still queued (ignoring flood control) and stops the thread
+    def stop(self, timeout=2):
+        if self.thread is None:
+            return
+        self.closing = True
+        self.wake()
+        self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def wake(self):
+        try:
+            self.wakeup_writer.send(b"\0")
+        except OSError:
+            # The socket buffer is full, the thread is already due to wake up
+            pass
+
+    def run(self):
+        while True:
+            delay = self.flush()
+            if self.closing and not self.has_pending_commands():
+                return
+            sockets = self.reactor.sockets
+            sockets.append(self.wakeup_reader)
+            readable, writable, failed = select.select(sockets, [], [], delay)
+            if self.wakeup_reader in readable:
+                readable.remove(self.wakeup_reader)
+                try:
+                    while self.wakeup_reader.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            self.reactor.process_data(readable)
+            self.reactor.process_timeout()
+
+# Runs the queued commands from the GTK main loop, for connections
+# which live there too (see transport.py)
+class MainLoopQueue(CommandQueue):
+    def __init__(self, burst, interval):
+        super().__init__(burst, interval)
+        self.source_id = None
+
+    def start(self):
+        self.wake()
+
+    # Sends what's still queued, ignoring flood control
+    def stop(self):
+        self.closing = True
+        self.flush()
+
+    def wake(self):
+        if self.source_id is None:
+            self.source_id = GLib.idle_add(self.on_flush)
+
+    def on_flush(self):
+        delay = self.flush()
+        self.source_id = None
+        if self.has_pending_commands():
+            # Wait for the token buckets to refill
+            self.source_id = GLib.timeout_add(int(delay * 1000) + 1, self.on_flush)
+        return False
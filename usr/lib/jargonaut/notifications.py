@@ -0,0 +1,133 @@
+import collections
+import gettext
+import re
+import time
+from gi.repository import GLib
+
+_ = gettext.gettext
+
+# Number of mentions quoted in an aggregated notification, the most recent ones
+MAX_QUOTED_MENTIONS = 3
+
+QUIET_HOURS = re.compile(r"^\s*(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d)\s*$")
+
+# Parses "22:00-07:30" into (start, end) minutes of the day, or returns None
+def parse_quiet_hours(value):
+    match = QUIET_HOURS.match(value)
+    if match is None:
+        return None
+    start_hours, start_minutes, end_hours, end_minutes = (int(group) for group in match.groups())
+    if start_hours > 23 or end_hours > 23 or start_minutes > 59 or end_minutes > 59:
+        return None
+    return (start_hours * 60 + start_minutes, end_hours * 60 + end_minutes)
+
+def is_quiet_time(quiet_hours, timestamp):
+    if quiet_hours is None:
+        return False
+    local_time = time.localtime(timestamp)
+    minute = local_time.tm_hour * 60 + local_time.tm_min
+    start, end = quiet_hours
+    if start <= end:
+        return start <= minute < end
+    # Over midnight
+    return minute >= start or minute < end
+
+# Seconds from timestamp (during the quiet hours) to their end
+def get_quiet_time_left(quiet_hours, timestamp):
+    local_time = time.localtime(timestamp)
+    minute = local_time.tm_hour * 60 + local_time.tm_min
+    return (quiet_hours[1] - minute) % (24 * 60) * 60 - local_time.tm_sec
+
+# Shows the mentions received while the window isn't focused in a single notification.
+# Mentions are collected for notification-delay ms, then the notification is shown, or
+# updated in place, with a summary. A burst of mentions costs one D-Bus round trip,
+# outside of the handling of the messages.
+class NotificationManager():
+    def __init__(self, settings, on_activated):
+        self.settings = settings
+        self.on_activated = on_activated
+        # The mentions which weren't dismissed yet: how many, from whom (in order), and the
+        # (nick, html) of the last ones. Nothing else is kept, however long they're held.
+        self.n_mentions = 0
+        self.nicks = {}
+        self.recent_mentions = collections.deque(maxlen=MAX_QUOTED_MENTIONS)
+        self.source_id = None
+        # Kept around so that its "closed" callback runs, and reused through update()
+        self.notification = None
+        self.shown = False
+        self.closing = False
+
+    def add_mention(self, nick, html):
+        self.n_mentions += 1
+        self.nicks[nick] = None
+        self.recent_mentions.append((nick, html))
+        if self.source_id is None:
+            self.source_id = GLib.timeout_add(self.settings.notification_delay, self.on_timeout,
+                                              priority=GLib.PRIORITY_LOW)
+
+    def on_timeout(self):
+        self.source_id = None
+        quiet_hours = parse_quiet_hours(self.settings.quiet_hours)
+        now = time.time()
+        if is_quiet_time(quiet_hours, now):
+            # The mentions are summed up once the quiet hours are over
+            self.source_id = GLib.timeout_add_seconds(max(1, get_quiet_time_left(quiet_hours, now)), self.on_timeout,
+                                                      priority=GLib.PRIORITY_LOW)
+        elif self.n_mentions > 0:
+            self.show()
+        return False
+
+    def get_summary(self):
+        nicks = list(self.nicks)
+        if self.n_mentions == 1:
+            return (_("Message from %s") % nicks[0], self.recent_mentions[0][1])
+        if len(nicks) == 1:
+            title = gettext.ngettext("%d mention from %s", "%d mentions from %s", self.n_mentions) % (self.n_mentions, nicks[0])
+        else:
+            title = _("%(mentions)d mentions from %(users)d users") % {"mentions": self.n_mentions, "users": len(nicks)}
+        lines = [f"<b>{GLib.markup_escape_text(nick)}</b>: {html}" for nick, html in self.recent_mentions]
+        return (title, "\n".join(lines))
+
+    def clear_mentions(self):
+        self.n_mentions = 0
+        self.nicks.clear()
+        self.recent_mentions.clear()
+
+    def show(self):
+        from gi.repository import Notify
+        title, body = self.get_summary()
+        if self.notification is None:
+            Notify.init(_("Chat Room"))
+            self.notification = Notify.Notification.new(title, body, "jargonaut-status-msg-symbolic")
+            self.notification.set_urgency(Notify.Urgency.CRITICAL)
+            self.notification.set_timeout(Notify.EXPIRES_NEVER)
+            self.notification.connect("closed", self.on_closed)
+        else:
+            self.notification.update(title, body, "jargonaut-status-msg-symbolic")
+        try:
+            self.notification.show()
+            self.shown = True
+        except GLib.Error as e:
+            print("Could not show the notification:", e.message)
+
+    # The user saw the messages (i.e. the window got the focus)
+    def clear(self):
+        self.clear_mentions()
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+        if self.shown:
+            self.closing = True
+            try:
+                self.notification.close()
+            except GLib.Error as e:
+                print("Could not close the notification:", e.message)
+                self.closing = False
+
+    def on_closed(self, notification):
+        self.shown = False
+        self.clear_mentions()
+        if self.closing:
+            self.closing = False
+            return
+        self.on_activated()
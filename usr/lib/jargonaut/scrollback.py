@@ -0,0 +1,68 @@
+import collections
+import itertools
+
+# Maximum number of messages kept in the webview while following the conversation
+WINDOW_SIZE = 200
+# Number of older messages loaded at once when scrolling up
+PAGE_SIZE = 100
+
+# A bounded, in-memory store of messages.
+# Each message gets a sequence number when it's added. Sequence numbers are
+# contiguous, so a message can be located from its seq without searching.
+class Scrollback():
+    def __init__(self, limit):
+        self.messages = collections.deque(maxlen=limit)
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __reversed__(self):
+        return reversed(self.messages)
+
+    def set_limit(self, limit):
+        self.messages = collections.deque(self.messages, maxlen=limit)
+
+    def append(self, message):
+        message.seq = self.next_seq
+        self.next_seq += 1
+        self.messages.append(message)
+
+    # Adds older messages (i.e. loaded from the chat log) in front of the others.
+    # They get the seqs right below base, but are only kept if there's room for them.
+    def prepend(self, messages, base):
+        seq = base - len(messages)
+        for message in messages:
+            message.seq = seq
+            seq += 1
+        room = self.messages.maxlen - len(self.messages)
+        if base == self.get_first_seq() and room > 0:
+            self.messages.extendleft(reversed(messages[-room:]))
+
+    def get_first_seq(self):
+        return self.next_seq - len(self.messages)
+
+    def get_last(self):
+        if len(self.messages) == 0:
+            return None
+        return self.messages[-1]
+
+    # Returns the messages which came after seq
+    def get_after(self, seq):
+        count = min(self.next_seq - 1 - seq, len(self.messages))
+        if count <= 0:
+            return []
+        messages = list(itertools.islice(reversed(self.messages), count))
+        messages.reverse()
+        return messages
+
+    # Returns up to count messages which came before seq
+    def get_before(self, seq, count):
+        end = min(seq, self.next_seq) - self.get_first_seq()
+        start = max(0, end - count)
+        if end <= start:
+            return []
+        return list(itertools.islice(self.messages, start, end))
@@ -0,0 +1,126 @@
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+import collections
+import itertools
+from capabilities import CapNegotiation
+from completion import NickCompleter
+from highlight import Highlighter
+from membership import Membership, irc_lower
+from scrollback import Scrollback
+
+# Maximum number of messages kept while a server is unreachable
+OUTBOX_SIZE = 100
+
+# Channels get a unique id, used to name their container in the webview
+channel_ids = itertools.count()
+
+# Parses a channel entry from the settings, either "#channel" (on the default server)
+# or "server[:port]/#channel", and returns a (server, port, channel) tuple.
+def parse_channel_entry(entry, default_server, default_port):
+    server, separator, channel = entry.rpartition("/")
+    if separator == "":
+        return (default_server, default_port, channel)
+    host, separator, port = server.partition(":")
+    if host == "":
+        host = default_server
+    # A port which isn't a number is ignored
+    if separator != "" and port.isdigit():
+        return (host, int(port), channel)
+    return (host, default_port, channel)
+
+# A channel, with its own messages, users and render state
+class Channel():
+    def __init__(self, server, name, scrollback_limit):
+        self.server = server
+        self.name = name
+        self.id = next(channel_ids)
+        self.scrollback = Scrollback(scrollback_limit)
+        self.users = Membership(server.casemapping)
+        self.completer = NickCompleter(self.users)
+        self.unread_count = 0
+        self.sidebar_row = None
+
+        # Incremental rendering state: the range of messages which are in the DOM
+        # and what the last rendered message looked like (for grouping).
+        # Channels which aren't shown are only rendered when the user switches to them.
+        self.rendered = False
+        self.rendered_first_seq = 0
+        self.rendered_last_seq = -1
+        self.render_last_nick = ""
+        self.render_last_time = None
+        self.render_last_day = None
+        self.render_dirty = False
+        self.n_real_messages = 0
+        self.scrollback_queue_start_count = 0
+        # The separator is drawn before the message with this seq
+        self.separator_seq = None
+        # Oldest message loaded from the chat log
+        self.history_first_message = None
+        # When a search result is shown, the messages around it replace the recent ones
+        self.search_hit_seq = None
+        # While the messages missed during a disconnection are fetched, new ones wait here
+        self.pending_history = None
+        self.history_since = None
+
+        # User list, rows are keyed by casemapped nick
+        self.user_store = Gtk.ListStore(str, str) # nick, raw_nick
+        self.user_store.set_sort_column_id(1, Gtk.SortType.ASCENDING)
+        self.user_iters = {}
+        # Membership changes which aren't applied to the user store yet
+        self.pending_user_changes = []
+        self.users_dirty = False
+
+# A connection to a server and the channels joined on it
+class Server():
+    def __init__(self, host, port, tls, nickname, highlight_words):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.nickname = nickname
+        # Created along with the reactor, once the window is drawn
+        self.connection = None
+        self.is_connected = False
+        # Whether the server was ever connected (i.e. this isn't the first attempt)
+        self.was_connected = False
+        self.supervisor = None
+        # Messages typed while disconnected, sent once the channels are joined again
+        self.outbox = collections.deque(maxlen=OUTBOX_SIZE)
+        # IRCv3 state, reset on each connection
+        self.caps = CapNegotiation()
+        self.batches = {}
+        self.sasl_mechanism = None
+        self.sasl_authenticated = False
+        self.casemapping = "rfc1459"
+        self.highlighter = Highlighter(nickname, highlight_words, self.casemapping)
+        self.chatlog = None
+        # Keyed by casemapped name
+        self.channels = {}
+
+    def get_key(self, name):
+        return irc_lower(name, self.casemapping)
+
+    def get_channel(self, name):
+        return self.channels.get(self.get_key(name))
+
+    def add_channel(self, name, scrollback_limit):
+        channel = Channel(self, name, scrollback_limit)
+        self.channels[self.get_key(name)] = channel
+        return channel
+
+    def reset_session(self):
+        self.caps.reset()
+        self.batches.clear()
+        self.sasl_mechanism = None
+        self.sasl_authenticated = False
+
+    def set_nickname(self, nickname):
+        self.nickname = nickname
+        self.highlighter.set_nickname(nickname)
+
+    def set_casemapping(self, casemapping):
+        self.casemapping = casemapping
+        self.channels = {self.get_key(channel.name): channel for channel in self.channels.values()}
+        for channel in self.channels.values():
+            channel.users.set_casemapping(casemapping)
+        self.highlighter.set_casemapping(casemapping)
@@ -1,19 +1,71 @@
+from gi.repository import Gio, GLib
+
+# A cached, typed view of a settings schema. Every key is read once, then kept up to date
+# from the "changed" signal, so reading a setting is a plain attribute access which never
+# goes to dconf (i.e. settings.timestamp_24h for the "timestamp-24h" key).
+class Settings():
+    def __init__(self, schema_id):
+        self.gsettings = Gio.Settings(schema=schema_id)
+        schema = self.gsettings.get_property("settings-schema")
+        self.types = {key: schema.get_key(key).get_value_type() for key in schema.list_keys()}
+        for key in self.types:
+            self.load(key)
+        # Connected first, so the cache is updated before the other "changed" handlers run
+        self.gsettings.connect("changed", self.on_changed)
+
+    def load(self, key):
+        setattr(self, get_attribute_name(key), self.gsettings.get_value(key).unpack())
+
+    def on_changed(self, gsettings, key):
+        if key in self.types:
+            self.load(key)
+
+    def get(self, key):
+        return getattr(self, get_attribute_name(key))
+
+    def get_default(self, key):
+        return self.gsettings.get_default_value(key).unpack()
+
+    def set(self, key, value):
+        self.gsettings.set_value(key, GLib.Variant(self.types[key].dup_string(), value))
+        setattr(self, get_attribute_name(key), value)
+
+    # i.e. connect("changed::debug", callback), callback(settings, key) is called once the cache is updated
+    def connect(self, signal, callback):
+        return self.gsettings.connect(signal, lambda gsettings, key: callback(self, key))
+
+def get_attribute_name(key):
+    return key.replace("-", "_")
+
 def bind_entry_widget(widget, settings, key, fn_callback=None):
-    widget.set_text(settings.get_string(key))
+    widget.set_text(settings.get(key))
     widget.connect("changed", on_bound_entry_changed, settings, key, fn_callback)
     return widget
 
+# Binds an entry to a list of strings, shown as comma-separated values
+def bind_list_entry_widget(widget, settings, key, fn_callback=None):
+    widget.set_text(", ".join(settings.get(key)))
+    widget.connect("changed", on_bound_list_entry_changed, settings, key, fn_callback)
+    return widget
+
 def bind_switch_widget(widget, settings, key, fn_callback=None):
-    widget.set_active(settings.get_boolean(key))
+    widget.set_active(settings.get(key))
     widget.connect("notify::active", on_bound_switch_activated, settings, key, fn_callback)
     return widget
 
 def on_bound_entry_changed(widget, settings, key, fn_callback=None):
-    settings.set_string(key, widget.get_text())
+    settings.set(key, widget.get_text())
     if fn_callback is not None:
-        fn_callback(widget.get_active())
+        fn_callback(widget.get_text())
+
+def on_bound_list_entry_changed(widget, settings, key, fn_callback=None):
+    values = [value.strip() for value in widget.get_text().split(",")]
+    values = [value for value in values if value != ""]
+    settings.set(key, values)
+    if fn_callback is not None:
+        fn_callback(values)
 
 def on_bound_switch_activated(widget, active, settings, key, fn_callback=None):
-    settings.set_boolean(key, widget.get_active())
+    settings.set(key, widget.get_active())
     if fn_callback is not None:
         fn_callback(widget.get_active())
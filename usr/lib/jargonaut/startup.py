@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+# Time to first paint we aim for (in ms), from the start of the process
+FIRST_PAINT_BUDGET = 400
+
+# When the process started, on the time.monotonic() clock. The kernel gives it in clock
+# ticks since boot, elsewhere this falls back to now (i.e. when this module is imported).
+def get_process_start():
+    now = time.monotonic()
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, fields are counted after its closing parenthesis
+            fields = f.read().rpartition(")")[2].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return now - (time.clock_gettime(time.CLOCK_BOOTTIME) - started)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return now
+
+# Records when each startup phase ends. Marks are cheap, so they're always recorded,
+# the timeline is only printed with --profile-startup.
+class StartupProfiler():
+    def __init__(self):
+        # The interpreter's own startup counts too
+        self.start = get_process_start()
+        self.last = self.start
+        self.enabled = "--profile-startup" in sys.argv
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.monotonic()
+        elapsed = (now - self.start) * 1000
+        delta = (now - self.last) * 1000
+        self.last = now
+        self.phases.append((phase, elapsed, delta))
+        if self.enabled:
+            print(f"[startup] {elapsed:8.1f} ms (+{delta:7.1f} ms) {phase}")
+        return elapsed
+
+    def mark_first_paint(self):
+        elapsed = self.mark("first paint")
+        if self.enabled and elapsed > FIRST_PAINT_BUDGET:
+            print(f"[startup] first paint took {elapsed:.0f} ms, over the {FIRST_PAINT_BUDGET} ms budget")
+
+profiler = StartupProfiler()
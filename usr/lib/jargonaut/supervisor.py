@@ -0,0 +1,151 @@
+from gi.repository import GLib
+import itertools
+import random
+import time
+
+# Delay before reconnecting (in seconds), doubled after each failed attempt up to the maximum
+RECONNECT_DELAY = 2
+RECONNECT_MAX_DELAY = 300
+
+# Any line received shows the connection is alive. The server is pinged once nothing
+# was received for PING_INTERVAL seconds, and the connection is considered dead if
+# nothing (not even the PONG) comes back within PING_TIMEOUT seconds.
+PING_CHECK_INTERVAL = 1
+PING_INTERVAL = 5
+PING_TIMEOUT = 5
+
+# Once the socket is connected, the server has this long (in seconds) to welcome us
+# (i.e. through the capability negotiation and SASL) before the connection is dropped
+REGISTRATION_TIMEOUT = 30
+
+ping_ids = itertools.count(1)
+
+# Exponential backoff, with jitter so that clients which lost their connection
+# at the same time (i.e. during a netsplit) don't all come back at once.
+class Backoff():
+    def __init__(self, base, maximum):
+        self.base = base
+        self.maximum = maximum
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+# Keeps a server connected: reconnects when the connection is lost or can't be
+# established, and pings the server to notice dead connections and measure the lag.
+# It runs on the main loop, the actual network work is done through the callbacks:
+# connect() starts a connection attempt, ping(token) sends a PING and drop(reason)
+# closes a connection which stopped responding.
+class ConnectionSupervisor():
+    def __init__(self, connect, ping, drop):
+        self.connect_callback = connect
+        self.ping_callback = ping
+        self.drop_callback = drop
+        self.backoff = Backoff(RECONNECT_DELAY, RECONNECT_MAX_DELAY)
+        self.reconnect_source_id = None
+        self.registration_source_id = None
+        self.ping_source_id = None
+        self.ping_token = None
+        self.ping_time = None
+        self.last_activity_time = None
+        # Round-trip time of the last PING (in seconds)
+        self.lag = None
+        self.stopped = False
+
+    def connect(self):
+        self.cancel_reconnect()
+        if not self.stopped:
+            self.connect_callback()
+
+    def stop(self):
+        self.stopped = True
+        self.cancel_reconnect()
+        self.cancel_registration()
+        self.stop_pinging()
+
+    # The socket is connected, the registration (CAP, NICK, USER...) starts
+    def on_socket_connected(self):
+        if self.ping_source_id is not None:
+            # Already welcomed
+            return
+        self.cancel_registration()
+        self.registration_source_id = GLib.timeout_add_seconds(REGISTRATION_TIMEOUT, self.on_registration_timeout)
+
+    def on_registration_timeout(self):
+        self.registration_source_id = None
+        self.drop_callback("Registration timeout: %d seconds" % REGISTRATION_TIMEOUT)
+        return False
+
+    def cancel_registration(self):
+        if self.registration_source_id is not None:
+            GLib.source_remove(self.registration_source_id)
+            self.registration_source_id = None
+
+    # The server welcomed us (001)
+    def on_connected(self):
+        self.backoff.reset()
+        self.cancel_registration()
+        self.stop_pinging()
+        self.last_activity_time = time.monotonic()
+        self.ping_source_id = GLib.timeout_add_seconds(PING_CHECK_INTERVAL, self.on_ping_check)
+
+    # Schedules a reconnection and returns its delay (in seconds),
+    # or None if it's stopped or a reconnection is already scheduled.
+    def on_disconnected(self):
+        self.cancel_registration()
+        self.stop_pinging()
+        self.lag = None
+        if self.stopped or self.reconnect_source_id is not None:
+            return None
+        delay = self.backoff.next_delay()
+        self.reconnect_source_id = GLib.timeout_add(int(delay * 1000), self.on_reconnect_timeout)
+        return delay
+
+    def on_reconnect_timeout(self):
+        self.reconnect_source_id = None
+        self.connect()
+        return False
+
+    def cancel_reconnect(self):
+        if self.reconnect_source_id is not None:
+            GLib.source_remove(self.reconnect_source_id)
+            self.reconnect_source_id = None
+
+    def stop_pinging(self):
+        if self.ping_source_id is not None:
+            GLib.source_remove(self.ping_source_id)
+            self.ping_source_id = None
+        self.ping_token = None
+
+    # Called for every line received, from whichever thread reads the connection
+    def on_activity(self):
+        self.last_activity_time = time.monotonic()
+
+    def on_ping_check(self):
+        now = time.monotonic()
+        if self.ping_token is not None and now - self.ping_time > PING_TIMEOUT:
+            if self.last_activity_time < self.ping_time:
+                self.ping_source_id = None
+                self.ping_token = None
+                self.drop_callback("Ping timeout: %d seconds" % int(now - self.last_activity_time))
+                return False
+            # The server is alive, it's just slow to answer, ping it again once it's quiet
+            self.ping_token = None
+        if self.ping_token is None and now - self.last_activity_time >= PING_INTERVAL:
+            self.ping_token = f"jargonaut-{next(ping_ids)}"
+            self.ping_time = now
+            self.ping_callback(self.ping_token)
+        return True
+
+    # Returns the lag if the PONG answers our last PING, None otherwise
+    def on_pong(self, token):
+        if self.ping_token is None or token != self.ping_token:
+            return None
+        self.lag = time.monotonic() - self.ping_time
+        self.ping_token = None
+        return self.lag
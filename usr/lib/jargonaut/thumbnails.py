@@ -0,0 +1,176 @@
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, Gio, GLib
+import concurrent.futures
+import hashlib
+import os
+import threading
+import urllib.parse
+import urllib.request
+from formatting import THUMBNAIL_SCHEME
+from ui import idle
+
+# Thumbnails fit in a square of this size (in pixels), twice the size they're shown at for HiDPI screens
+THUMBNAIL_SIZE = 400
+# Images bigger than this (in bytes) aren't downloaded
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+FETCH_TIMEOUT = 15
+# Number of images downloaded at once
+MAX_WORKERS = 4
+# The disk cache is trimmed (least recently used thumbnails first) when it goes over this size (in bytes)
+CACHE_SIZE = 100 * 1024 * 1024
+
+def get_cache_directory():
+    return os.path.join(GLib.get_user_cache_dir(), "jargonaut", "thumbnails")
+
+class ThumbnailError(Exception):
+    pass
+
+# A bounded LRU cache of thumbnails on disk. Reading a thumbnail updates its mtime,
+# so the oldest mtimes are the least recently used. Only used from the worker threads.
+class ThumbnailCache():
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.total_size = None
+
+    def get_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    # Returns (data, content_type) or None
+    def get(self, url):
+        path = self.get_path(url)
+        for extension, content_type in ((".jpg", "image/jpeg"), (".png", "image/png")):
+            try:
+                with open(path + extension, "rb") as f:
+                    data = f.read()
+                os.utime(path + extension)
+                return (data, content_type)
+            except OSError:
+                continue
+        return None
+
+    def put(self, url, data, content_type):
+        extension = ".png" if content_type == "image/png" else ".jpg"
+        path = self.get_path(url) + extension
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.total_size is None:
+                self.total_size = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+            temporary_path = path + ".tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+            self.total_size += len(data)
+            if self.total_size > self.max_size:
+                self.trim()
+
+    # Removes the least recently used thumbnails, down to 90% of the maximum size
+    def trim(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self.total_size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.total_size <= self.max_size * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.total_size -= size
+            except OSError:
+                pass
+
+# Serves the thumbnails of images posted in the chat, through a custom URI scheme
+# (see get_thumbnail_uri()). Images are downloaded and downscaled by worker threads,
+# so a huge image costs a download, never a stall of the view.
+class ThumbnailProvider():
+    def __init__(self):
+        self.cache = ThumbnailCache(get_cache_directory(), CACHE_SIZE)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        # Requests waiting for the same image, keyed by URL
+        self.pending = {}
+
+    def register(self, context):
+        context.register_uri_scheme(THUMBNAIL_SCHEME, self.on_request)
+        # Only local pages (i.e. ours) can load thumbnails
+        context.get_security_manager().register_uri_scheme_as_local(THUMBNAIL_SCHEME)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def on_request(self, request):
+        url = urllib.parse.unquote(request.get_path())
+        if not url.lower().startswith(("http://", "https://")):
+            self.finish_error(request, "Unsupported URL")
+            return
+        if url in self.pending:
+            self.pending[url].append(request)
+            return
+        self.pending[url] = [request]
+        self.executor.submit(self.load, url)
+
+    # Runs in the executor: from the disk cache if possible, downloaded otherwise
+    def load(self, url):
+        try:
+            thumbnail = self.cache.get(url)
+            if thumbnail is None:
+                thumbnail = self.create_thumbnail(self.fetch(url))
+                try:
+                    self.cache.put(url, *thumbnail)
+                except OSError as e:
+                    print("Could not cache thumbnail:", e)
+            self.on_loaded(url, thumbnail, None)
+        except Exception as e:
+            self.on_loaded(url, None, str(e))
+
+    def fetch(self, url):
+        request = urllib.request.Request(url, headers={"User-Agent": "Jargonaut"})
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+            content_type = response.headers.get("Content-Type", "")
+            if not content_type.startswith("image/"):
+                raise ThumbnailError(f"Not an image: {content_type}")
+            length = response.headers.get("Content-Length")
+            if length is not None and length.isdigit() and int(length) > MAX_IMAGE_SIZE:
+                raise ThumbnailError("Image too big")
+            data = response.read(MAX_IMAGE_SIZE + 1)
+            if len(data) > MAX_IMAGE_SIZE:
+                raise ThumbnailError("Image too big")
+            return data
+
+    # Decodes the image straight at the thumbnail size (only the first frame of animations)
+    # and returns (data, content_type)
+    def create_thumbnail(self, data):
+        loader = GdkPixbuf.PixbufLoader()
+        loader.connect("size-prepared", self.on_size_prepared)
+        try:
+            loader.write(data)
+            loader.close()
+        except GLib.Error as e:
+            raise ThumbnailError(e.message)
+        pixbuf = loader.get_pixbuf()
+        if pixbuf is None:
+            raise ThumbnailError("Could not decode the image")
+        if pixbuf.get_has_alpha():
+            success, buffer = pixbuf.save_to_bufferv("png", [], [])
+            return (bytes(buffer), "image/png")
+        success, buffer = pixbuf.save_to_bufferv("jpeg", ["quality"], ["85"])
+        return (bytes(buffer), "image/jpeg")
+
+    def on_size_prepared(self, loader, width, height):
+        scale = min(1, THUMBNAIL_SIZE / max(width, height, 1))
+        if scale < 1:
+            loader.set_size(max(1, int(width * scale)), max(1, int(height * scale)))
+
+    @idle
+    def on_loaded(self, url, thumbnail, error):
+        for request in self.pending.pop(url, []):
+            if thumbnail is None:
+                self.finish_error(request, error)
+                continue
+            data, content_type = thumbnail
+            stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+            request.finish(stream, len(data), content_type)
+
+    def finish_error(self, request, message):
+        request.finish_error(GLib.Error.new_literal(Gio.io_error_quark(), message, Gio.IOErrorEnum.FAILED))
@@ -0,0 +1,99 @@
+import gettext
+import time
+from gi.repository import GLib
+
+_ = gettext.gettext
+
+# Number of minutes (and days) memoized, the caches are cleared when they're full
+CACHE_SIZE = 10000
+
+def get_day_key(date_time):
+    return date_time.format("%Y-%m-%d")
+
+# Formats the times and days of messages. The local midnight is computed once a day
+# (a timer moves it at the next midnight) and the strings are memoized per minute and
+# per 12h/24h format, so rendering a message costs dict lookups, not GLib.DateTimes.
+class TimestampFormatter():
+    def __init__(self, on_day_changed):
+        self.on_day_changed = on_day_changed
+        # Keyed by (minute, use_24h)
+        self.times = {}
+        # Local day ("YYYY-MM-DD") of the minutes before today
+        self.days = {}
+        self.day_labels = {}
+        self.source_id = None
+        self.update_day()
+
+    def update_day(self):
+        now = GLib.DateTime.new_now_local()
+        year, month, day = now.get_ymd()
+        midnight = GLib.DateTime.new_local(year, month, day, 0, 0, 0)
+        self.midnight = midnight.to_unix()
+        self.next_midnight = midnight.add_days(1).to_unix()
+        self.today = get_day_key(midnight)
+        self.yesterday = get_day_key(midnight.add_days(-1))
+        # "Today" and "Yesterday" moved
+        self.day_labels.clear()
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+        self.source_id = GLib.timeout_add_seconds(max(1, self.next_midnight - int(time.time())), self.on_timeout)
+
+    def on_timeout(self):
+        self.source_id = None
+        if time.time() < self.next_midnight:
+            # Woke up a bit early
+            self.update_day()
+        else:
+            self.change_day()
+        return False
+
+    def change_day(self):
+        self.update_day()
+        self.on_day_changed()
+
+    def get_time(self, timestamp, use_24h):
+        key = (timestamp // 60, use_24h)
+        text = self.times.get(key)
+        if text is None:
+            if len(self.times) >= CACHE_SIZE:
+                self.times.clear()
+            date_time = GLib.DateTime.new_from_unix_local(key[0] * 60)
+            text = date_time.format("%-H:%M" if use_24h else "%-I:%M %p")
+            self.times[key] = text
+        return text
+
+    # Returns the local day of a timestamp, as "YYYY-MM-DD"
+    def get_day(self, timestamp):
+        if timestamp >= self.next_midnight and time.time() >= self.next_midnight:
+            # The timer didn't fire yet, i.e. after a suspend
+            self.change_day()
+        if timestamp >= self.midnight:
+            return self.today
+        minute = timestamp // 60
+        day = self.days.get(minute)
+        if day is None:
+            if len(self.days) >= CACHE_SIZE:
+                self.days.clear()
+            day = get_day_key(GLib.DateTime.new_from_unix_local(minute * 60))
+            self.days[minute] = day
+        return day
+
+    def get_day_label(self, day):
+        if day == self.today:
+            return _("Today")
+        if day == self.yesterday:
+            return _("Yesterday")
+        label = self.day_labels.get(day)
+        if label is None:
+            year, month, day_of_month = (int(value) for value in day.split("-"))
+            label = GLib.DateTime.new_local(year, month, day_of_month, 0, 0, 0).format("%A %x")
+            self.day_labels[day] = label
+        return label
+
+    # The time, followed by the day unless it's today
+    def get_date_time(self, timestamp, use_24h):
+        text = self.get_time(timestamp, use_24h)
+        day = self.get_day(timestamp)
+        if day != self.today:
+            text += " " + self.get_day_label(day)
+        return text
@@ -0,0 +1,239 @@
+from gi.repository import Gio, GLib
+import collections
+import irc.client
+import traceback
+
+# Maximum time to establish a connection (in seconds)
+CONNECT_TIMEOUT = 30
+
+# Maximum time to wait for the QUIT to be written when disconnecting (in seconds)
+QUIT_TIMEOUT = 5
+
+# Sent before logging on, so that the server holds the registration until the
+# capability negotiation ends (with CAP END)
+CAP_LS = "CAP LS 302"
+
+# Lines which aren't valid UTF-8 are decoded as Latin-1, like irc's LenientDecodingLineBuffer
+def decode_line(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+# An irc.client connection which runs on the GTK main loop: it connects, reads and writes
+# asynchronously through Gio and hands lines straight to irc.client's parser, so events
+# are dispatched on the main thread without a network thread or a thread hop.
+# self.socket stays None, so the reactor's select() loop never sees these connections.
+class GioServerConnection(irc.client.ServerConnection):
+    def __init__(self, reactor):
+        super().__init__(reactor)
+        self.stream = None
+        self.input = None
+        self.output = None
+        self.cancellable = None
+        self.connect_timeout_id = None
+        self.write_cancellable = None
+        self.certificate = None
+        self.pending_writes = collections.deque()
+        self.writing = False
+        self.close_after_write = False
+
+    # Non-blocking version of connect(), on_socket_connected() is called once the socket is
+    # connected (and the registration sent), on_error(message) if it fails.
+    # certificate is an optional Gio.TlsCertificate presented to the server.
+    def connect_async(self, server, port, nickname, tls, on_socket_connected, on_error, certificate=None):
+        if self.connected:
+            self.disconnect("Changing servers")
+        self.handlers = {}
+        self.real_server_name = ""
+        self.real_nickname = nickname
+        self.server = server
+        self.port = port
+        self.server_address = (server, port)
+        self.nickname = nickname
+        self.username = nickname
+        self.ircname = nickname
+        self.password = None
+        self.sasl_login = None
+        self.certificate = certificate
+        self.abort_connection()
+
+        client = Gio.SocketClient()
+        client.set_tls(tls)
+        client.connect("event", self.on_socket_client_event)
+        self.cancellable = Gio.Cancellable()
+        # Only the connection times out: Gio.SocketClient's timeout would also apply to every
+        # read on the socket, and a quiet channel would look like a dead connection
+        self.connect_timeout_id = GLib.timeout_add_seconds(CONNECT_TIMEOUT, self.on_connect_timeout,
+                                                           self.cancellable, on_error)
+        client.connect_to_host_async(server, port, self.cancellable, self.on_connected, (on_socket_connected, on_error))
+
+    def on_connect_timeout(self, cancellable, on_error):
+        self.connect_timeout_id = None
+        cancellable.cancel()
+        on_error("Connection timed out")
+        return False
+
+    # Cancels the connection attempt in progress, if there's one
+    def abort_connection(self):
+        if self.connect_timeout_id is not None:
+            GLib.source_remove(self.connect_timeout_id)
+            self.connect_timeout_id = None
+        if self.cancellable is not None:
+            self.cancellable.cancel()
+
+    def on_socket_client_event(self, client, event, connectable, connection):
+        if event == Gio.SocketClientEvent.TLS_HANDSHAKING:
+            # Like the ssl transport, don't verify the server's certificate
+            connection.connect("accept-certificate", lambda *args: True)
+            if self.certificate is not None:
+                connection.set_certificate(self.certificate)
+
+    def on_connected(self, client, result, callbacks):
+        on_socket_connected, on_error = callbacks
+        try:
+            self.stream = client.connect_to_host_finish(result)
+        except GLib.Error as e:
+            if not e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                self.abort_connection()
+                on_error(e.message)
+            return
+        if self.connect_timeout_id is not None:
+            GLib.source_remove(self.connect_timeout_id)
+            self.connect_timeout_id = None
+        self.input = Gio.DataInputStream.new(self.stream.get_input_stream())
+        self.input.set_newline_type(Gio.DataStreamNewlineType.LF)
+        self.output = self.stream.get_output_stream()
+        self.write_cancellable = Gio.Cancellable()
+        self.pending_writes.clear()
+        self.writing = False
+        self.close_after_write = False
+        self.connected = True
+        self.read_lines()
+
+        # Log on...
+        self.send_raw(CAP_LS)
+        self.nick(self.nickname)
+        self.user(self.username, self.ircname)
+        on_socket_connected()
+
+    def read_lines(self):
+        self.input.read_line_async(GLib.PRIORITY_DEFAULT, self.cancellable, self.on_line_read)
+
+    def on_line_read(self, stream, result):
+        if stream is not self.input:
+            # Left over from a previous connection
+            return
+        try:
+            line, length = stream.read_line_finish(result)
+        except GLib.Error as e:
+            if e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.TIMED_OUT):
+                self.disconnect("Connection timed out")
+            elif not e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                self.disconnect("Connection reset by peer")
+            return
+        if line is None:
+            # End of stream: the server hung up
+            self.disconnect("Connection reset by peer")
+            return
+        self.process_line(line)
+        # Process whatever complete lines are already buffered, without going through the main loop again
+        while self.connected and b"\n" in self.input.peek_buffer():
+            line, length = self.input.read_line(None)
+            self.process_line(line)
+        if self.connected:
+            self.read_lines()
+
+    def process_line(self, data):
+        line = decode_line(data).rstrip("\r")
+        if line == "":
+            return
+        try:
+            self._process_line(line)
+        except Exception:
+            traceback.print_exc()
+
+    def send_raw(self, string):
+        if self.stream is None:
+            raise irc.client.ServerNotConnectedError("Not connected.")
+        self.pending_writes.append(self._prep_message(string))
+        if not self.writing:
+            self.write_pending()
+
+    def write_pending(self):
+        if len(self.pending_writes) == 0:
+            self.writing = False
+            if self.close_after_write:
+                self.close_stream()
+            return
+        self.writing = True
+        data = b"".join(self.pending_writes)
+        self.pending_writes.clear()
+        self.pending_writes.append(data)
+        self.output.write_bytes_async(GLib.Bytes.new(data), GLib.PRIORITY_DEFAULT, self.write_cancellable,
+                                      self.on_written, self.stream)
+
+    def on_written(self, output, result, stream):
+        if stream is not self.stream:
+            # Left over from a previous connection (i.e. after a reconnection), close it
+            try:
+                output.write_bytes_finish(result)
+            except GLib.Error:
+                pass
+            try:
+                stream.close(None)
+            except GLib.Error:
+                pass
+            return
+        try:
+            written = output.write_bytes_finish(result)
+        except GLib.Error:
+            self.pending_writes.clear()
+            self.writing = False
+            if self.connected:
+                self.disconnect("Connection reset by peer.")
+            self.close_stream()
+            return
+        data = self.pending_writes.popleft()
+        if written < len(data):
+            self.pending_writes.appendleft(data[written:])
+        self.write_pending()
+
+    def disconnect(self, message=""):
+        try:
+            del self.connected
+        except AttributeError:
+            # Not connected (yet), abort the connection attempt if there's one
+            self.abort_connection()
+            return
+
+        # Stop reading, but let the pending writes complete. The stream is closed once the
+        # QUIT is written, or after QUIT_TIMEOUT if the connection is stuck: writing it
+        # synchronously would block the main loop on a full send buffer.
+        self.cancellable.cancel()
+        self.quit(message)
+        self.close_after_write = True
+        GLib.timeout_add_seconds(QUIT_TIMEOUT, self.write_cancellable.cancel)
+        self._handle_event(irc.client.Event("disconnect", self.server, "", [message]))
+
+    def close_stream(self):
+        if self.stream is None:
+            return
+        try:
+            self.stream.close(None)
+        except GLib.Error:
+            pass
+        self.stream = None
+        self.input = None
+        self.output = None
+
+# Wraps an irc.connection.Factory for the threaded transport: sends CAP LS as
+# soon as the socket is connected, before irc.client sends NICK and USER.
+class CapFactory():
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, server_address):
+        sock = self.factory(server_address)
+        sock.sendall(f"{CAP_LS}\r\n".encode("utf-8"))
+        return sock
@@ -1,10 +1,16 @@
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib
+import collections
+import functools
 import gettext
 import locale
 import math
 import threading
+import time
+import traceback
+import zlib
+from membership import irc_lower
 
 # i18n
 APP = "jargonaut"
@@ -36,6 +42,21 @@ color_palette = [
     "#A5A5A5"   # Gris
 ]
 
+# Markup of the nicks in the user lists, for about as many users as a big channel shows at once
+NICK_MARKUP_CACHE_SIZE = 1024
+
+# Nicks always get the same color, in every session: it's picked by a hash of the casemapped nick
+def get_nick_color(nick):
+    return color_palette[zlib.crc32(irc_lower(nick).encode("utf-8")) % len(color_palette)]
+
+@functools.lru_cache(maxsize=NICK_MARKUP_CACHE_SIZE)
+def get_nick_markup(nick, away=False, prefix=""):
+    color = get_nick_color(nick)
+    prefix = GLib.markup_escape_text(prefix)
+    if away:
+        return f"<span alpha='50%'>{prefix}</span><span foreground='{color}' alpha='50%'><i>{nick}</i></span>"
+    return f"{prefix}<span foreground='{color}'>{nick}</span>"
+
 # Used as a decorator to run things in the background
 def _async(func):
     def wrapper(*args, **kwargs):
@@ -45,12 +66,82 @@ def _async(func):
         return thread
     return wrapper
 
-# Used as a decorator to run things in the main loop, from another thread
+# Calls made through @idle are queued and run in order from a single idle
+# source, rather than adding one GLib idle source per call.
+idle_queue = collections.deque()
+idle_lock = threading.Lock()
+idle_scheduled = False
+# Maximum time spent running queued calls before giving the main loop back (in seconds)
+IDLE_TIME_BUDGET = 0.01
+
+def run_idle_queue():
+    global idle_scheduled
+    deadline = time.monotonic() + IDLE_TIME_BUDGET
+    while True:
+        with idle_lock:
+            if len(idle_queue) == 0:
+                idle_scheduled = False
+                return False
+            func, args = idle_queue.popleft()
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+        if time.monotonic() > deadline:
+            # Let GTK draw and handle input, we'll resume in the next iteration
+            return True
+
+# Used as a decorator to run things in the main loop, from another thread.
+# Calls made from the main loop itself run right away, unless queued calls are
+# still waiting (so they keep their order).
 def idle(func):
     def wrapper(*args):
-        GLib.idle_add(func, *args)
+        global idle_scheduled
+        if threading.current_thread() is threading.main_thread():
+            with idle_lock:
+                run_now = len(idle_queue) == 0
+            if run_now:
+                try:
+                    func(*args)
+                except Exception:
+                    traceback.print_exc()
+                return
+        with idle_lock:
+            idle_queue.append((func, args))
+            if idle_scheduled:
+                return
+            idle_scheduled = True
+        GLib.idle_add(run_idle_queue)
     return wrapper
 
+# Coalesces render requests: schedule() marks the view as dirty and the
+# callback runs at most once per interval (in ms), however many requests came in.
+class RenderScheduler():
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self.source_id = None
+        self.n_requests = 0
+        self.n_flushes = 0
+
+    def schedule(self):
+        self.n_requests += 1
+        if self.source_id is None:
+            self.source_id = GLib.timeout_add(self.interval, self.on_timeout)
+
+    def on_timeout(self):
+        self.source_id = None
+        self.n_flushes += 1
+        self.callback()
+        return False
+
+    def set_interval(self, interval):
+        self.interval = interval
+
+    # Number of requests which were merged into an earlier flush
+    def get_coalesced_count(self):
+        return self.n_requests - self.n_flushes
+
 def build_menu(app, window, menu):
         accel_group = Gtk.AccelGroup()
         window.add_accel_group(accel_group)
@@ -58,6 +149,14 @@ def build_menu(app, window, menu):
         item.set_label(_("Preferences"))
         item.connect("activate", open_preferences, app)
         menu.append(item)
+        item = Gtk.ImageMenuItem()
+        item.set_image(Gtk.Image.new_from_icon_name("xsi-edit-find-symbolic", Gtk.IconSize.MENU))
+        item.set_label(_("Search"))
+        item.connect("activate", open_search, app)
+        key, mod = Gtk.accelerator_parse("<Control>F")
+        item.add_accelerator("activate", accel_group, key, mod, Gtk.AccelFlags.VISIBLE)
+        item.set_sensitive(app.settings.keep_history)
+        menu.append(item)
         menu.append(Gtk.SeparatorMenuItem())
         item = Gtk.ImageMenuItem()
         item.set_image(Gtk.Image.new_from_icon_name("xsi-keyboard-shortcuts-symbolic", Gtk.IconSize.MENU))
@@ -94,13 +193,8 @@ def open_about(widget, window):
         dlg.set_program_name("Jargonaut")
         dlg.set_comments(_("Chat Room"))
         try:
-            h = open("/usr/share/common-licenses/GPL", encoding="utf-8")
-            s = h.readlines()
-            gpl = ""
-            for line in s:
-                gpl += line
-            h.close()
-            dlg.set_license(gpl)
+            with open("/usr/share/common-licenses/GPL", encoding="utf-8") as h:
+                dlg.set_license(h.read())
         except Exception as e:
             print(e)
 
@@ -117,9 +211,16 @@ def open_about(widget, window):
         dlg.show()
 
 def open_preferences(widget, app):
+        app.setup_preferences()
         app.builder.get_object("main_stack").set_visible_child_name("page_settings")
         app.builder.get_object("back_button").set_visible(True)
 
+def open_search(widget, app):
+        app.builder.get_object("main_stack").set_visible_child_name("page_chat")
+        app.builder.get_object("back_button").set_visible(False)
+        app.search_bar.set_search_mode(True)
+        app.search_entry.grab_focus()
+
 def open_keyboard_shortcuts(widget):
         gladefile = "/usr/share/jargonaut/shortcuts.ui"
         builder = Gtk.Builder()
@@ -129,25 +230,6 @@ def open_keyboard_shortcuts(widget):
         window.set_title(_("Chat Room"))
         window.show()
 
-def get_span_minutes(message_dt, previous_dt):
-    span = message_dt.difference(previous_dt)
-    return math.floor(span / GLib.TIME_SPAN_MINUTE)
-
-def format_timespan(message_dt, use_24h):
-    now = GLib.DateTime.new_now_local()
-    y, m, d = now.get_ymd()
-
-    this_past_midnight_dt = GLib.DateTime.new_local(y, m, d, 0, 0, 0)
-    before_today = this_past_midnight_dt.difference(message_dt) > 0
-
-    formatted = None
-
-    if use_24h:
-        formatted = message_dt.format("%-H:%M")
-    else:
-        formatted = message_dt.format("%-I:%M %p")
-
-    if before_today:
-        formatted += " %x"
-
-    return formatted
+# Times are in seconds since the epoch
+def get_span_minutes(message_time, previous_time):
+    return math.floor((message_time - previous_time) / 60)